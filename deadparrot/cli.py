@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+# -*- coding: utf-8; -*-
+#
+# Copyright (C) 2009 Gabriel Falcão <gabriel@nacaolivre.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public
+# License along with this program; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+import os
+import sys
+import heapq
+import shutil
+import hashlib
+import tempfile
+
+from time import time as timestamp
+from optparse import OptionParser
+from deadparrot.stats import StatsRegistry
+from deadparrot.lib import demjson
+from deadparrot.serialization import Registry
+from deadparrot.models.registry import ModelRegistry
+from deadparrot.models.managers import FileObjectsManager
+from deadparrot.models.integrity import StorageCorruptedError
+
+USAGE = """%prog <command> -m <models module> [options] [Model ...]
+
+commands:
+  verify    checks the storage files record by record
+  compact   rewrites the storage files, dropping the expired records
+  reindex   rebuilds the sidecar indexes from the storage files
+  stats     shows the records, bytes and field cardinalities
+  export    writes the records as jsonl, json or xml
+  bench     times add, get and filter on a copy of the records"""
+
+class CommandError(Exception):
+    pass
+
+def load_models(module_name, names=None):
+    """Imports the given module, returning the models declared in it,
+    optionally only those named in "names\""""
+    try:
+        __import__(module_name)
+    except ImportError, e:
+        raise CommandError('could not import %s: %s' % (module_name, e))
+
+    found = ModelRegistry.get_all(by_module=module_name)
+    if names:
+        by_name = dict([(m.__name__, m) for m in found])
+        missing = [n for n in names if n not in by_name]
+        if missing:
+            raise CommandError('%s has no model named %s' % (module_name, ", ".join(missing)))
+        found = [by_name[n] for n in names]
+
+    return sorted(found, key=lambda m: m.__name__)
+
+def verify(managers, options, out):
+    failed = False
+    for manager in managers:
+        if options.recover:
+            report = manager.recover()
+        else:
+            report = manager.verify()
+
+        out.write('%s: %d valid records, %d errors\n' % \
+                  (manager.model.__name__, report.valid, len(report.errors)))
+        for number, reason in report.errors:
+            out.write('  line %d: %s\n' % (number, reason))
+
+        if not report.ok and not options.recover:
+            failed = True
+
+    return failed and 1 or 0
+
+def compact(managers, options, out):
+    for manager in managers:
+        before, after = manager.compact()
+        out.write('%s: %d records, %d dropped\n' % \
+                  (manager.model.__name__, after, before - after))
+    return 0
+
+def reindex(managers, options, out):
+    for manager in managers:
+        out.write('%s: %d records indexed\n' % \
+                  (manager.model.__name__, manager.reindex()))
+    return 0
+
+class DistinctCounter(object):
+    """Estimates how many distinct values were added to it, keeping
+    only the "size" smallest hashes of them (the k minimum values
+    estimator), so the memory it takes is bounded. Up to "size"
+    distinct values the count is exact"""
+
+    def __init__(self, size=1024):
+        self.size = size
+        # the smallest hashes, negated for heapq to keep the largest
+        # of them first
+        self._heap = []
+        self._hashes = set()
+
+    def add(self, value):
+        digest = hashlib.md5(demjson.encode(value).encode('utf-8')).hexdigest()
+        h = long(digest[:16], 16)
+        if h in self._hashes:
+            return
+
+        if len(self._heap) < self.size:
+            heapq.heappush(self._heap, -h)
+        elif h < -self._heap[0]:
+            self._hashes.discard(-heapq.heappushpop(self._heap, -h))
+        else:
+            return
+        self._hashes.add(h)
+
+    @property
+    def exact(self):
+        return len(self._heap) < self.size
+
+    def count(self):
+        if self.exact:
+            return len(self._heap)
+        # the hashes are spread evenly over [0, 2 ** 64)
+        return int((self.size - 1) * (2 ** 64) / float(-self._heap[0]))
+
+def stats(managers, options, out):
+    for manager in managers:
+        model = manager.model
+        names = sorted(model._meta._fields.keys())
+        distinct = dict([(name, DistinctCounter()) for name in names])
+        count = 0
+        for record in manager.iterate(raw=True):
+            count += 1
+            data = record[model._meta.verbose_name]
+            for name in names:
+                distinct[name].add(data.get(name))
+
+        size = 0
+        if os.path.exists(manager._fullpath):
+            size = os.path.getsize(manager._fullpath)
+
+        out.write('%s: %d records, %d bytes\n' % (model.__name__, count, size))
+        for name in names:
+            counter = distinct[name]
+            about = not counter.exact and 'about ' or ''
+            out.write('  %s: %s%d distinct values\n' % (name, about, counter.count()))
+    return 0
+
+def export(managers, options, out):
+    if options.format not in ('jsonl', 'json', 'xml'):
+        raise CommandError('unknown export format %r, use jsonl, json or xml' % options.format)
+
+    if options.format != 'jsonl' and len(managers) != 1:
+        raise CommandError('the %s format exports a single model at a time' % options.format)
+
+    if options.output:
+        out = open(options.output, 'w')
+
+    try:
+        for manager in managers:
+            export_model(manager, options.format, out)
+    finally:
+        if options.output:
+            out.close()
+    return 0
+
+def export_model(manager, format, out):
+    verbose_name = manager.model._meta.verbose_name
+    plural = manager.model._meta.verbose_name_plural
+    if format == 'xml':
+        serializer = Registry.get('xml')
+        out.write('<%s>' % plural)
+    elif format == 'json':
+        out.write('{%s:[' % demjson.encode(plural).encode('utf-8'))
+
+    first = True
+    for record in manager.iterate(raw=True):
+        # drops the storage metadata, like checksums and expiration
+        record = {verbose_name: record[verbose_name]}
+        if format == 'xml':
+            out.write(serializer(record).serialize())
+        else:
+            if format == 'json' and not first:
+                out.write(',')
+            out.write(demjson.encode(record).encode('utf-8'))
+            if format == 'jsonl':
+                out.write('\n')
+        first = False
+
+    if format == 'xml':
+        out.write('</%s>\n' % plural)
+    elif format == 'json':
+        out.write(']}\n')
+
+def bench(managers, options, out):
+    for manager in managers:
+        model = manager.model
+        samples = []
+        for instance in manager.iterate():
+            samples.append(instance)
+            if len(samples) == options.number:
+                break
+
+        if not samples:
+            out.write('%s: no records to benchmark with\n' % model.__name__)
+            continue
+
+        fields = model._meta._fields
+        keys = [k for k, f in fields.items() if f.primary_key] or fields.keys()
+        first_field = sorted(fields.keys())[0]
+
+        path = tempfile.mkdtemp(prefix='deadparrot-bench-')
+        try:
+            scratch = FileObjectsManager(model, path)
+            # keeps the benchmark out of the in-process stats
+            scratch.stats_registry = StatsRegistry()
+            timings = (
+                ('add', lambda s: scratch.add(s)),
+                ('get', lambda s: scratch.get(**dict([(k, getattr(s, k)) for k in keys]))),
+                ('filter', lambda s: scratch.filter(**{first_field: getattr(s, first_field)})),
+            )
+            for name, operation in timings:
+                started = timestamp()
+                for sample in samples:
+                    operation(sample)
+                elapsed = timestamp() - started
+                out.write('%s.%s: %d ops in %.3fs (%.1f ops/s)\n' % \
+                          (model.__name__, name, len(samples), elapsed,
+                           len(samples) / (elapsed or 1e-9)))
+        finally:
+            shutil.rmtree(path)
+    return 0
+
+COMMANDS = {
+    'verify': verify,
+    'compact': compact,
+    'reindex': reindex,
+    'stats': stats,
+    'export': export,
+    'bench': bench,
+}
+
+def get_parser():
+    parser = OptionParser(usage=USAGE)
+    parser.add_option('-p', '--base-path', dest='base_path', default='.',
+                      help='the directory holding the storage files [default: %default]')
+    parser.add_option('-m', '--models', dest='models',
+                      help='the python module declaring the models')
+    parser.add_option('--recover', dest='recover', action='store_true', default=False,
+                      help='verify: rewrite the damaged files keeping their valid records')
+    parser.add_option('-f', '--format', dest='format', default='jsonl',
+                      help='export: jsonl, json or xml [default: %default]')
+    parser.add_option('-o', '--output', dest='output',
+                      help='export: the file to write to [default: stdout]')
+    parser.add_option('-n', '--number', dest='number', type='int', default=100,
+                      help='bench: how many stored records to benchmark with [default: %default]')
+    return parser
+
+def main(argv=None, out=sys.stdout):
+    parser = get_parser()
+    options, args = parser.parse_args(argv)
+
+    if not args or args[0] not in COMMANDS:
+        parser.error('a command is required, one of: %s' % ", ".join(sorted(COMMANDS)))
+
+    if not options.models:
+        parser.error('the models module (-m) is required')
+
+    # the models module is usually found relative to where we are called
+    if os.getcwd() not in sys.path:
+        sys.path.insert(0, os.getcwd())
+
+    try:
+        models = load_models(options.models, args[1:])
+        managers = [FileObjectsManager(m, options.base_path) for m in models]
+        return COMMANDS[args[0]](managers, options, out)
+    except (CommandError, OSError, StorageCorruptedError), e:
+        sys.stderr.write('%s: error: %s\n' % (parser.get_prog_name(), e))
+        return 2
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -18,8 +18,11 @@
 # Free Software Foundation, Inc., 59 Temple Place - Suite 330,
 # Boston, MA 02111-1307, USA.
 
+from operator import attrgetter
+from collections import OrderedDict
 from deadparrot.serialization import Registry
 from deadparrot.models import managers
+from deadparrot.models import codegen
 from deadparrot.models.managers import *
 from deadparrot.models.fields import *
 
@@ -57,6 +60,18 @@ def build_metadata(klass, params):
     if not params.has_key('fields_validation_policy'):
         klass_meta.fields_validation_policy = VALIDATE_ALL
 
+    for flag in 'changelog', 'identity_map', 'checksums', 'reverse_index', 'compact', \
+                'trusted_load':
+        if not params.has_key(flag):
+            setattr(klass_meta, flag, False)
+
+    if not params.has_key('search_fields'):
+        klass_meta.search_fields = ()
+
+    for ttl_option in 'ttl_field', 'ttl_seconds':
+        if not params.has_key(ttl_option):
+            setattr(klass_meta, ttl_option, None)
+
     metaobj = klass_meta()
     if hasattr(metaobj, '_fields'):
         for k, v in metaobj._fields.items():
@@ -64,7 +79,332 @@ def build_metadata(klass, params):
 
     return metaobj
 
+class RelatedReference(object):
+    """Stands for a reference=True relationship in the model class.
+
+    Records keep only the primary keys of the related objects, which
+    are resolved through the "objects" manager of the related model on
+    the first access. The resolved value is then set in the instance,
+    taking precedence over this (non-data) descriptor."""
+
+    def __init__(self, name, relationship):
+        self.name = name
+        self.relationship = relationship
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return None
+
+        pending = pending_references(instance)
+        if self.name in pending:
+            value = self.resolve(pending[self.name])
+        elif isinstance(self.relationship, ManyToManyField):
+            value = ModelSetManager(self.relationship.to_model)
+        else:
+            return None
+
+        if value is not None:
+            set_resolved(instance, self.relationship, self.name, value)
+        return value
+
+    def get_manager(self):
+        to_model = self.relationship.to_model
+        manager = getattr(to_model, 'objects', None)
+        if not hasattr(manager, 'in_bulk'):
+            raise TypeError('%s has no "objects" manager to resolve the '
+                            'references of %s.%s' % (to_model.__name__,
+                                                     self.relationship.from_model.__name__,
+                                                     self.name))
+        return manager
+
+    def resolve(self, pks):
+        """Returns the related instance (or a ModelSetManager, for many
+        to many relationships) for the given primary keys, None when a
+        foreign key points to a missing object"""
+        if isinstance(self.relationship, ManyToManyField):
+            found = self.get_manager().in_bulk(pks)
+        else:
+            found = self.get_manager().in_bulk([pks])
+        return self.build(pks, found)
+
+    def build(self, pks, found):
+        """Same as resolve(), picking the related instances from a dict
+        returned by in_bulk()"""
+        if not isinstance(self.relationship, ManyToManyField):
+            return found.get(pk_key(pks))
+
+        msmanager = ModelSetManager(self.relationship.to_model)
+        for pk in pks:
+            instance = found.get(pk_key(pk))
+            if instance is not None:
+                msmanager.add(instance)
+        return msmanager
+
+class ReverseRelation(object):
+    """Set in the related model of every relationship, as
+    <model name>_set (e.g. customer.order_set), returning the stored
+    objects of the model pointing to the instance"""
+
+    def __init__(self, from_model):
+        self.from_model = from_model
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+
+        manager = getattr(self.from_model, 'objects', None)
+        if not hasattr(manager, 'referrers'):
+            raise TypeError('%s has no "objects" manager to look for the '
+                            'objects pointing to %r' % (self.from_model.__name__, instance))
+        return manager.referrers(instance)
+
+def pending_references(instance):
+    """Returns the {relationship name: primary keys} dict of the
+    references of an instance that were not resolved yet"""
+    # compact instances have no __dict__, nor references
+    return getattr(instance, '__dict__', {}).get('_references', {})
+
+def set_resolved(instance, relationship, name, value):
+    """Keeps a reference resolved from the storage in the instance,
+    which is not a change of it, see Model.changed_fields"""
+    if not isinstance(relationship, ManyToManyField):
+        setattr(value, '_from_model', relationship.from_model)
+        setattr(value, '_to_model', relationship.to_model)
+
+    pending_references(instance).pop(name, None)
+    instance.__dict__[name] = value
+
+def pk_key(pk):
+    """Returns a hashable key for a {primary key name: value} dict"""
+    return tuple(sorted(pk.items()))
+
+def values_getter(names):
+    """Returns a callable taking a model instance, which returns the
+    tuple of its values for the given attribute names"""
+    if not names:
+        return lambda instance: ()
+    if len(names) == 1:
+        # attrgetter gives the value itself for a single name
+        getter = attrgetter(names[0])
+        return lambda instance: (getter(instance), )
+    return attrgetter(*names)
+
+def instance_key(instance):
+    """Returns a hashable key for a model instance: its primary key
+    values, or its identity when it has no primary key (or does not
+    have it set yet)"""
+    meta = instance._meta
+    if meta.has_pk:
+        key = meta._pk_values(instance)
+        if key.count(None) != len(key):
+            return key
+    return id(instance)
+
+def pk_dict(instance):
+    """Returns the {primary key name: value} dict of a model instance,
+    with the values as they get stored"""
+    fields = instance._meta._fields
+    return dict([(k, f.serialize(getattr(instance, k))) \
+                 for k, f in fields.items() if f.primary_key])
+
+class JoinTableRelation(object):
+    """Stands for a ManyToManyField declared with join_table=True in
+    the model class, giving each instance a JoinTableSetManager bound
+    to the join table kept by the "objects" manager of the model"""
+
+    def __init__(self, name, relationship):
+        self.name = name
+        self.relationship = relationship
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return None
+
+        manager = getattr(owner, 'objects', None)
+        tables = getattr(manager, '_join_tables', {})
+        if self.name not in tables:
+            raise TypeError('%s has no "objects" manager keeping the join '
+                            'table of %s' % (owner.__name__, self.name))
+
+        value = JoinTableSetManager(self.relationship.to_model,
+                                    tables[self.name], pk_dict(instance))
+        instance.__dict__[self.name] = value
+        return value
+
+def _new_state(instance):
+    """Sets the (per instance) names of the fields and relationships
+    changed since the instance was loaded or stored, and the cache of
+    the serialized values of its fields"""
+    object.__setattr__(instance, '_changed', set())
+    object.__setattr__(instance, '_serialized', {})
+
+def _touch(instance, name):
+    """Records that a field or relationship of the instance changed"""
+    try:
+        instance._changed.add(name)
+        instance._serialized.pop(name, None)
+    except AttributeError:
+        # an __init__ written by hand that did not call Model.__init__
+        _new_state(instance)
+        instance._changed.add(name)
+
+def _field_setter(name, field, validate, track=True):
+    """Returns the callable Model.__setattr__ uses to validate and
+    convert the values assigned to a field"""
+    def setter(instance, val):
+        if validate:
+            # raising the field-specific exceptions
+            try:
+                field.validate(val)
+            except FieldValidationError, e:
+                raise FieldValidationError(
+                    'On field %r: got %r should be a %r' % (
+                        name,
+                        val,
+                        field.vartype
+                    )
+                )
+
+        val = field.convert_type(val)
+        if track:
+            _touch(instance, name)
+        return val
+
+    return setter
+
+def _relationship_setter(name, relationship):
+    """Returns the callable Model.__setattr__ uses to check the values
+    assigned to a relationship"""
+    to_model = relationship.to_model
+    if isinstance(relationship, ManyToManyField):
+        def setter(instance, val):
+            if not isinstance(val, (list, ModelSetManager)):
+                raise TypeError('%r is not a %s list or ModelSetManager, it is actually a %r' % (val, to_model.__name__, type(val)))
+            pending_references(instance).pop(name, None)
+            _touch(instance, name)
+            return val
+    else:
+        from_model = relationship.from_model
+        def setter(instance, val):
+            if not isinstance(val, to_model):
+                raise TypeError('%r is not a %s instance, it is actually a %r' % (val, to_model.__name__, type(val)))
+            setattr(val, '_from_model', from_model)
+            setattr(val, '_to_model', to_model)
+            pending_references(instance).pop(name, None)
+            _touch(instance, name)
+            return val
+
+    return setter
+
+def _init_relationship(instance, name, value):
+    """Sets a relationship given to the constructor, where many to
+    many relationships can be given as lists"""
+    if isinstance(value, list):
+        if len(value) == 0:
+            return
+
+        klass = instance._meta._relationships[name].model
+        if not all([isinstance(x, klass) for x in value]):
+            raise TypeError('Got non %r objects in attribute %r models on %r' % (klass, name, instance))
+
+        msmanager = ModelSetManager(klass)
+        for model_object in value:
+            msmanager.add(model_object)
+        value = msmanager
+
+    setattr(instance, name, value)
+
+def _load_relationship(instance, name, value):
+    """Sets a relationship read by from_dict"""
+    rship = instance._meta._relationships[name]
+    will_model = rship.to_model
+    if rship.reference and rship.is_reference(value):
+        # resolved by RelatedReference when accessed
+        instance.__dict__.setdefault('_references', {})[name] = value
+    elif isinstance(rship, ManyToManyField):
+        msetmanager = ModelSetManager(will_model)
+        if isinstance(value, list):
+            for related in [will_model.from_dict(d) for d in value]:
+                msetmanager.add(related)
+            setattr(instance, name, msetmanager)
+        else:
+            setattr(instance, name, msetmanager.from_dict(value))
+    else:
+        setattr(instance, name, will_model.from_dict(value))
+
+def _generate_methods(cls):
+    """Sets the generated __init__ and _load_from_dict of a model
+    class, see deadparrot.models.codegen"""
+    meta = cls._meta
+    fields = sorted(meta._fields)
+    relationships = [(k, isinstance(meta._relationships[k], ManyToManyField)) \
+                     for k in sorted(meta._relationships)]
+
+    namespace = {
+        'setters': cls._setters,
+        'set_attr': object.__setattr__,
+        'ModelSetManager': ModelSetManager,
+        'init_relationship': _init_relationship,
+        'load_relationship': _load_relationship,
+    }
+    for index, name in enumerate(fields):
+        namespace['setter_%d' % index] = cls._setters[name]
+    for index, (name, many) in enumerate(relationships):
+        namespace['to_model_%d' % index] = meta._relationships[name].to_model
+
+    # a __setattr__ of the model itself is always called
+    fast = cls.__setattr__.im_func is Model.__setattr__.im_func
+
+    # keeping an __init__ written by hand, here or in a base class
+    for klass in cls.__mro__:
+        if '__init__' in vars(klass):
+            break
+    init = vars(klass)['__init__']
+    if klass is Model or getattr(init, '__deadparrot_generated__', False):
+        source = codegen.init_source(fields, relationships, meta.compact, fast)
+        cls.__init__ = codegen.generate(source, '__init__', namespace)
+
+    # loaded instances have nothing changed yet
+    validate = meta.fields_validation_policy != VALIDATE_NONE
+    source = codegen.loader_source(fields, relationships, fast)
+    for index, name in enumerate(fields):
+        namespace['setter_%d' % index] = _field_setter(name, meta._fields[name], validate, False)
+    cls._load_from_dict = classmethod(codegen.generate(source, '_load_from_dict', namespace))
+
+    # the same, for records known to be valid, only converting them
+    trusted_setters = dict(cls._setters)
+    for index, name in enumerate(fields):
+        namespace['setter_%d' % index] = _field_setter(name, meta._fields[name], False, False)
+        trusted_setters[name] = _field_setter(name, meta._fields[name], False)
+    namespace['trusted_setters'] = trusted_setters
+    namespace['del_attr'] = object.__delattr__
+
+    # compact instances have no room for the trusted setters, models
+    # with their own __setattr__ get them validated anyway
+    source = codegen.loader_source(fields, relationships, fast, not meta.compact)
+    cls._load_trusted = classmethod(codegen.generate(source, '_load_from_dict', namespace))
+
 class ModelMeta(type):
+    def __new__(mcs, name, bases, attrs):
+        meta = attrs.get('Meta')
+        if name in ('ModelMeta', 'Model') or not getattr(meta, 'compact', False):
+            return super(ModelMeta, mcs).__new__(mcs, name, bases, attrs)
+
+        # Meta.compact = True: the instances keep their values in slots,
+        # one per field and relationship, instead of a __dict__
+        declared = dict([(k, v) for k, v in attrs.items() \
+                         if isinstance(v, (Field, RelationShip))])
+        for k in declared:
+            del attrs[k]
+
+        attrs['__slots__'] = tuple(sorted(declared)) + \
+                             ('_from_model', '_to_model', '_changed', '_serialized', '__weakref__')
+        cls = super(ModelMeta, mcs).__new__(mcs, name, bases, attrs)
+
+        # __init__ gets this same dict, and looks for the fields in it
+        attrs.update(declared)
+        return cls
+
     def __init__(cls, name, bases, attrs):
         if name not in ('ModelMeta', 'Model'):
             metadata_params = hasattr(cls, 'Meta') and \
@@ -103,6 +443,7 @@ class ModelMeta(type):
             metadata_params['_relationships'] = relationships
             metadata_params['_relationships_plural'] = relationships_plural
             metadata_params['has_pk'] = False
+            metadata_params['_pk_names'] = sorted([k for k, v in fields.items() if v.primary_key])
 
             cls._meta = build_metadata(cls, metadata_params)
             cls._data = {}
@@ -113,7 +454,16 @@ class ModelMeta(type):
                 if v.primary_key:
                     cls._meta.has_pk = True
 
-                setattr(cls, k, None)
+                # the slots of compact models are left as they are
+                if not cls._meta.compact:
+                    setattr(cls, k, None)
+
+            # what instances are told apart by, see Model.__eq__ and
+            # Model.pk: the primary key fields, or all of them
+            cls._meta._pk_values = values_getter(cls._meta._pk_names or sorted(fields.keys()))
+            cls._meta._pk_getter = None
+            if cls._meta._pk_names:
+                cls._meta._pk_getter = attrgetter(*cls._meta._pk_names)
 
             for k, v in relationships.items():
                 if v.is_lazy:
@@ -129,11 +479,46 @@ class ModelMeta(type):
 
                 cls._data[k] = v
                 v.set_from_model(cls)
-                if isinstance(v, ManyToManyField):
+                if cls._meta.compact:
+                    if v.reference or getattr(v, 'join_table', False):
+                        raise InvalidRelationShipError, \
+                              "%s.%s: compact models can not have relationships " \
+                              "declared with reference=True or join_table=True" % (name, k)
+                elif getattr(v, 'join_table', False):
+                    if not cls._meta.has_pk:
+                        raise InvalidRelationShipError, \
+                              "A model need to have at least one " \
+                              "primary_key for using a join_table"
+                    setattr(cls, k, JoinTableRelation(k, v))
+                elif v.reference:
+                    setattr(cls, k, RelatedReference(k, v))
+                elif isinstance(v, ManyToManyField):
                     setattr(cls, k, ModelSetManager(v.to_model))
                 else:
                     setattr(cls, k, None)
 
+            # what Model.__setattr__ calls for each field and relationship,
+            # so that an assignment costs a single dict lookup
+            validate = cls._meta.fields_validation_policy != VALIDATE_NONE
+            cls._setters = {}
+            for k, v in fields.items():
+                cls._setters[k] = _field_setter(k, v, validate)
+            for k, v in relationships.items():
+                cls._setters[k] = _relationship_setter(k, v)
+
+            _generate_methods(cls)
+
+            for target in set([v.to_model for v in relationships.values()]):
+                accessor = '%s_set' % name.lower()
+                current = getattr(target, accessor, None)
+                if accessor in target._data or \
+                   current is not None and not isinstance(current, ReverseRelation):
+                    raise InvalidRelationShipError, \
+                          "%s.%s clashes with the reverse accessor of the " \
+                          "relationships from %s" % (target.__name__, accessor, name)
+
+                setattr(target, accessor, ReverseRelation(cls))
+
             # handling managers
             manager_classes = dict([(k, v) for k, v in attrs.items() \
                                     if isinstance(v, tuple) and \
@@ -157,6 +542,8 @@ class ModelSet(object):
                        self.__model_class__.__name__,
                        type(i))
         self.items = list(items)
+        # derived indexes, built on demand and dropped on every change
+        self._indexes = {}
 
     def __eq__(self, other):
         return self.items == other
@@ -166,10 +553,12 @@ class ModelSet(object):
     def __getitem__(self, *a, **kw):
         return self.items.__getitem__(*a, **kw)
     def __setitem__(self, *a, **kw):
+        self._indexes.clear()
         return self.items.__setitem__(*a, **kw)
     def __getslice__(self, *a, **kw):
         return self.items.__getslice__(*a, **kw)
     def __setslice__(self, *a, **kw):
+        self._indexes.clear()
         return self.items.__setslice__(*a, **kw)
     def __nonzero__(self):
         return bool(self.items)
@@ -186,6 +575,7 @@ class ModelSet(object):
                             (self.__model_class__.__name__, model))
 
         self.items.append(model)
+        self._indexes.clear()
 
     def remove(self, model):
         if not isinstance(model, self.__model_class__):
@@ -193,7 +583,129 @@ class ModelSet(object):
                             'as parameter, got %r' % \
                             (self.__model_class__.__name__, model))
 
+        key = self._key(model)
+        if isinstance(key, tuple) and key not in self._keyed():
+            # nothing to compare the items with
+            raise ValueError('%r not in %r' % (model, self))
+
         self.items.remove(model)
+        self._indexes.clear()
+
+    def _key(self, model):
+        """The primary key values of a model, or its identity when it
+        has none"""
+        return instance_key(model)
+
+    def _keyed(self):
+        """Returns an {self._key(item): item} dict, the first item
+        winning when many have the same key"""
+        if 'keys' not in self._indexes:
+            keyed = {}
+            for item in self.items:
+                keyed.setdefault(self._key(item), item)
+            self._indexes['keys'] = keyed
+        return self._indexes['keys']
+
+    def __contains__(self, value):
+        """Takes either a model instance or its primary key value (a
+        tuple of them, ordered by field name, for composite keys)"""
+        if isinstance(value, self.__model_class__):
+            key = self._key(value)
+            if not isinstance(key, tuple):
+                # no primary key to look for, compared field by field
+                return value in self.items
+            return key in self._keyed()
+
+        if not isinstance(value, tuple):
+            value = (value, )
+        return value in self._keyed()
+
+    def index_by(self, name):
+        """Returns a {field value: item} dict, which is cached until the
+        set changes, so it should not be modified"""
+        key = ('index', name)
+        if key not in self._indexes:
+            self._check_field(name)
+            index = {}
+            for item in self.items:
+                index.setdefault(getattr(item, name), item)
+            self._indexes[key] = index
+        return self._indexes[key]
+
+    def group_by(self, name):
+        """Returns a {field value: set of the items having it} dict,
+        cached the same way as index_by"""
+        key = ('group', name)
+        if key not in self._indexes:
+            self._check_field(name)
+            groups = {}
+            for item in self.items:
+                groups.setdefault(getattr(item, name), []).append(item)
+            self._indexes[key] = dict([(k, self.__class__(*v)) for k, v in groups.items()])
+        return self._indexes[key]
+
+    def _check_field(self, name):
+        meta = self.__model_class__._meta
+        if name not in meta._fields and name not in meta._relationships:
+            raise TypeError('%s is not a valid field in %r' % (name, self.__model_class__))
+
+    def _check_other(self, other, method):
+        if not isinstance(other, ModelSet) or other.__model_class__ is not self.__model_class__:
+            raise TypeError('%s() takes a %s.Set, got %r' % \
+                            (method, self.__model_class__.__name__, other))
+
+    def union(self, other):
+        """Returns a new set with the items of both, by primary key"""
+        self._check_other(other, 'union')
+        keyed = self._keyed()
+        return self.__class__(*(self.items + [i for i in other.items if self._key(i) not in keyed]))
+
+    def intersection(self, other):
+        self._check_other(other, 'intersection')
+        keyed = other._keyed()
+        return self.__class__(*[i for i in self.items if self._key(i) in keyed])
+
+    def difference(self, other):
+        self._check_other(other, 'difference')
+        keyed = other._keyed()
+        return self.__class__(*[i for i in self.items if self._key(i) not in keyed])
+
+    def prefetch_related(self, *names):
+        """Resolves the given reference=True relationships of all the
+        items at once, with a single in_bulk() call per relationship,
+        instead of one lookup per item. Returns the set itself"""
+        relationships = self.__model_class__._meta._relationships
+        for name in names:
+            if name not in relationships:
+                raise TypeError('%s has no relationship named %r' % \
+                                (self.__model_class__.__name__, name))
+
+        for name in names:
+            reference = RelatedReference(name, relationships[name])
+            pending = []
+            wanted = []
+            for item in self.items:
+                pks = pending_references(item).get(name)
+                if pks is None:
+                    # embedded, or already resolved
+                    continue
+
+                pending.append((item, pks))
+                if isinstance(pks, list):
+                    wanted.extend(pks)
+                else:
+                    wanted.append(pks)
+
+            if not pending:
+                continue
+
+            found = reference.get_manager().in_bulk(wanted)
+            for item, pks in pending:
+                value = reference.build(pks, found)
+                if value is not None:
+                    set_resolved(item, reference.relationship, name, value)
+
+        return self
 
     def to_dict(self):
         dicts = [m.to_dict() for m in self.items]
@@ -208,6 +720,17 @@ class ModelSet(object):
         items = edict[cls.__model_class__._meta.verbose_name_plural]
         return cls(*[cls.__model_class__.from_dict(i) for i in items])
 
+    def to_graph(self):
+        """Same as to_dict, but writing each related object a single
+        time, see deadparrot.models.graph"""
+        from deadparrot.models.graph import GraphWriter
+        return GraphWriter().write(list(self.items))
+
+    @classmethod
+    def from_graph(cls, graph):
+        from deadparrot.models.graph import GraphReader
+        return cls(*GraphReader(graph).read(cls.__model_class__))
+
     def serialize(self, to):
         serializer = Registry.get(to)
         return serializer(self.to_dict()).serialize()
@@ -221,31 +744,31 @@ class ModelSet(object):
 class Model(object):
     __metaclass__ = ModelMeta
     __dead_parrot__ = __module__
+    # so that the subclasses declared with Meta.compact = True have no
+    # __dict__ at all, the others get one as usual
+    __slots__ = ()
+    _setters = {}
 
     def __init__(self, **kw):
+        setters = self._setters
+        relationships = self._meta._relationships
+        _new_state(self)
+        if self._meta.compact:
+            for k in self._meta._fields:
+                object.__setattr__(self, k, None)
+            for k, v in self._meta._relationships.items():
+                if isinstance(v, ManyToManyField):
+                    object.__setattr__(self, k, ModelSetManager(v.to_model))
+                else:
+                    object.__setattr__(self, k, None)
+
         for k, v in kw.items():
-            if k not in self._meta._fields.keys() and \
-               k not in self._meta._relationships.keys():
+            if k not in setters:
                 raise AttributeError, \
             "%s has no attribute %s" % (self.__class__.__name__, k)
 
-            is_relation = k in self._meta._relationships.keys()
-            if is_relation:
-                if isinstance(v, list):
-                    if len(v) == 0:
-                        continue
-
-                    klass = self._meta._relationships[k].model
-                    if not all([isinstance(x, klass) for x in v]):
-                        raise TypeError('Got non %r objects in attribute %r models on %r' % (klass, k, self))
-
-                    msmanager = ModelSetManager(klass)
-                    for model_object in v:
-                        msmanager.add(model_object)
-
-                    setattr(self, k, msmanager)
-                else:
-                    setattr(self, k, v)
+            if k in relationships:
+                _init_relationship(self, k, v)
             else:
                 setattr(self, k, v)
 
@@ -256,42 +779,77 @@ class Model(object):
         return "<%s%s object>" % (self.__class__.__name__, pks and "(%s)" % pks or "")
 
     def _get_data(self):
-        fields = []
+        # the serialized values of the fields are kept until they change
+        try:
+            serialized = self._serialized
+        except AttributeError:
+            _new_state(self)
+            serialized = self._serialized
+
+        fields = self._meta._fields
+        if len(serialized) != len(fields):
+            for k, field in fields.items():
+                if k not in serialized:
+                    value = getattr(self, k)
+                    if value is not None:
+                        value = field.serialize(value)
+                    serialized[k] = value
+
+        data = dict([(k, v) for k, v in serialized.items() if v is not None])
+
+        # references not resolved yet are stored back as they were read
+        pending = pending_references(self)
+        for k, relationship in self._meta._relationships.items():
+            if k in pending:
+                data[k] = pending[k]
+                continue
+
+            # stored apart, in the join table
+            if getattr(relationship, 'join_table', False):
+                continue
 
-        for k in self._data.keys():
             value = getattr(self, k)
-            field = None
-            is_relation = None
-            for x in '_fields', '_relationships':
-                is_relation = x == '_relationships'
-                if field is None:
-                    fdict = getattr(self._meta, x)
-                    field = fdict.get(k, None)
+            if value is not None:
+                data[k] = relationship.serialize(value)
 
-            if not is_relation or value is not None:
-                tup = (k, field.serialize(value))
-                fields.append(tup)
-
-        return dict(fields)
+        return data
 
     def to_dict(self):
         return {self._meta.verbose_name: self._get_data()}
 
+    def changed_fields(self):
+        """Returns the names of the fields and relationships set since
+        the instance was loaded or stored"""
+        return sorted(getattr(self, '_changed', ()))
+
+    def _clear_changes(self):
+        object.__setattr__(self, '_changed', set())
+
     def __eq__(self, other):
         if not isinstance(other, self.__class__):
             raise TypeError, "%s can be compared only with %s or its subclasses instances." \
                   " Got %r" % (self.__class__.__name__, self.__class__.__name__, other)
 
-        # ok, "other" is the same type than self, gonna iterate through its attributes and compare them
-        if not self._meta.has_pk:
-            mine = [getattr(self, field_name) for field_name in self._meta._fields.keys()]
-            from_other = [getattr(other, field_name) for field_name in self._meta._fields.keys()]
-        # unless "self" has at least one primary_key, only pk values will be used
-        else:
-            mine = [getattr(self, field_name) for field_name, field in self._meta._fields.items() if field.primary_key]
-            from_other = [getattr(other, field_name) for field_name, field in self._meta._fields.items() if field.primary_key]
+        # the primary key values are compared, or all the field values
+        # when "self" has no primary_key
+        values = self._meta._pk_values
+        return values(self) == values(other)
 
-        return mine == from_other
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self._meta._pk_values(self))
+
+    @property
+    def pk(self):
+        """The value of the primary key field, a tuple of them (ordered
+        by field name) for composite keys, or None when the model has
+        no primary_key"""
+        getter = self._meta._pk_getter
+        if getter is None:
+            return None
+        return getter(self)
 
     @property
     def _is_valid(self):
@@ -300,82 +858,72 @@ class Model(object):
         return None not in [getattr(self, k) for k in non_blank_fields]
 
     def __setattr__(self, attr, val):
-        if attr in self._data.keys():
-            if attr in self._meta._fields.keys():
-                field = self._meta._fields[attr]
-            elif attr in self._meta._relationships.keys():
-                field = self._meta._relationships[attr]
-
-
-                if not isinstance(val, field.to_model) and not isinstance(field, ManyToManyField):
-                    raise TypeError('%r is not a %s instance, it is actually a %r' % (val, field.to_model.__name__, type(val)))
-                elif isinstance(field, ManyToManyField):
-                    if not isinstance(val, (list, ModelSetManager)):
-                        raise TypeError('%r is not a %s list or ModelSetManager, it is actually a %r' % (val, field.to_model.__name__, type(val)))
-                else:
-                    setattr(val, '_from_model', field.from_model)
-                    setattr(val, '_to_model', field.to_model)
-
-            if isinstance(field, Field):
-                if self._meta.fields_validation_policy != VALIDATE_NONE:
-                    # raising the field-specific exceptions
-                    try:
-                        field.validate(val)
-                    except FieldValidationError, e:
-                        raise FieldValidationError(
-                            'On field %r: got %r should be a %r' % (
-                                attr,
-                                val,
-                                field.vartype
-                            )
-                        )
-                val = field.convert_type(val)
-            self._data[attr] = val
+        setter = self._setters.get(attr)
+        if setter is not None:
+            val = setter(self, val)
 
         super(Model, self).__setattr__(attr, val)
 
     @classmethod
-    def from_dict(cls, data_dict):
+    def from_dict(cls, data_dict, trusted=False):
+        """Builds an instance from a {verbose_name: {... data ...}}
+        dict. When trusted is True the values are converted but not
+        validated, for records that were validated when written"""
         if not isinstance(data_dict, dict):
             raise TypeError, "%s.from_dict takes a dict as parameter. " \
                   "Got %r:%r" % (cls.__name__,
                                  type(data_dict),
                                  data_dict)
-        try:
-            d = data_dict[cls._meta.verbose_name].copy()
-        except KeyError:
+        if not isinstance(data_dict.get(cls._meta.verbose_name), dict):
             raise TypeError, "%s.from_dict got an mismatched dict structure." \
                   "Expected {'%s': {... data ...}} like structure, got %s" % (cls,
                                                                               cls._meta.verbose_name,
                                                                               unicode(data_dict))
-        keys = cls._meta._fields.keys()
-        rel_keys = cls._meta._relationships.keys()
+        if trusted:
+            return cls._load_trusted(data_dict[cls._meta.verbose_name])
+        return cls._load_from_dict(data_dict[cls._meta.verbose_name])
+
+    @classmethod
+    def _load_from_dict(cls, data):
+        """Builds an instance from the {field name: value} dict of a
+        record, replaced in each model class by one generated for its
+        fields, see deadparrot.models.codegen"""
         obj = cls()
-        for k, v in d.items():
-            if k in keys:
+        for k, v in data.items():
+            if k in cls._meta._fields:
                 setattr(obj, k, v)
-
-            if k in rel_keys:
-                rship = cls._meta._relationships[k]
-                will_model = rship.to_model
-                if isinstance(rship, ManyToManyField):
-                    msetmanager = ModelSetManager(will_model)
-                    if isinstance(v, list):
-                        for instance in [will_model.from_dict(d) for d in v]:
-                            msetmanager.add(instance)
-                        setattr(obj, k, msetmanager)
-                    else:
-                        setattr(obj, k, msetmanager.from_dict(v))
-                else:
-                    setattr(obj, k, will_model.from_dict(v))
+            elif k in cls._meta._relationships:
+                _load_relationship(obj, k, v)
 
         return obj
 
+    _load_trusted = _load_from_dict
+
     @classmethod
     def Set(cls):
         klass = type('%sSet' % cls.__name__, (ModelSet, ), {'__model_class__': cls })
         return klass
 
+    @classmethod
+    def ColumnarSet(cls):
+        from deadparrot.models.columnar import ColumnarModelSet
+        klass = type('%sColumnarSet' % cls.__name__, (ColumnarModelSet, ), {'__model_class__': cls })
+        return klass
+
+    def to_graph(self):
+        """Same as to_dict, but writing each related object a single
+        time, even when it is shared or part of a cycle, see
+        deadparrot.models.graph"""
+        from deadparrot.models.graph import GraphWriter
+        return GraphWriter().write(self)
+
+    @classmethod
+    def from_graph(cls, graph):
+        """Rebuilds the instance written by to_graph, where the objects
+        that were shared are shared again"""
+        from deadparrot.models.graph import GraphReader
+        return GraphReader(graph).read(cls)
+
     def serialize(self, to):
         serializer = Registry.get(to)
         return serializer(self.to_dict()).serialize()
@@ -407,35 +955,51 @@ class Model(object):
 
         return cls(**kwargs)
 
+class ObjectList(list):
+    """The list ModelSetManager.objects returns. It is a copy of the
+    related objects, so changing it would change nothing: it raises
+    TypeError instead"""
+
+    def _read_only(self, *args, **kw):
+        raise TypeError('ModelSetManager.objects can not be changed, '
+                        'use the add() and remove() of the manager')
+
+    append = extend = insert = remove = pop = sort = reverse = _read_only
+    __setitem__ = __delitem__ = __setslice__ = __delslice__ = _read_only
+    __iadd__ = __imul__ = _read_only
+
 class ModelSetManager(object):
+    """The related objects of a ManyToManyField, kept in the order they
+    were added, keyed by their primary key values (or by identity, for
+    models without primary keys or not having them set yet), so that
+    adding, removing and looking for an object takes constant time"""
     model = None
-    objects = None
 
     def __init__(self, model):
         if not isinstance(model, type) or not issubclass(model, Model):
             raise TypeError, 'ModelSetManager takes a models.Model subclass as construction parameter, got %r' % model
         self.model = model
-        self.objects = []
-        self.hashes = []
+        self._objects = OrderedDict()
 
     def __repr__(self):
         return '<ModelSetManager for %s object>' % self.model.__name__
 
+    @property
+    def objects(self):
+        """A copy of the related objects, in the order they were added,
+        which can not be changed: use add() and remove() instead"""
+        return ObjectList(self._objects.values())
+
+    def key_for(self, instance):
+        return instance_key(instance)
+
     def add(self, instance):
         if not isinstance(instance, self.model):
             raise TypeError, 'ModelSetManager.add takes a instance of %r ' \
                              'as parameter, got %r' % (self.model, instance)
 
-        object_hash = hash(instance)
-
-        try:
-            index = self.hashes.index(object_hash)
-            self.objects[index] = instance
-            self.hashes[index] = object_hash
-
-        except ValueError:
-            self.objects.append(instance)
-            self.hashes.append(object_hash)
+        # an object already there is replaced, keeping its position
+        self._objects[self.key_for(instance)] = instance
 
     def remove(self, instance):
         if not isinstance(instance, self.model):
@@ -443,13 +1007,49 @@ class ModelSetManager(object):
                              'as parameter, got %r' % (self.model, instance)
 
         try:
-            object_hash = hash(instance)
-            index = self.hashes.index(object_hash)
-            del self.objects[index]
-            del self.hashes[index]
-        except (ValueError, IndexError):
+            del self._objects[self.key_for(instance)]
+        except KeyError:
             raise ValueError('%r not in %r' % (instance, self))
 
+    def __contains__(self, instance):
+        return isinstance(instance, self.model) and \
+               self.key_for(instance) in self._objects
+
+    def __len__(self):
+        return len(self._objects)
+
+    def __nonzero__(self):
+        # true even when empty, as it always was, and not by its len()
+        return True
+
+    def __iter__(self):
+        return iter(self._objects.values())
+
+    def _check_other(self, other, operator):
+        if not isinstance(other, ModelSetManager) or other.model is not self.model:
+            raise TypeError('unsupported operand for %s: ModelSetManager for %s and %r' % \
+                            (operator, self.model.__name__, other))
+
+    def _new(self, items):
+        ret = ModelSetManager(self.model)
+        for key, instance in items:
+            ret._objects[key] = instance
+        return ret
+
+    def __or__(self, other):
+        self._check_other(other, '|')
+        ret = self._new(self._objects.items())
+        ret._objects.update(other._objects)
+        return ret
+
+    def __and__(self, other):
+        self._check_other(other, '&')
+        return self._new([(k, v) for k, v in self._objects.items() if k in other._objects])
+
+    def __sub__(self, other):
+        self._check_other(other, '-')
+        return self._new([(k, v) for k, v in self._objects.items() if k not in other._objects])
+
     def as_modelset(self):
         SetClass = self.model.Set()
         return SetClass(*self.objects)
@@ -464,3 +1064,60 @@ class ModelSetManager(object):
             self.add(item)
 
         return self
+
+class JoinTableSetManager(ModelSetManager):
+    """The ModelSetManager of a ManyToManyField declared with
+    join_table=True. The related objects are loaded on the first access
+    to them, while add() and remove() go straight to the join table, so
+    adding an object appends a single pair to it."""
+
+    def __init__(self, model, table, owner_pk):
+        self.model = model
+        self.table = table
+        self.owner_pk = owner_pk
+        self._loaded = None
+
+    def __repr__(self):
+        return '<JoinTableSetManager for %s object>' % self.model.__name__
+
+    def _load(self):
+        if self._loaded is None:
+            manager = getattr(self.model, 'objects', None)
+            if not hasattr(manager, 'in_bulk'):
+                raise TypeError('%s has no "objects" manager to load the '
+                                'join table objects from' % self.model.__name__)
+
+            pks = self.table.related(self.owner_pk)
+            found = manager.in_bulk(pks)
+            loaded = ModelSetManager(self.model)
+            for pk in pks:
+                instance = found.get(pk_key(pk))
+                if instance is not None:
+                    loaded.add(instance)
+            self._loaded = loaded
+
+        return self._loaded
+
+    @property
+    def _objects(self):
+        return self._load()._objects
+
+    def add(self, instance):
+        if not isinstance(instance, self.model):
+            raise TypeError, 'ModelSetManager.add takes a instance of %r ' \
+                             'as parameter, got %r' % (self.model, instance)
+
+        self.table.add(self.owner_pk, [pk_dict(instance)])
+        self._loaded = None
+
+    def remove(self, instance):
+        if not isinstance(instance, self.model):
+            raise TypeError, 'ModelSetManager.remove takes a instance of %r ' \
+                             'as parameter, got %r' % (self.model, instance)
+
+        pk = pk_dict(instance)
+        if pk not in self.table.related(self.owner_pk):
+            raise ValueError('%r not in %r' % (instance, self))
+
+        self.table.remove(self.owner_pk, [pk])
+        self._loaded = None
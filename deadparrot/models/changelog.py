@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# -*- coding: utf-8; -*-
+#
+# Copyright (C) 2009 Gabriel Falcão <gabriel@nacaolivre.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public
+# License along with this program; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+import os
+
+from deadparrot.lib import demjson
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+__all__ = ['Change', 'ChangeLog', 'INSERT', 'UPDATE', 'DELETE']
+
+INSERT = 'insert'
+UPDATE = 'update'
+DELETE = 'delete'
+
+class Change(object):
+    def __init__(self, version, op, pk):
+        self.version = version
+        self.op = op
+        self.pk = pk
+
+    def __repr__(self):
+        return '<Change %d %s %r>' % (self.version, self.op, self.pk)
+
+    def __eq__(self, other):
+        if not isinstance(other, Change):
+            return False
+        return (self.version, self.op, self.pk) == \
+               (other.version, other.op, other.pk)
+
+    def __ne__(self, other):
+        return not self == other
+
+class ChangeLog(object):
+    """Append-only log of the writes made to a model storage file.
+
+    Each line is "<version> <op> <json pk>", so readers can find the
+    version of a line without decoding its payload. The last seen
+    size and offset are remembered, so polling an unchanged log costs
+    a single stat() call."""
+
+    def __init__(self, path):
+        self.path = path
+        self._size = 0
+        self._offset = 0
+        self._version = 0
+
+    def _lock(self, fobj):
+        if fcntl is not None:
+            fcntl.flock(fobj.fileno(), fcntl.LOCK_EX)
+
+    def _unlock(self, fobj):
+        if fcntl is not None:
+            fcntl.flock(fobj.fileno(), fcntl.LOCK_UN)
+
+    def _stat_size(self):
+        try:
+            return os.stat(self.path).st_size
+        except OSError:
+            return 0
+
+    def _tail_version(self, fobj):
+        fobj.seek(0, 2)
+        end = fobj.tell()
+        if not end:
+            return 0
+
+        block = min(end, 4096)
+        while True:
+            fobj.seek(end - block)
+            chunk = fobj.read(block).rstrip('\n')
+            if '\n' in chunk or block == end:
+                break
+            block = min(end, block * 2)
+
+        last_line = chunk.rsplit('\n', 1)[-1]
+        return int(last_line.split(' ', 1)[0])
+
+    @property
+    def version(self):
+        size = self._stat_size()
+        if size == self._size:
+            return self._version
+        if not size:
+            return 0
+
+        fobj = open(self.path, 'rb')
+        try:
+            return self._tail_version(fobj)
+        finally:
+            fobj.close()
+
+    def append(self, op, pks):
+        fobj = open(self.path, 'a+b')
+        self._lock(fobj)
+        try:
+            version = self._tail_version(fobj)
+            lines = []
+            for pk in pks:
+                version += 1
+                lines.append('%d %s %s\n' % (version, op, demjson.encode(pk)))
+
+            fobj.seek(0, 2)
+            fobj.write("".join(lines))
+            fobj.flush()
+        finally:
+            self._unlock(fobj)
+            fobj.close()
+
+        return version
+
+    def since(self, version=0):
+        size = self._stat_size()
+        if size < self._size:
+            # the log was truncated (e.g. compacted), start over
+            self._size = self._offset = self._version = 0
+
+        if version >= self._version and size == self._size:
+            return []
+
+        fobj = open(self.path, 'rb')
+        try:
+            if version >= self._version:
+                fobj.seek(self._offset)
+
+            changes = []
+            while True:
+                line = fobj.readline()
+                if not line.endswith('\n'):
+                    # incomplete line, a writer is still appending it
+                    break
+
+                number, op, pk = line.rstrip('\n').split(' ', 2)
+                number = int(number)
+                self._offset = fobj.tell()
+                self._version = max(self._version, number)
+                if number > version:
+                    changes.append(Change(number, op, demjson.decode(pk)))
+
+            self._size = self._offset
+        finally:
+            fobj.close()
+
+        return changes
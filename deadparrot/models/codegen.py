@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding: utf-8; -*-
+#
+# Copyright (C) 2009 Gabriel Falcão <gabriel@nacaolivre.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public
+# License along with this program; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+# The __init__ and _load_from_dict of each model class are generated
+# from its fields, so that building an instance runs straight through
+# them, without looking them up one by one. For a model with the
+# fields "id" and "name", and the relationship "owner":
+#
+#   def _load_from_dict(cls, data):
+#       obj = cls()
+#       if 'id' in data:
+#           set_attr(obj, 'id', setter_0(obj, data['id']))
+#       if 'name' in data:
+#           set_attr(obj, 'name', setter_1(obj, data['name']))
+#       if 'owner' in data:
+#           load_relationship(obj, 'owner', data['owner'])
+#       set_attr(obj, '_changed', set())
+#       return obj
+#
+# The names used by the generated code (setter_<n>, set_attr, ...)
+# come from the namespace given by the model class.
+
+__all__ = ['generate', 'init_source', 'loader_source']
+
+# the code objects, by source, shared by the models alike
+_CODE = {}
+
+def generate(source, name, namespace):
+    """Returns the function called "name" defined in the given source,
+    with the given namespace as its globals"""
+    code = _CODE.get(source)
+    if code is None:
+        code = _CODE.setdefault(source, compile(source, '<deadparrot %s>' % name, 'exec'))
+
+    namespace = dict(namespace)
+    exec code in namespace
+    function = namespace[name]
+    function.__deadparrot_generated__ = True
+    return function
+
+def _assignment(target, name, index, source, fast):
+    if fast:
+        return '    set_attr(%s, %r, setter_%d(%s, %s[%r]))' % \
+               (target, name, index, target, source, name)
+    # the model has its own __setattr__, which has to see the values
+    return '    setattr(%s, %r, %s[%r])' % (target, name, source, name)
+
+def init_source(fields, relationships, compact, fast):
+    """The source of an __init__(self, **kw) for the given field names
+    and (relationship name, is many to many) tuples"""
+    lines = ['def __init__(self, **kw):',
+             "    set_attr(self, '_changed', set())",
+             "    set_attr(self, '_serialized', {})"]
+    if compact:
+        for name in fields:
+            lines.append('    set_attr(self, %r, None)' % name)
+        for index, (name, many) in enumerate(relationships):
+            if many:
+                lines.append('    set_attr(self, %r, ModelSetManager(to_model_%d))' % (name, index))
+            else:
+                lines.append('    set_attr(self, %r, None)' % name)
+
+    lines.append('    if not kw:')
+    lines.append('        return')
+    lines.append('    for k in kw:')
+    lines.append('        if k not in setters:')
+    lines.append('            raise AttributeError("%s has no attribute %s" % '
+                 '(self.__class__.__name__, k))')
+
+    for index, name in enumerate(fields):
+        lines.append('    if %r in kw:' % name)
+        lines.append('    ' + _assignment('self', name, index, 'kw', fast))
+
+    for name, many in relationships:
+        lines.append('    if %r in kw:' % name)
+        lines.append('        init_relationship(self, %r, kw[%r])' % (name, name))
+
+    return '\n'.join(lines) + '\n'
+
+def loader_source(fields, relationships, fast, trusted=False):
+    """The source of a _load_from_dict(cls, data) for the given field
+    names and (relationship name, is many to many) tuples.
+
+    When trusted is True, and the model has its own __setattr__, the
+    instance gets the trusted_setters while it is loaded, which
+    Model.__setattr__ takes before those of the class"""
+    lines = ['def _load_from_dict(cls, data):',
+             '    obj = cls()']
+
+    body = []
+    for index, name in enumerate(fields):
+        body.append('    if %r in data:' % name)
+        body.append('    ' + _assignment('obj', name, index, 'data', fast))
+
+    for name, many in relationships:
+        body.append('    if %r in data:' % name)
+        body.append('        load_relationship(obj, %r, data[%r])' % (name, name))
+
+    if trusted and not fast:
+        lines.append("    set_attr(obj, '_setters', trusted_setters)")
+        lines.append('    try:')
+        lines.extend(['    ' + line for line in body])
+        lines.append('    finally:')
+        lines.append("        del_attr(obj, '_setters')")
+    else:
+        lines.extend(body)
+
+    if relationships or not fast:
+        # set through __setattr__, which takes them as changes
+        lines.append("    set_attr(obj, '_changed', set())")
+    lines.append('    return obj')
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,468 @@
+#!/usr/bin/env python
+# -*- coding: utf-8; -*-
+#
+# Copyright (C) 2009 Gabriel Falcão <gabriel@nacaolivre.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public
+# License along with this program; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+import calendar
+import operator
+
+from array import array
+from decimal import Decimal
+
+from deadparrot.serialization import Registry
+from deadparrot.models.fields import IntegerField, FloatField, BooleanField
+from deadparrot.models.fields import DecimalField, DateTimeField, DateField, TimeField
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+__all__ = ['BitColumn', 'Column', 'ColumnarModelSet']
+
+# filter() lookups, as in filter(age__gt=30)
+OPERATORS = {
+    'exact': operator.eq,
+    'ne': operator.ne,
+    'gt': operator.gt,
+    'gte': operator.ge,
+    'lt': operator.lt,
+    'lte': operator.le,
+}
+
+class BitColumn(object):
+    """A list of booleans packed 8 per byte"""
+
+    def __init__(self, values=()):
+        self.bits = bytearray()
+        self.length = 0
+        for value in values:
+            self.append(value)
+
+    def __len__(self):
+        return self.length
+
+    def append(self, value):
+        if not self.length & 7:
+            self.bits.append(0)
+        if value:
+            self.bits[self.length >> 3] |= 1 << (self.length & 7)
+        self.length += 1
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.length
+        if not 0 <= index < self.length:
+            raise IndexError('BitColumn index out of range')
+        return bool(self.bits[index >> 3] & (1 << (index & 7)))
+
+    def __iter__(self):
+        for index in xrange(self.length):
+            yield bool(self.bits[index >> 3] & (1 << (index & 7)))
+
+class Column(object):
+    """The values of a field, in their stored form: integers and floats
+    in typed arrays, booleans in a BitColumn and everything else in a
+    list where equal strings share a single object. The nulls are
+    flagged in a BitColumn of their own.
+
+    Integer columns holding a value that does not fit a C long keep
+    their values in a list instead, and are not vectorized."""
+
+    def __init__(self, field):
+        self.field = field
+        if isinstance(field, FloatField):
+            self.kind = 'float'
+            self.values = array('d')
+            self.empty = 0.0
+        elif isinstance(field, IntegerField):
+            self.kind = 'int'
+            self.values = array('l')
+            self.empty = 0
+        elif isinstance(field, BooleanField):
+            self.kind = 'bool'
+            self.values = BitColumn()
+            self.empty = False
+        else:
+            self.kind = 'object'
+            self.values = []
+            self.empty = None
+            self._pool = {}
+
+        # decimals and dates are stored as strings, but compared (and
+        # vectorized) as integers: decimals scaled by their
+        # decimal_places and dates as seconds since the epoch
+        self.numeric_as = None
+        if isinstance(field, DecimalField):
+            self.numeric_as = 'decimal'
+            self.scale = 10 ** field.decimal_places
+        elif isinstance(field, TimeField):
+            self.numeric_as = 'time'
+        elif isinstance(field, DateField):
+            self.numeric_as = 'date'
+        elif isinstance(field, DateTimeField):
+            self.numeric_as = 'datetime'
+
+        # False once the values no longer fit in a typed array
+        self.packed = True
+        self.nulls = BitColumn()
+        self.has_nulls = False
+        self._keys = None
+        self._arrays = None
+
+    def __len__(self):
+        return len(self.nulls)
+
+    @property
+    def is_numeric(self):
+        return self.kind in ('int', 'float') or self.numeric_as is not None
+
+    @property
+    def is_vectorizable(self):
+        return self.is_numeric and self.packed
+
+    def append(self, raw):
+        self._keys = None
+        self._arrays = None
+        if raw is None:
+            self.nulls.append(True)
+            self.has_nulls = True
+            self.values.append(self.empty)
+            return
+
+        self.nulls.append(False)
+        value = self.convert(raw)
+        try:
+            self.values.append(value)
+        except OverflowError:
+            # a long too large for array('l')
+            self.values = self.values.tolist()
+            self.values.append(value)
+            self.packed = False
+
+    def convert(self, raw):
+        """Returns the stored form of a raw (or python) value"""
+        if self.kind == 'int':
+            return int(self.field.convert_type(raw))
+        if self.kind == 'float':
+            return float(raw)
+        if self.kind == 'bool':
+            return bool(self.field.convert_type(raw))
+
+        if isinstance(raw, basestring):
+            return self._pool.setdefault(raw, raw)
+        return raw
+
+    def key(self, value):
+        """Converts a stored (or python) value to the form it is
+        compared by"""
+        if self.kind != 'object':
+            return self.convert(value)
+
+        if self.numeric_as is None:
+            return self.field.serialize(self.field.convert_type(value))
+
+        value = self.field.convert_type(value)
+        if self.numeric_as == 'decimal':
+            return int((Decimal(value) * self.scale).to_integral_value())
+        if self.numeric_as == 'time':
+            return value.hour * 3600 + value.minute * 60 + value.second
+        return calendar.timegm(value.timetuple())
+
+    def keys(self):
+        """Returns the list of the comparison keys, None for the nulls"""
+        if self._keys is None:
+            if self.numeric_as is None:
+                self._keys = list(self)
+            else:
+                self._keys = []
+                for value in self:
+                    if value is not None:
+                        value = self.key(value)
+                    self._keys.append(value)
+        return self._keys
+
+    def arrays(self):
+        """Returns the comparison keys and the nulls as numpy arrays"""
+        if self._arrays is None:
+            if self.numeric_as is None:
+                keys = numpy.array(self.values)
+            else:
+                keys = numpy.array([k or 0 for k in self.keys()], dtype='int64')
+            nulls = numpy.array(list(self.nulls), dtype=bool)
+            self._arrays = (keys, nulls)
+        return self._arrays
+
+    def to_python(self, key):
+        """The opposite of key(), for the aggregations"""
+        if self.numeric_as == 'decimal':
+            return Decimal(key) / self.scale
+        return key
+
+    def __getitem__(self, index):
+        if self.has_nulls and self.nulls[index]:
+            return None
+        return self.values[index]
+
+    def __iter__(self):
+        if not self.has_nulls:
+            return iter(self.values)
+        return self._iter_with_nulls()
+
+    def _iter_with_nulls(self):
+        for null, value in zip(self.nulls, self.values):
+            if null:
+                yield None
+            else:
+                yield value
+
+class ColumnarModelSet(object):
+    """A ModelSet keeping each field as a Column instead of a list of
+    model instances. Instances are only built when taken from the set,
+    while to_dict(), serialize() and filter() work on the columns.
+
+    Relationships are kept as they are stored, in a list per
+    relationship."""
+    __model_class__ = None
+    # set to False to always use the pure python operations
+    use_numpy = True
+
+    def __init__(self, *items):
+        meta = self.__model_class__._meta
+        self.columns = dict([(k, Column(f)) for k, f in meta._fields.items()])
+        self.related = dict([(k, []) for k in meta._relationships.keys()])
+        self.length = 0
+        for item in items:
+            self.add(item)
+
+    def __len__(self):
+        return self.length
+
+    def __nonzero__(self):
+        return self.length > 0
+
+    def __repr__(self):
+        return "%s.ColumnarSet(%d rows)" % (self.__model_class__.__name__, self.length)
+
+    def add(self, model):
+        if not isinstance(model, self.__model_class__):
+            raise TypeError('add() takes a %s model instance ' \
+                            'as parameter, got %r' % \
+                            (self.__model_class__.__name__, model))
+
+        self.append_record(model.to_dict()[self.__model_class__._meta.verbose_name])
+
+    def append_record(self, data):
+        """Appends a row from the {field name: value} dict of a stored
+        record"""
+        for name, column in self.columns.items():
+            column.append(data.get(name))
+        for name, values in self.related.items():
+            values.append(data.get(name))
+        self.length += 1
+
+    def record(self, index):
+        """Returns the {field name: value} dict of a row, in the same
+        form as it is stored"""
+        data = {}
+        for name, column in self.columns.items():
+            value = column[index]
+            if value is not None:
+                data[name] = value
+        for name, values in self.related.items():
+            if values[index] is not None:
+                data[name] = values[index]
+        return data
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self.take(xrange(*index.indices(self.length)))
+
+        if index < 0:
+            index += self.length
+        if not 0 <= index < self.length:
+            raise IndexError('%s index out of range' % self.__class__.__name__)
+
+        model = self.__model_class__
+        return model.from_dict({model._meta.verbose_name: self.record(index)})
+
+    def __getslice__(self, start, end):
+        return self[max(0, start):max(0, end):]
+
+    def __iter__(self):
+        for index in xrange(self.length):
+            yield self[index]
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def take(self, indexes):
+        """Returns a new set with the given rows"""
+        ret = self.__class__()
+        for index in indexes:
+            ret.append_record(self.record(index))
+        return ret
+
+    def values(self, name):
+        """Returns the values of a field, in their stored form, None
+        for the nulls"""
+        return list(self.column(name))
+
+    def column(self, name):
+        if name not in self.columns:
+            raise TypeError('%s is not a valid field in %r' % (name, self.__model_class__))
+        return self.columns[name]
+
+    def vectorize(self, column):
+        """Tells whether the operations on a column go through numpy"""
+        return self.use_numpy and numpy is not None and column.is_vectorizable
+
+    def filter(self, **params):
+        """Returns the rows matching all the given lookups, which are
+        either field=value or field__<lookup>=value, where lookup is
+        one of exact, ne, gt, gte, lt, lte and in. Nulls never match.
+
+        Numeric, decimal and date fields are compared as numbers, with
+        boolean masks over numpy arrays when numpy is available"""
+        lookups = []
+        for key, value in params.items():
+            name, lookup = key, 'exact'
+            if '__' in key:
+                name, lookup = key.rsplit('__', 1)
+            if lookup != 'in' and lookup not in OPERATORS:
+                raise TypeError('unknown lookup %r in %s' % (lookup, key))
+            lookups.append((self.column(name), lookup, value))
+
+        if lookups and all([self.vectorize(c) for c, l, v in lookups]):
+            mask = numpy.ones(self.length, dtype=bool)
+            for column, lookup, value in lookups:
+                keys, nulls = column.arrays()
+                if lookup == 'in':
+                    mask &= numpy.in1d(keys, [column.key(v) for v in value])
+                else:
+                    mask &= OPERATORS[lookup](keys, column.key(value))
+                mask &= ~nulls
+            return self.take(numpy.flatnonzero(mask).tolist())
+
+        selected = xrange(self.length)
+        for column, lookup, value in lookups:
+            keys = column.keys()
+            if lookup == 'in':
+                wanted = set([column.key(v) for v in value])
+                selected = [i for i in selected if keys[i] is not None and keys[i] in wanted]
+            else:
+                compare = OPERATORS[lookup]
+                wanted = column.key(value)
+                selected = [i for i in selected if keys[i] is not None and compare(keys[i], wanted)]
+
+        return self.take(selected)
+
+    def sum(self, name):
+        """Sums a numeric or decimal field, skipping the nulls"""
+        column = self.column(name)
+        if column.kind not in ('int', 'float') and column.numeric_as != 'decimal':
+            raise TypeError('sum() takes a numeric field, %s is not' % name)
+
+        if self.vectorize(column):
+            keys, nulls = column.arrays()
+            total = keys[~nulls].sum().item()
+        else:
+            total = sum([k for k in column.keys() if k is not None])
+        return column.to_python(total)
+
+    def mean(self, name):
+        """The average of a numeric or decimal field, None when it has
+        only nulls"""
+        column = self.column(name)
+        count = len([k for k in column.keys() if k is not None])
+        if not count:
+            return None
+
+        total = self.sum(name)
+        if isinstance(total, Decimal):
+            return total / count
+        return float(total) / count
+
+    def count_by(self, name):
+        """Returns a {value: number of rows} dict, the values in their
+        stored form, None counting the nulls"""
+        column = self.column(name)
+        if self.vectorize(column) and column.numeric_as is None:
+            keys, nulls = column.arrays()
+            values, counts = numpy.unique(keys[~nulls], return_counts=True)
+            ret = dict(zip(values.tolist(), counts.tolist()))
+            if nulls.any():
+                ret[None] = int(nulls.sum())
+            return ret
+
+        ret = {}
+        for value in column:
+            ret[value] = ret.get(value, 0) + 1
+        return ret
+
+    def argsort(self, name, reverse=False):
+        """Returns the row indexes ordered by a field, the nulls last.
+        Rows with equal values keep their order"""
+        column = self.column(name)
+        if self.vectorize(column):
+            keys, nulls = column.arrays()
+            present = numpy.flatnonzero(~nulls)
+            keys = keys[present]
+            if reverse:
+                # negated, since reversing the result would also reverse
+                # the order of the rows with equal keys
+                keys = -keys
+            order = numpy.argsort(keys, kind='mergesort')
+            return present[order].tolist() + numpy.flatnonzero(nulls).tolist()
+
+        keys = column.keys()
+        present = [i for i in xrange(self.length) if keys[i] is not None]
+        present.sort(key=lambda i: keys[i], reverse=reverse)
+        return present + [i for i in xrange(self.length) if keys[i] is None]
+
+    def order_by(self, name, reverse=False):
+        return self.take(self.argsort(name, reverse))
+
+    def to_dict(self):
+        verbose_name = self.__model_class__._meta.verbose_name
+        dicts = [{verbose_name: self.record(i)} for i in xrange(self.length)]
+        return {self.__model_class__._meta.verbose_name_plural: dicts}
+
+    @classmethod
+    def from_dict(cls, edict):
+        if not isinstance(edict, dict):
+            raise TypeError, "%s.from_dict takes a dict as parameter. " \
+                  "Got %r" % (cls.__name__, type(edict))
+
+        meta = cls.__model_class__._meta
+        ret = cls()
+        for item in edict[meta.verbose_name_plural]:
+            ret.append_record(item[meta.verbose_name])
+        return ret
+
+    def serialize(self, to):
+        serializer = Registry.get(to)
+        return serializer(self.to_dict()).serialize()
+
+    @classmethod
+    def deserialize(cls, data, format):
+        serializer = Registry.get(format)
+        my_dict = serializer.deserialize(data)
+        return cls.from_dict(my_dict)
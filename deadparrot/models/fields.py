@@ -24,6 +24,11 @@ from attributes import *
 from decimal import Decimal, InvalidOperation
 
 from deadparrot.models.registry import ModelRegistry
+from deadparrot.models import urls
+
+url_regex = re.compile(r'^https?:[/]{2}([\w_.-]+)+[.]\w{2,}([/]?.*)?')
+email_regex = re.compile(r'^[a-z0-9_.-]{2,}@[\w_.-]{3,}' \
+                         '[.][a-z]{2,}([.][a-z]{2,})*', re.I)
 
 class FieldValidationError(Exception):
     pass
@@ -32,20 +37,38 @@ class InvalidRelationShipError(Exception):
     pass
 
 class URLChecker(object):
+    def __init__(self, service=None):
+        # an urls.URLExistenceService, which caches the results and
+        # can check many urls at once
+        self.service = service
+
     def set_url(self, url):
         self.url = url
 
     def is_valid(self):
-        url_regex = re.compile(r'^https?:[/]{2}([\w_.-]+)+[.]\w{2,}([/]?.*)?')
         return url_regex.search(self.url) and True or False
 
     def does_exists(self):
+        if self.service is not None:
+            return self.service.exists(self.url)
+
         try:
             urllib2.urlopen(self.url)
             return True
         except urllib2.URLError:
             return False
 
+    def does_exists_many(self, urls):
+        """Returns a {url: exists} dict"""
+        if self.service is not None:
+            return self.service.exists_many(urls)
+
+        ret = {}
+        for url in urls:
+            self.set_url(url)
+            ret[url] = self.does_exists()
+        return ret
+
 class Field(Attribute):
     must_validate = True
     primary_key = False
@@ -77,6 +100,19 @@ class Field(Attribute):
         self.primary_key = primary_key
         super(Field, self).__init__(self.vartype, *args, **kw)
 
+    def validate_many(self, values):
+        """Validates many values at once, for the bulk paths, returning
+        a {position: exception} dict with the invalid ones"""
+        errors = {}
+        validate = self.validate
+        for index, value in enumerate(values):
+            try:
+                validate(value)
+            except (FieldValidationError, TypeError, ValueError), e:
+                errors[index] = e
+
+        return errors
+
 class CharField(Field):
     max_length = None
     vartype = unicode
@@ -124,11 +160,12 @@ class DateTimeField(CharField, DateTimeAttribute):
             kw['max_length'] += 2
 
         self.vartype = vartype
+        # a format without any directive formats to itself
+        self.bad_format = datetime.now().strftime(vartype) == vartype
         super(DateTimeField, self).__init__(*args, **kw)
 
     def validate(self, value):
-        klassname = self.__class__.__name__
-        if datetime.now().strftime(self.vartype) == self.vartype:
+        if self.bad_format:
             raise FieldValidationError, \
                   u'"%s" is not a valid datetime format, ' % value
 
@@ -155,6 +192,7 @@ class DecimalField(Field):
                       (self.__class__.__name__, param,
                        type(val), val)
 
+        self.exponent = Decimal(1).scaleb(-self.decimal_places)
         super(DecimalField, self).__init__(*args, **kw)
 
     def validate(self, value):
@@ -163,12 +201,12 @@ class DecimalField(Field):
                   u"%s must be a string for DecimalField " \
                   "compatibility" % value
         try:
-            floated_value = float(Decimal(value))
+            rounded = Decimal(value).quantize(self.exponent)
         except InvalidOperation:
             raise FieldValidationError, 'the string "%s" is ' \
                   "not a valid decimal number" % value
 
-        to_validate = u"%.*f" % (self.decimal_places, floated_value)
+        to_validate = format(rounded, 'f')
         if (len(to_validate) - 1) != self.max_digits:
             raise FieldValidationError, "%s do not have %d max " \
                   "digits and %d decimal places" % (value,
@@ -192,9 +230,6 @@ class EmailField(CharField):
                   u"%s must be a string(ish) type " \
                   "for EmailField compatibility" % value
 
-        email_regex = re.compile(r'^[a-z0-9_.-]{2,}@[\w_.-]{3,}' \
-                                 '[.][a-z]{2,}([.][a-z]{2,})*', re.I)
-
         if not email_regex.search(value):
             raise FieldValidationError, 'The email is not valid: "%s"'% value
 
@@ -276,6 +311,7 @@ class PhoneNumberField(CharField):
 
         rfmt = re.escape(format).replace("0", r"\d")
         self.regex_format = r"(%s)" % rfmt
+        self.regex = re.compile(self.regex_format)
 
         super(PhoneNumberField, self).__init__(*args, **kw)
 
@@ -285,8 +321,7 @@ class PhoneNumberField(CharField):
                   u"%s must be a string(ish) type " \
                   "for PhoneNumberField compatibility" % value
 
-        regex = re.compile(self.regex_format)
-        if not regex.search(value):
+        if not self.regex.search(value):
             raise FieldValidationError, "The given value doesn't match " \
                   "'%s'. Got %s" % (self.format, value)
 
@@ -305,7 +340,17 @@ class URLField(CharField):
         verify_exists = kw.pop('verify_exists', True)
 
         # an object for checking url, for TDD reasons :)
-        self.url_checker = kw.pop('url_checker', URLChecker())
+        self.url_checker = kw.pop('url_checker', None) or URLChecker(urls.service)
+
+        # checks the existence of the urls only when the objects are
+        # stored, all of them at once, see FileObjectsManager.add_many
+        deferred = kw.pop('deferred', False)
+        if not isinstance(deferred, bool):
+            raise TypeError, u"%s.deferred param must be a bool" \
+                  " (True or False), got %r (%r)" % \
+                  (self.__class__.__name__,
+                   type(deferred), deferred)
+        self.deferred = deferred
 
         if not isinstance(verify_exists, bool):
             raise TypeError, u"%s.verify_exists param must be a bool" \
@@ -335,14 +380,56 @@ class URLField(CharField):
         if not url_status.is_valid():
             raise FieldValidationError, 'The url is not valid: "%s"'% value
 
-        if self.verify_exists and not url_status.does_exists():
+        if self.verify_exists and not self.deferred and not url_status.does_exists():
             raise FieldValidationError, 'The url does not exist: "%s"'% value
 
+    def missing(self, values):
+        """Returns the given urls that do not exist, checking them at
+        once. Always empty unless verify_exists is True"""
+        values = [v for v in values if v]
+        if not self.verify_exists or not values:
+            return []
+
+        checker = self.url_checker
+        if hasattr(checker, 'does_exists_many'):
+            found = checker.does_exists_many(values)
+        else:
+            found = {}
+            for value in values:
+                checker.set_url(value)
+                found[value] = checker.does_exists()
+
+        return [v for v in values if not found[v]]
+
+    def validate_many(self, values):
+        # the format first, then the existence of the valid ones at once
+        errors = {}
+        checked = []
+        for index, value in enumerate(values):
+            if not isinstance(value, basestring):
+                errors[index] = TypeError(u"%s must be a string(ish) type "
+                                          "for URLField compatibility" % value)
+                continue
+
+            self.url_checker.set_url(value)
+            if not self.url_checker.is_valid():
+                errors[index] = FieldValidationError('The url is not valid: "%s"' % value)
+            else:
+                checked.append((index, value))
+
+        missing = set(self.missing([value for index, value in checked]))
+        for index, value in checked:
+            if value in missing:
+                errors[index] = FieldValidationError('The url does not exist: "%s"' % value)
+
+        return errors
+
 class RelationShip(object):
     from_model = None
     to_model = None
     is_lazy = False
     is_self_referenced = False
+    reference = False
 
     def set_model_object(self, model):
 
@@ -392,6 +479,13 @@ class RelationShip(object):
 
         self.is_self_referenced = self_referenced
 
+    def set_reference(self, reference):
+        err = '%s.set_reference takes a boolean as parameter, got %r'
+        if not isinstance(reference, bool):
+            raise TypeError(err % (self.__class__.__name__, reference))
+
+        self.reference = reference
+
     def set_from_model(self, from_model):
         err = '%s.set_from_model takes a deadparrot.models.Model ' \
               'subclass as parameter, got %r'
@@ -408,7 +502,52 @@ class RelationShip(object):
 
         self.to_model = to_model
 
+    def reference_for(self, instance):
+        """Returns the primary key values of a related instance, which
+        is all that gets stored of it when reference=True"""
+        fields = self.to_model._meta._fields
+        return dict([(k, f.serialize(getattr(instance, k))) \
+                     for k, f in fields.items() if f.primary_key])
+
+    def is_reference(self, value):
+        """Tells whether a deserialized value holds only primary keys,
+        instead of the whole related objects"""
+        if isinstance(value, list):
+            return bool(value) and self.is_reference(value[0])
+
+        return isinstance(value, dict) and \
+               not value.has_key(self.to_model._meta.verbose_name)
+
+    def stored_pks(self, value):
+        """Returns the primary keys of the related objects found in a
+        stored value, either referenced or embedded"""
+        meta = self.to_model._meta
+        if isinstance(value, list):
+            ret = []
+            for item in value:
+                ret.extend(self.stored_pks(item))
+            return ret
+
+        if not isinstance(value, dict):
+            return []
+
+        if value.has_key(meta.verbose_name_plural):
+            return self.stored_pks(value[meta.verbose_name_plural])
+
+        if value.has_key(meta.verbose_name):
+            data = value[meta.verbose_name]
+            return [dict([(k, data.get(k)) for k, f in meta._fields.items() if f.primary_key])]
+
+        return [value]
+
     def serialize(self, val):
+        if self.reference:
+            if hasattr(val, 'as_modelset'):
+                val = val.as_modelset().items
+            if isinstance(val, list):
+                return [self.reference_for(v) for v in val]
+            return self.reference_for(val)
+
         if isinstance(val, list):
             return [v.to_dict() for v in val]
         else:
@@ -427,12 +566,24 @@ class RelationShip(object):
         self.set_lazy(False)
 
 class ForeignKey(RelationShip):
-    def __init__(self, model):
+    def __init__(self, model, reference=False):
         self.set_model_object(model)
+        self.set_reference(reference)
 
 class ManyToManyField(RelationShip):
-    def __init__(self, model):
+    join_table = False
+
+    def __init__(self, model, reference=False, join_table=False):
         self.set_model_object(model)
+        self.set_reference(reference)
+        self.set_join_table(join_table)
+
+    def set_join_table(self, join_table):
+        err = '%s.set_join_table takes a boolean as parameter, got %r'
+        if not isinstance(join_table, bool):
+            raise TypeError(err % (self.__class__.__name__, join_table))
+
+        self.join_table = join_table
 
 class OneToOneField(ForeignKey):
     pass
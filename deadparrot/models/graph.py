@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# -*- coding: utf-8; -*-
+#
+# Copyright (C) 2009 Gabriel Falcão <gabriel@nacaolivre.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public
+# License along with this program; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+# The graph serialization writes each object a single time, in a table
+# keyed by model and primary key, and refers to it everywhere else:
+#
+#   {"$root": {"$ref": ["Order", "[[\"id\",1]]"]},
+#    "$refs": {"Order": {"[[\"id\",1]]": {"id": 1,
+#                                         "customer": {"$ref": ["Customer", "[[\"id\",7]]"]}}},
+#              "Customer": {"[[\"id\",7]]": {"id": 7, "name": "John"}}}}
+#
+# so that shared objects are not repeated, and cycles (like the ones of
+# ForeignKey('self')) do not recurse forever. Objects of models without
+# primary keys are keyed by their identity ("@1", "@2", ...).
+
+from deadparrot.models.base import ModelSetManager, pk_dict, pending_references
+from deadparrot.models.fields import ManyToManyField
+from deadparrot.models.reverse import key_for
+
+__all__ = ['GraphWriter', 'GraphReader']
+
+class GraphWriter(object):
+    def __init__(self):
+        self.refs = {}
+        self._seen = {}
+        # keeps the instances alive, so that their ids are not reused
+        self._instances = []
+
+    def ref(self, instance):
+        seen = self._seen.get(id(instance))
+        if seen is not None:
+            return {'$ref': list(seen)}
+
+        meta = instance._meta
+        if meta.has_pk:
+            key = key_for(pk_dict(instance))
+        else:
+            key = '@%d' % (len(self._instances) + 1)
+
+        self._seen[id(instance)] = (meta.verbose_name, key)
+        self._instances.append(instance)
+
+        table = self.refs.setdefault(meta.verbose_name, {})
+        if key not in table:
+            # set before walking the relationships, which may lead back here
+            table[key] = {}
+            table[key] = self.data(instance)
+
+        return {'$ref': [meta.verbose_name, key]}
+
+    def data(self, instance):
+        meta = instance._meta
+        pending = pending_references(instance)
+        ret = {}
+        for k, field in meta._fields.items():
+            value = getattr(instance, k)
+            if value is not None:
+                ret[k] = field.serialize(value)
+
+        for k, relationship in meta._relationships.items():
+            if getattr(relationship, 'join_table', False):
+                continue
+
+            if k in pending:
+                ret[k] = pending[k]
+                continue
+
+            value = getattr(instance, k)
+            if value is None:
+                continue
+
+            if isinstance(relationship, ManyToManyField):
+                ret[k] = [self.ref(i) for i in getattr(value, 'objects', value)]
+            else:
+                ret[k] = self.ref(value)
+
+        return ret
+
+    def write(self, root):
+        """Takes a model instance or a list of them"""
+        if isinstance(root, list):
+            root = [self.ref(i) for i in root]
+        else:
+            root = self.ref(root)
+
+        return {'$root': root, '$refs': self.refs}
+
+class GraphReader(object):
+    def __init__(self, graph):
+        if not isinstance(graph, dict) or not graph.has_key('$refs'):
+            raise TypeError('a graph should be a dict like {"$root": ..., '
+                            '"$refs": {...}}, got %r' % graph)
+
+        self.refs = graph['$refs']
+        self.root = graph['$root']
+        self._built = {}
+
+    def build(self, model, ref):
+        name, key = ref['$ref']
+        instance = self._built.get((name, key))
+        if instance is not None:
+            return instance
+
+        try:
+            data = self.refs[name][key]
+        except KeyError:
+            raise TypeError('the graph has no %s object keyed %s' % (name, key))
+
+        relationships = model._meta._relationships
+        plain = {}
+        linked = {}
+        for k, v in data.items():
+            if k in relationships and self.is_ref(v):
+                linked[k] = v
+            else:
+                plain[k] = v
+
+        instance = model.from_dict({model._meta.verbose_name: plain})
+        # remembered before building the linked objects, which may
+        # point back to this one
+        self._built[(name, key)] = instance
+
+        for k, v in linked.items():
+            to_model = relationships[k].to_model
+            if isinstance(v, list):
+                msmanager = ModelSetManager(to_model)
+                for item in v:
+                    msmanager.add(self.build(to_model, item))
+                setattr(instance, k, msmanager)
+            else:
+                setattr(instance, k, self.build(to_model, v))
+
+        return instance
+
+    def is_ref(self, value):
+        if isinstance(value, list):
+            return bool(value) and self.is_ref(value[0])
+        return isinstance(value, dict) and value.has_key('$ref')
+
+    def read(self, model):
+        if isinstance(self.root, list):
+            return [self.build(model, ref) for ref in self.root]
+        return self.build(model, self.root)
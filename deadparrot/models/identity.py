@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# -*- coding: utf-8; -*-
+#
+# Copyright (C) 2009 Gabriel Falcão <gabriel@nacaolivre.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public
+# License along with this program; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+import weakref
+
+__all__ = ['IdentityMap']
+
+class IdentityMap(object):
+    """Maps the primary key of stored records to the live model
+    instances built from them.
+
+    Instances are held through weak references, so the map never keeps
+    a model alive by itself. Each entry remembers the record it was
+    built from, and an instance is only reused while the stored record
+    is still the same."""
+
+    def __init__(self, model):
+        if not model._meta.has_pk:
+            raise TypeError('%s needs at least one primary_key to use an '
+                            'identity map' % model.__name__)
+
+        self.model = model
+        self.pk_names = sorted([k for k, f in model._meta._fields.items() \
+                                if f.primary_key])
+        self._entries = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def key_for(self, record):
+        data = record[self.model._meta.verbose_name]
+        return tuple([data.get(k) for k in self.pk_names])
+
+    def _forget(self, key, ref):
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] is ref:
+            del self._entries[key]
+
+    def load(self, record, trusted=False):
+        """Returns the live instance for the given record, building
+        (and remembering) a new one when needed"""
+        key = self.key_for(record)
+        entry = self._entries.get(key)
+        if entry is not None:
+            instance = entry[0]()
+            if instance is not None and entry[1] == record:
+                return instance
+
+        instance = self.model.from_dict(record, trusted)
+        forget = lambda ref, key=key: self._forget(key, ref)
+        self._entries[key] = (weakref.ref(instance, forget), record)
+        return instance
+
+    def invalidate(self, records):
+        for record in records:
+            self._entries.pop(self.key_for(record), None)
+
+    def clear(self):
+        self._entries.clear()
@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+# -*- coding: utf-8; -*-
+#
+# Copyright (C) 2009 Gabriel Falcão <gabriel@nacaolivre.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public
+# License along with this program; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+import csv
+import codecs
+
+from deadparrot.lib import demjson
+from deadparrot.models.validation import VALIDATE_NONE
+
+__all__ = ['ImportReport', 'BulkImporter']
+
+class ImportReport(object):
+    def __init__(self):
+        self.imported = 0
+        # (row number, field name, message) tuples
+        self.errors = []
+
+    @property
+    def rejected(self):
+        return len(set([number for number, name, message in self.errors]))
+
+    def __repr__(self):
+        return '<ImportReport: %d imported, %d rejected>' % (self.imported, self.rejected)
+
+class BulkImporter(object):
+    """Loads rows of raw values into a FileObjectsManager storage.
+
+    Rows are gathered in batches, and each batch is validated and
+    converted one column at a time, without building model instances.
+    Rows with invalid values are reported and skipped, the valid ones
+    are written with a single storage write per batch."""
+
+    def __init__(self, manager, batch_size=1000):
+        if not isinstance(batch_size, int) or batch_size < 1:
+            raise TypeError('batch_size should be a positive int, got %r' % batch_size)
+
+        self.manager = manager
+        self.model = manager.model
+        self.batch_size = batch_size
+        self.report = ImportReport()
+
+        meta = self.model._meta
+        self.validate = meta.fields_validation_policy != VALIDATE_NONE
+        self.required = [k for k, f in meta._fields.items() if not f.blank]
+
+    def convert_column(self, name, numbers, values):
+        """Validates and converts the values of a column, returning the
+        serialized values and reporting the invalid ones as None"""
+        field = self.model._meta._fields[name]
+        convert = field.convert_type
+        serialize = field.serialize
+        errors = self.report.errors
+
+        present = [index for index, value in enumerate(values) \
+                   if value is not None and value != '']
+        invalid = {}
+        if self.validate:
+            invalid = field.validate_many([values[index] for index in present])
+
+        ret = [None] * len(values)
+        for position, index in enumerate(present):
+            error = invalid.get(position)
+            if error is None:
+                try:
+                    ret[index] = serialize(convert(values[index]))
+                    continue
+                except (TypeError, ValueError), e:
+                    error = e
+            errors.append((numbers[index], name, unicode(error)))
+
+        return ret
+
+    def import_batch(self, batch):
+        """Takes a list of (row number, {field name: raw value}) tuples"""
+        numbers = [number for number, row in batch]
+        names = set()
+        for number, row in batch:
+            names.update(row.keys())
+
+        columns = {}
+        for name in names:
+            values = [row.get(name) for number, row in batch]
+            columns[name] = self.convert_column(name, numbers, values)
+
+        bad = set([number for number, name, message in self.report.errors])
+        for name in self.required:
+            column = columns.get(name) or [None] * len(numbers)
+            for number, value in zip(numbers, column):
+                if value is None and number not in bad:
+                    self.report.errors.append((number, name, 'this field is required'))
+                    bad.add(number)
+
+        verbose_name = self.model._meta.verbose_name
+        records = []
+        for index, number in enumerate(numbers):
+            if number in bad:
+                continue
+            data = {}
+            for name, column in columns.items():
+                if column[index] is not None:
+                    data[name] = column[index]
+            records.append({verbose_name: data})
+
+        if records:
+            self.manager._append_records(records)
+        self.report.imported += len(records)
+
+    def load(self, rows):
+        """Takes an iterable of (row number, {field name: raw value}),
+        where rows that could not be read at all are None"""
+        fields = self.model._meta._fields
+        batch = []
+        for number, row in rows:
+            if row is None:
+                self.report.errors.append((number, None, 'not a json object'))
+                continue
+
+            unknown = [k for k in row.keys() if k not in fields]
+            if unknown:
+                for name in unknown:
+                    self.report.errors.append((number, name, 'unknown field'))
+                continue
+
+            batch.append((number, row))
+            if len(batch) == self.batch_size:
+                self.import_batch(batch)
+                batch = []
+
+        if batch:
+            self.import_batch(batch)
+
+        return self.report
+
+def read_csv(path, mapping=None, delimiter=','):
+    """Yields (row number, {field name: value}) from a utf-8 csv file,
+    whose first row names the columns. The mapping translates column
+    names to field names, columns missing from it are skipped"""
+    fobj = open(path, 'rb')
+    try:
+        reader = csv.reader(fobj, delimiter=delimiter)
+        header = [h.decode('utf-8') for h in reader.next()]
+        if mapping is None:
+            mapping = dict([(h, h) for h in header])
+
+        columns = [(index, mapping[h]) for index, h in enumerate(header) if h in mapping]
+        for row in reader:
+            if not row:
+                continue
+            values = {}
+            for index, name in columns:
+                if index < len(row):
+                    values[name] = row[index].decode('utf-8')
+            yield reader.line_num, values
+    finally:
+        fobj.close()
+
+def read_jsonl(path, verbose_name):
+    """Yields (line number, {field name: value}) from a file with a json
+    object per line, either {field: value} or {verbose_name: {...}}"""
+    fobj = codecs.open(path, 'r', 'utf-8')
+    try:
+        number = 0
+        for line in fobj:
+            number += 1
+            if not line.strip():
+                continue
+
+            try:
+                values = demjson.decode(line)
+            except ValueError:
+                values = None
+
+            if isinstance(values, dict) and values.keys() == [verbose_name] and \
+               isinstance(values[verbose_name], dict):
+                values = values[verbose_name]
+
+            if not isinstance(values, dict):
+                values = None
+            yield number, values
+    finally:
+        fobj.close()
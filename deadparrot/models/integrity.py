@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+# -*- coding: utf-8; -*-
+#
+# Copyright (C) 2009 Gabriel Falcão <gabriel@nacaolivre.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public
+# License along with this program; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+# Storage files written with Meta.checksums = True keep one record per
+# line, each one carrying the CRC32 of its own json:
+#
+#   {"Cars":[
+#   {"Car":{"brand":"OSCar"},"__crc32__":3405691582},
+#   {"Car":{"brand":"Chevy"},"__crc32__":1234567890}
+#   ]}
+#
+# which is still a valid json document, but that can be verified (and
+# salvaged) line by line, without loading the whole file in memory.
+
+import re
+import zlib
+
+from deadparrot.lib import demjson
+
+__all__ = ['StorageCorruptedError', 'VerifyReport', 'checksum',
+           'encode_record', 'encode_records', 'iter_records', 'verify']
+
+CHECKSUM_KEY = '__crc32__'
+checksum_regex = re.compile(r'^(.*),"%s":(\d+)\}$' % CHECKSUM_KEY)
+
+class StorageCorruptedError(Exception):
+    pass
+
+def checksum(json):
+    if isinstance(json, unicode):
+        json = json.encode('utf-8')
+    return zlib.crc32(json) & 0xffffffff
+
+def encode_record(record):
+    record = dict(record)
+    record.pop(CHECKSUM_KEY, None)
+    json = demjson.encode(record)
+    return u'%s,"%s":%d}' % (json[:-1], CHECKSUM_KEY, checksum(json))
+
+def encode_records(plural, records):
+    """Yields the lines of a storage file holding the given records,
+    which can be any iterable, consumed one record at a time"""
+    yield u'{%s:[\n' % demjson.encode(plural)
+    previous = None
+    for record in records:
+        if previous is not None:
+            yield previous + u',\n'
+        previous = encode_record(record)
+
+    if previous is not None:
+        yield previous + u'\n'
+    yield u']}\n'
+
+class VerifyReport(object):
+    def __init__(self, path):
+        self.path = path
+        self.valid = 0
+        # (line number, reason) tuples
+        self.errors = []
+
+    @property
+    def ok(self):
+        return not self.errors
+
+    def __repr__(self):
+        return '<VerifyReport %s: %d valid records, %d errors>' % \
+               (self.path, self.valid, len(self.errors))
+
+def _check_line(line):
+    """Returns the record decoded from a line of a storage file, raising
+    ValueError when the line is damaged"""
+    match = checksum_regex.match(line)
+    if match is None:
+        raise ValueError('missing checksum')
+
+    json, expected = match.group(1) + u'}', int(match.group(2))
+    if checksum(json) != expected:
+        raise ValueError('checksum mismatch')
+
+    record = demjson.decode(json)
+    if not isinstance(record, dict):
+        raise ValueError('not a record')
+    return record
+
+def iter_records(path, plural, report=None, candidate=None):
+    """Yields the valid records of a storage file, one at a time,
+    recording the damaged ones in the given VerifyReport.
+
+    In files written line by line, the lines for which candidate(line)
+    returns False are skipped without being decoded (nor verified)"""
+    if report is None:
+        report = VerifyReport(path)
+
+    # read as bytes, split on "\n" only: the codecs readers would also
+    # split on u"\u2028", u"\x85" and the like, which demjson leaves
+    # unescaped inside of the strings
+    fobj = open(path, 'rb')
+    try:
+        first = fobj.readline()
+        if not first.strip():
+            return
+
+        header = '{%s:[' % demjson.encode(plural).encode('utf-8')
+        if first.rstrip() != header:
+            # not written line by line, it has to be decoded at once
+            try:
+                data = demjson.decode((first + fobj.read()).decode('utf-8'))
+                records = data[plural]
+            except (ValueError, KeyError, TypeError), e:
+                report.errors.append((1, 'undecodable file: %s' % e))
+                return
+
+            for record in records:
+                report.valid += 1
+                yield record
+            return
+
+        closed = False
+        number = 1
+        for line in fobj:
+            number += 1
+            line = line.rstrip('\n')
+            if line.strip() == ']}':
+                closed = True
+                continue
+
+            if closed:
+                report.errors.append((number, 'data after the end of the file'))
+                continue
+
+            try:
+                line = line.rstrip(',').decode('utf-8')
+                if candidate is not None and not candidate(line):
+                    continue
+                record = _check_line(line)
+            except ValueError, e:
+                report.errors.append((number, unicode(e)))
+                continue
+
+            report.valid += 1
+            yield record
+
+        if not closed:
+            report.errors.append((number, 'truncated file'))
+    finally:
+        fobj.close()
+
+def verify(path, plural):
+    report = VerifyReport(path)
+    for record in iter_records(path, plural, report):
+        pass
+    return report
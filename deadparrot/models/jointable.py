@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- coding: utf-8; -*-
+#
+# Copyright (C) 2009 Gabriel Falcão <gabriel@nacaolivre.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public
+# License along with this program; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+import os
+import codecs
+
+from deadparrot.lib import demjson
+from deadparrot.models.reverse import key_for
+
+__all__ = ['JoinTable']
+
+class JoinTable(object):
+    """The pairs of a ManyToManyField declared with join_table=True,
+    kept in a file with a [from primary key, to primary key] json list
+    per line, so that adding a pair appends a single line.
+
+    Both columns are indexed in memory, and the indexes are rebuilt
+    whenever another process changes the file."""
+
+    def __init__(self, path):
+        self.path = path
+        self._pairs = []
+        self._by_from = {}
+        self._by_to = {}
+        self._stamp = None
+
+    def _get_stamp(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return (st.st_mtime, st.st_size)
+
+    def _index(self, from_pk, to_pk):
+        self._pairs.append((from_pk, to_pk))
+        self._by_from.setdefault(key_for(from_pk), []).append(to_pk)
+        self._by_to.setdefault(key_for(to_pk), []).append(from_pk)
+
+    def _load(self):
+        stamp = self._get_stamp()
+        if stamp == self._stamp:
+            return
+
+        self._pairs = []
+        self._by_from = {}
+        self._by_to = {}
+        if stamp is not None:
+            fobj = codecs.open(self.path, 'r', 'utf-8')
+            try:
+                for line in fobj:
+                    if line.strip():
+                        from_pk, to_pk = demjson.decode(line)
+                        self._index(from_pk, to_pk)
+            finally:
+                fobj.close()
+
+        self._stamp = stamp
+
+    def __len__(self):
+        self._load()
+        return len(self._pairs)
+
+    def related(self, from_pk):
+        """Returns the primary keys paired with from_pk, in the order
+        they were added"""
+        self._load()
+        return list(self._by_from.get(key_for(from_pk), []))
+
+    def referrers(self, to_pk):
+        self._load()
+        return list(self._by_to.get(key_for(to_pk), []))
+
+    def add(self, from_pk, to_pks):
+        self._load()
+        current = self._by_from.get(key_for(from_pk), [])
+        lines = []
+        for to_pk in to_pks:
+            if to_pk in current:
+                continue
+            self._index(from_pk, to_pk)
+            lines.append(demjson.encode([from_pk, to_pk]) + u'\n')
+
+        if lines:
+            fobj = codecs.open(self.path, 'a', 'utf-8')
+            try:
+                fobj.write(u''.join(lines))
+            finally:
+                fobj.close()
+            self._stamp = self._get_stamp()
+
+    def remove(self, from_pk, to_pks=None):
+        """Removes the given pairs, or every pair of from_pk when to_pks
+        is None, rewriting the file"""
+        self._load()
+        key = key_for(from_pk)
+        if key not in self._by_from:
+            return
+
+        pairs = self._pairs
+        self._pairs = []
+        self._by_from = {}
+        self._by_to = {}
+        for pair in pairs:
+            if key_for(pair[0]) == key and (to_pks is None or pair[1] in to_pks):
+                continue
+            self._index(*pair)
+
+        temporary = self.path + '.tmp'
+        fobj = codecs.open(temporary, 'w', 'utf-8')
+        try:
+            for pair in self._pairs:
+                fobj.write(demjson.encode(list(pair)) + u'\n')
+        finally:
+            fobj.close()
+
+        os.rename(temporary, self.path)
+        self._stamp = self._get_stamp()
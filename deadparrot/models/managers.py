@@ -18,12 +18,31 @@
 # Free Software Foundation, Inc., 59 Temple Place - Suite 330,
 # Boston, MA 02111-1307, USA.
 import os
+import re
 import codecs
+import shutil
+import threading
 
+from functools import wraps
+from deadparrot import stats
+
+from deadparrot.lib import demjson
+from deadparrot.serialization import Registry
 from deadparrot.models.fields import *
+from deadparrot.models.changelog import ChangeLog, INSERT, UPDATE, DELETE
+from deadparrot.models.identity import IdentityMap
+from deadparrot.models.search import SearchIndex
+from deadparrot.models.reverse import ReverseIndex
+from deadparrot.models.jointable import JoinTable
+from deadparrot.models.schema import SchemaStamp, fingerprint
+from deadparrot.models.integrity import StorageCorruptedError, VerifyReport
+from deadparrot.models.integrity import encode_record, encode_records, iter_records
+from deadparrot.models.importer import BulkImporter, read_csv, read_jsonl
 from os.path import join
+from time import time as timestamp
+from datetime import datetime
 
-__all__ = ['ModelManager', 'FileSystemModelManager']
+__all__ = ['ModelManager', 'FileSystemModelManager', 'StorageCorruptedError']
 
 class ObjectsManager(object):
     def __init__(self, model, *args, **kw):
@@ -38,7 +57,44 @@ class ModelManager(object):
     def __new__(cls, *args, **kw):
         return (cls.manager, args, kw)
 
+def measured(operation):
+    """Decorates a FileObjectsManager method, recording its latency and
+    I/O counters in deadparrot.stats (or the stats_registry of the
+    manager, when it has one) under the given operation name.
+    Calls made from within another measured call are accounted to the
+    outer one (e.g. the all() done by get() counts as get()), but for
+    the records they return, which each operation counts itself with
+    self._count('records_returned', ...)"""
+    def decorate(method):
+        @wraps(method)
+        def wrapper(self, *args, **kw):
+            counters = getattr(self._measuring, 'counters', None)
+            if counters is not None:
+                returned = counters['records_returned']
+                try:
+                    return method(self, *args, **kw)
+                finally:
+                    counters['records_returned'] = returned
+
+            counters = {'records_scanned': 0, 'records_returned': 0,
+                        'bytes_read': 0, 'bytes_written': 0}
+            self._measuring.counters = counters
+            started = timestamp()
+            try:
+                return method(self, *args, **kw)
+            finally:
+                self._measuring.counters = None
+                registry = self.stats_registry or stats.registry
+                registry.record(self.model.__name__, operation,
+                                timestamp() - started, **counters)
+        return wrapper
+    return decorate
+
 class FileObjectsManager(ObjectsManager):
+    # a stats.StatsRegistry to record the operations in, instead of
+    # the in-process one
+    stats_registry = None
+
     def __setup__(self, base_path):
         if not isinstance(base_path, basestring):
             raise TypeError('FileSystemModelManager "base_path" parameter should be string, got %r' % base_path)
@@ -46,6 +102,61 @@ class FileObjectsManager(ObjectsManager):
         if not os.path.exists(base_path):
             raise OSError('The path %s does not exist' % base_path)
         self.base_path = base_path
+        self._measuring = threading.local()
+
+        self._changelog = None
+        if self.model._meta.changelog:
+            self._changelog = ChangeLog(join(base_path, "%s.changes" % self.model.__name__))
+
+        self._identity_map = None
+        if self.model._meta.identity_map:
+            self._identity_map = IdentityMap(self.model)
+
+        self._search_index = None
+        if self.model._meta.search_fields:
+            self._search_index = SearchIndex(self.model, join(base_path, "%s.search" % self.model.__name__))
+
+        self._reverse_index = None
+        if self.model._meta.reverse_index:
+            self._reverse_index = ReverseIndex(self.model, join(base_path, "%s.refs" % self.model.__name__))
+
+        self._join_tables = {}
+        for name, relationship in self.model._meta._relationships.items():
+            if getattr(relationship, 'join_table', False):
+                path = join(base_path, "%s.%s.pairs" % (self.model.__name__, name))
+                self._join_tables[name] = JoinTable(path)
+
+        self._schema_stamp = None
+        if self.model._meta.trusted_load:
+            self._schema_stamp = SchemaStamp(join(base_path, "%s.schema" % self.model.__name__),
+                                             fingerprint(self.model))
+
+        self._setup_ttl()
+
+    def _setup_ttl(self):
+        meta = self.model._meta
+        self._ttl_field = None
+        self._ttl_seconds = None
+
+        if meta.ttl_field is not None:
+            field = meta._fields.get(meta.ttl_field)
+            if not isinstance(field, DateTimeField) or isinstance(field, TimeField):
+                raise TypeError('%s.Meta.ttl_field should be the name of a '
+                                'DateTimeField, got %r' % (self.model.__name__, meta.ttl_field))
+            self._ttl_field = meta.ttl_field
+
+        if meta.ttl_seconds is not None:
+            if not isinstance(meta.ttl_seconds, (int, long, float)) or meta.ttl_seconds <= 0:
+                raise TypeError('%s.Meta.ttl_seconds should be a positive number, '
+                                'got %r' % (self.model.__name__, meta.ttl_seconds))
+            self._ttl_seconds = meta.ttl_seconds
+
+    @property
+    def _has_ttl(self):
+        return self._ttl_field is not None or self._ttl_seconds is not None
+
+    def _clock(self):
+        return timestamp()
 
     @property
     def _filename(self):
@@ -55,35 +166,493 @@ class FileObjectsManager(ObjectsManager):
     def _fullpath(self):
         return join(self.base_path, self._filename)
 
-    def create(self, **kw):
-        model = self.model(**kw)
-        return self.add(model)
-
-    def add(self, model):
-        ModelSetClass = self.model.Set()
+    def _record_pk(self, record):
+        fields = self.model._meta._fields
+        data = record[self.model._meta.verbose_name]
+        names = [k for k, f in fields.items() if f.primary_key] or fields.keys()
+        return dict([(k, data.get(k)) for k in names])
+
+    def _count(self, name, value):
+        counters = getattr(self._measuring, 'counters', None)
+        if counters is not None:
+            counters[name] += value
+
+    def _notify(self, op, records, previous=()):
+        """Called after each write with the records it touched, and, on
+        UPDATE, with the records they replaced"""
+        if not records:
+            return
+
+        if self._identity_map is not None:
+            self._identity_map.invalidate(records)
+
+        for index in self._search_index, self._reverse_index:
+            if index is None:
+                continue
+            if op == UPDATE:
+                index.remove(previous)
+                index.add(records)
+            elif op == INSERT:
+                index.add(records)
+            else:
+                index.remove(records)
+
+        if op == DELETE:
+            for table in self._join_tables.values():
+                for record in records:
+                    table.remove(self._record_pk(record))
+
+        if self._changelog is not None:
+            self._changelog.append(op, [self._record_pk(r) for r in records])
+
+    def _read_records(self, strict=False):
+        """Returns the stored records as they were decoded from the
+        storage file, still in their {verbose_name: {...}} form.
+
+        When strict is True, a damaged storage file raises
+        StorageCorruptedError instead of being read as empty (or, with
+        Meta.checksums, as its valid records only), so that writes never
+        overwrite the data that could still be recovered."""
         if not os.path.exists(self._fullpath):
-            f = codecs.open(self._fullpath, 'w', 'utf-8')
-            f.write('')
-            f.close()
+            return []
+
+        return self._decode_file(strict)
+
+    def _corrupted(self, reason):
+        return StorageCorruptedError('The storage file %s is damaged (%s), use '
+                                     '%s.objects.recover() to keep its valid records' % \
+                                     (self._fullpath, reason, self.model.__name__))
+
+    def _decode_file(self, strict=False):
+        if self.model._meta.checksums:
+            return self._decode_lines(strict)
 
         fobj = codecs.open(self._fullpath, 'r', 'utf-8')
         json = fobj.read()
         fobj.close()
+        self._count('bytes_read', len(json.encode('utf-8')))
 
         try:
-            modelset = ModelSetClass.deserialize(json, 'json')
-        except ValueError:
-            modelset = ModelSetClass()
+            data = Registry.get('json').deserialize(json)
+        except ValueError, e:
+            if strict and json.strip():
+                raise self._corrupted(e)
+            return []
+
+        records = data[self.model._meta.verbose_name_plural]
+        self._count('records_scanned', len(records))
+        return records
+
+    def _decode_lines(self, strict=False):
+        report = VerifyReport(self._fullpath)
+        plural = self.model._meta.verbose_name_plural
+        records = list(iter_records(self._fullpath, plural, report))
+        if strict and not report.ok:
+            number, reason = report.errors[0]
+            raise self._corrupted('line %d: %s' % (number, reason))
+
+        self._count('bytes_read', os.stat(self._fullpath).st_size)
+        self._count('records_scanned', len(records))
+        return records
+
+    def _write_records(self, records):
+        plural = self.model._meta.verbose_name_plural
+        if self.model._meta.checksums:
+            return self._write_lines(encode_records(plural, records))
+
+        trusted = self._keeps_trust()
+        data = {plural: records}
+        json = Registry.get('json')(data).serialize()
+        fobj = codecs.open(self._fullpath, 'w', 'utf-8')
+        fobj.write(json)
+        fobj.close()
+        self._count('bytes_written', len(json.encode('utf-8')))
+        self._stamp_schema(trusted)
+
+    def _write_lines(self, lines):
+        # written aside and renamed, so that readers never see a
+        # half-written storage file
+        trusted = self._keeps_trust()
+        temporary = self._fullpath + '.tmp'
+        fobj = codecs.open(temporary, 'w', 'utf-8')
+        try:
+            for line in lines:
+                fobj.write(line)
+        finally:
+            fobj.close()
+
+        os.rename(temporary, self._fullpath)
+        self._count('bytes_written', os.stat(self._fullpath).st_size)
+        self._stamp_schema(trusted)
+
+    def _keeps_trust(self):
+        """Called before writing the storage file: the records already
+        there are written back, so the file can only be trusted after
+        the write when it was trusted (or empty) before it"""
+        if self._schema_stamp is None:
+            return False
+        if not os.path.exists(self._fullpath) or not os.path.getsize(self._fullpath):
+            return True
+        return self._schema_stamp.matches(self._fullpath)
+
+    def _stamp_schema(self, trusted):
+        """Called after each write of the storage file, so that the next
+        reads can trust it, see _is_trusted"""
+        if trusted:
+            self._schema_stamp.write(self._fullpath)
+
+    def _is_trusted(self):
+        """With Meta.trusted_load, the records of a storage file last
+        written by this same model definition are loaded without being
+        validated again, only converted"""
+        return self._schema_stamp is not None and \
+               self._schema_stamp.matches(self._fullpath)
+
+    def _builder(self):
+        """Returns the function that builds model instances from records"""
+        trusted = self._is_trusted()
+        if self._identity_map is not None:
+            return lambda record: self._identity_map.load(record, trusted)
+        return lambda record: self.model.from_dict(record, trusted)
+
+    def _load(self, records):
+        SetClass = self.model.Set()
+        build = self._builder()
+
+        if self._has_ttl:
+            now = self._clock()
+            records = [r for r in records if not self._is_expired(r, now)]
+
+        return SetClass(*[build(r) for r in records])
+
+    def _is_expired(self, record, now):
+        expires = record.get('__expires__')
+        if expires is not None and expires <= now:
+            return True
+
+        if self._ttl_field is not None:
+            value = record[self.model._meta.verbose_name].get(self._ttl_field)
+            if value:
+                field = self.model._meta._fields[self._ttl_field]
+                value = field.convert_type(value)
+                moment = datetime.fromtimestamp(now)
+                if not isinstance(value, datetime):
+                    moment = moment.date()
+                return value <= moment
+
+        return False
+
+    def _sweep(self, records):
+        """Drops the expired records, logging them as deleted. Used by
+        every write, so that expired records get purged in the same pass
+        that rewrites the storage file"""
+        if not self._has_ttl:
+            return records
+
+        now = self._clock()
+        alive = []
+        expired = []
+        for record in records:
+            if self._is_expired(record, now):
+                expired.append(record)
+            else:
+                alive.append(record)
+
+        self._notify(DELETE, expired)
+        return alive
+
+    def _stamp_expiry(self, model):
+        """Returns the record to be stored for the given model,
+        stamped with its expiration when Meta.ttl_seconds is set"""
+        if self._ttl_seconds is None:
+            return model.to_dict()
+
+        expires = self._clock() + self._ttl_seconds
+        if self._ttl_field is None:
+            record = model.to_dict()
+            record['__expires__'] = expires
+            return record
+
+        if getattr(model, self._ttl_field) is None:
+            setattr(model, self._ttl_field, datetime.fromtimestamp(int(expires)))
+
+        return model.to_dict()
+
+    def _stamp_records(self, records):
+        """Same as _stamp_expiry, for records that were not built from
+        model instances, like the ones loaded by the bulk importer"""
+        if self._ttl_seconds is None:
+            return
+
+        expires = self._clock() + self._ttl_seconds
+        verbose_name = self.model._meta.verbose_name
+        for record in records:
+            if self._ttl_field is None:
+                record['__expires__'] = expires
+                continue
+
+            data = record[verbose_name]
+            if data.get(self._ttl_field) is None:
+                field = self.model._meta._fields[self._ttl_field]
+                data[self._ttl_field] = field.serialize(datetime.fromtimestamp(int(expires)))
+
+    def _append_records(self, records):
+        """Stores many records at once. Files written with Meta.checksums
+        get the new lines appended in place, the others are rewritten a
+        single time (the checksummed ones still holding a single json
+        document get the line layout on the way)"""
+        self._stamp_records(records)
+        if not os.path.exists(self._fullpath) or not os.path.getsize(self._fullpath):
+            self._write_records(records)
+        elif self.model._meta.checksums and self._has_line_layout():
+            self._append_lines(records)
+        else:
+            stored = self._sweep(self._decode_file(strict=True))
+            self._write_records(stored + records)
+
+        self._notify(INSERT, records)
+
+    def _has_line_layout(self):
+        """True when the storage file starts as the files written one
+        record per line do, see integrity.iter_records"""
+        header = (u'{%s:[' % demjson.encode(self.model._meta.verbose_name_plural)).encode('utf-8')
+        fobj = open(self._fullpath, 'rb')
+        try:
+            first = fobj.readline()
+        finally:
+            fobj.close()
 
-        modelset.add(model)
+        return first.rstrip() == header
 
-        fobj = codecs.open(self._fullpath, 'w', 'utf-8')
+    def _append_lines(self, records):
+        plural = self.model._meta.verbose_name_plural
+        header = (u'{%s:[\n' % demjson.encode(plural)).encode('utf-8')
+        closing = ']}\n'
 
-        fobj.write(modelset.serialize('json'))
-        fobj.close()
+        trusted = self._keeps_trust()
+        fobj = open(self._fullpath, 'r+b')
+        try:
+            fobj.seek(0, 2)
+            size = fobj.tell()
+            fobj.seek(max(size - len(closing) - 1, 0))
+            if size < len(header) + len(closing) or fobj.read() != '\n' + closing:
+                raise self._corrupted('truncated file')
+
+            # the last stored record gets the comma it needs to be
+            # followed by the new ones
+            if size == len(header) + len(closing):
+                fobj.seek(size - len(closing))
+                lines = []
+            else:
+                fobj.seek(size - len(closing) - 1)
+                lines = [',\n']
+
+            encoded = [encode_record(r).encode('utf-8') for r in records]
+            lines.append(',\n'.join(encoded))
+            lines.append('\n' + closing)
+            data = ''.join(lines)
+            fobj.write(data)
+            fobj.truncate()
+        finally:
+            fobj.close()
+
+        self._count('bytes_written', len(data))
+        self._stamp_schema(trusted)
 
+    @property
+    def version(self):
+        """The current version of the change log, 0 when nothing was
+        written yet"""
+        return self._get_changelog().version
+
+    def _get_changelog(self):
+        if self._changelog is None:
+            raise TypeError('%s does not keep a change log, set '
+                            '"changelog = True" in its Meta class' % self.model.__name__)
+        return self._changelog
+
+    def watch(self, since=0, callback=None):
+        """Returns the changes written after the version "since", as a
+        list of changelog.Change objects, oldest first.
+
+        When a callback is given, it is called with each change and
+        the latest version seen is returned instead, so that it can be
+        used as "since" in the next call."""
+        changes = self._get_changelog().since(since)
+        if callback is None:
+            return changes
+
+        for change in changes:
+            callback(change)
+            since = change.version
+
+        return since
+
+    def create(self, **kw):
+        model = self.model(**kw)
+        return self.add(model)
+
+    def _check_urls(self, models, names=None):
+        """Checks, all at once, the urls of the URLFields declared with
+        deferred=True, which were not checked when they were set (only
+        those of the given field names, when given)"""
+        for name, field in self.model._meta._fields.items():
+            if names is not None and name not in names:
+                continue
+            if isinstance(field, URLField) and field.deferred:
+                missing = field.missing([getattr(m, name) for m in models])
+                if missing:
+                    raise FieldValidationError('On field %r: the urls %s do not exist' % \
+                                               (name, ", ".join(missing)))
+
+    @measured('add')
+    def add(self, model):
+        if not isinstance(model, self.model):
+            raise TypeError('add() takes a %s as parameter, got %r' % (self.model.__name__, model))
+
+        self._check_urls([model])
+
+        if not os.path.exists(self._fullpath):
+            f = codecs.open(self._fullpath, 'w', 'utf-8')
+            f.write('')
+            f.close()
+
+        records = self._sweep(self._decode_file(strict=True))
+        record = self._stamp_expiry(model)
+        records.append(record)
+        self._write_records(records)
+        self._save_join_tables(model, record)
+        model._clear_changes()
+
+        self._notify(INSERT, [record])
+        self._count('records_returned', 1)
         return model
 
+    @measured('add_many')
+    def add_many(self, models):
+        """Stores many model instances with a single write, returning
+        them. The urls of deferred URLFields are checked concurrently"""
+        models = list(models)
+        for model in models:
+            if not isinstance(model, self.model):
+                raise TypeError('add_many() takes %s instances, got %r' % (self.model.__name__, model))
+
+        self._check_urls(models)
+        records = [self._stamp_expiry(m) for m in models]
+        if records:
+            self._append_records(records)
+        for model, record in zip(models, records):
+            self._save_join_tables(model, record)
+            model._clear_changes()
+
+        self._count('records_returned', len(models))
+        return models
+
+    @measured('update')
+    def update(self, model):
+        """Writes the fields of a stored model instance that changed
+        since it was loaded (or stored), see Model.changed_fields,
+        leaving the rest of its record as it is. The objects of the
+        join_table relationships set again replace those in the join
+        table. Returns the names of the fields written.
+
+        The stored record is the one with the primary key of the
+        instance, raising ValueError when there is none. Instances whose
+        primary key was set since they were loaded (or stored), new
+        ones included, raise TypeError, as their record can not be told
+        for sure"""
+        if not isinstance(model, self.model):
+            raise TypeError('update() takes a %s as parameter, got %r' % (self.model.__name__, model))
+
+        if not self.model._meta.has_pk:
+            raise TypeError('update() needs %s to have at least one primary_key' % self.model.__name__)
+
+        fields = self.model._meta._fields
+        changed = model.changed_fields()
+        for name in changed:
+            if name in fields and fields[name].primary_key:
+                raise TypeError('the primary key %r of %r was set after it was '
+                                'loaded, it can not be updated' % (name, model))
+
+        if not changed:
+            return []
+
+        self._check_urls([model], changed)
+        verbose_name = self.model._meta.verbose_name
+        data = model._get_data()
+        pk = self._record_pk({verbose_name: data})
+
+        records = self._sweep(self._read_records(strict=True))
+        for index, record in enumerate(records):
+            if self._record_pk(record) == pk:
+                break
+        else:
+            raise ValueError('there is no stored %s with the primary key %r' % \
+                             (self.model.__name__, pk))
+
+        updated = dict(record)
+        stored = updated[verbose_name] = dict(record[verbose_name])
+        written = [n for n in changed if n not in self._join_tables]
+        for name in written:
+            if name in data:
+                stored[name] = data[name]
+            else:
+                stored.pop(name, None)
+
+        if written:
+            records[index] = updated
+            self._write_records(records)
+
+        # the pairs of the join tables set again are replaced
+        for name in changed:
+            value = model.__dict__.get(name)
+            if name in self._join_tables and value is not None and not hasattr(value, 'table'):
+                self._join_tables[name].remove(self._record_pk(record))
+        self._save_join_tables(model, updated)
+        model._clear_changes()
+
+        if written:
+            self._notify(UPDATE, [updated], previous=[record])
+        return changed
+
+    def _save_join_tables(self, model, record):
+        """Moves the objects set in the join_table relationships of a
+        model that was just stored into their join tables"""
+        for name, table in self._join_tables.items():
+            value = model.__dict__.get(name)
+            if value is None or hasattr(value, 'table'):
+                continue
+
+            relationship = self.model._meta._relationships[name]
+            instances = getattr(value, 'objects', value)
+            table.add(self._record_pk(record), [relationship.reference_for(i) for i in instances])
+            # the attribute goes back to the JoinTableRelation
+            del model.__dict__[name]
+
+    def load_csv(self, path, mapping=None, batch_size=1000, delimiter=','):
+        """Imports the rows of a utf-8 csv file, whose first row names
+        the columns. The mapping translates the column names into field
+        names, when they differ (e.g. {'Full Name': 'name'}).
+
+        Rows are validated and stored in batches of batch_size rows,
+        the invalid ones are skipped and reported in the returned
+        importer.ImportReport.
+
+        Each batch is appended in place to the storage files written
+        with Meta.checksums. The other ones are a single json document,
+        written again whole for every batch, so the import gets slower
+        as the table grows: large imports should go to Meta.checksums
+        models, or use a batch_size as large as the memory allows"""
+        importer = BulkImporter(self, batch_size)
+        return importer.load(read_csv(path, mapping, delimiter))
+
+    def load_jsonl(self, path, batch_size=1000):
+        """Imports a file with one json object per line, the same way
+        as load_csv"""
+        importer = BulkImporter(self, batch_size)
+        return importer.load(read_jsonl(path, self.model._meta.verbose_name))
+
+    @measured('filter')
     def filter(self, **params):
         for key in params.keys():
             if not key in self.model._meta._fields.keys():
@@ -101,42 +670,319 @@ class FileObjectsManager(ObjectsManager):
                 if getattr(obj, k) == v:
                     modelset.add(obj)
 
+        self._count('records_returned', len(modelset))
         return modelset
 
-    def all(self):
-        ModelSetClass = self.model.Set()
-        if not os.path.exists(self._fullpath):
-            return ModelSetClass()
-
-        fobj = codecs.open(self._fullpath, 'r', 'utf-8')
-        json = fobj.read()
-        fobj.close()
-
-        try:
-            modelset = ModelSetClass.deserialize(json, 'json')
-        except ValueError:
-            modelset = ModelSetClass()
-
-        return modelset
-
+    @measured('all')
+    def all(self, columnar=False):
+        """Returns all the stored objects, in a ColumnarSet when
+        columnar is True, without building any model instance"""
+        if not columnar:
+            if self._schema_stamp is None or self._has_ttl or self._is_trusted():
+                ret = self._load(self._read_records())
+                self._count('records_returned', len(ret))
+                return ret
+
+            # every record gets validated here, so the file can be trusted
+            # from now on, unless it was changed in the meantime
+            before = self._schema_stamp.storage_stamp(self._fullpath)
+            ret = self._load(self._read_records())
+            if before is not None and before == self._schema_stamp.storage_stamp(self._fullpath):
+                self._schema_stamp.write(self._fullpath)
+            self._count('records_returned', len(ret))
+            return ret
+
+        records = self._read_records()
+        if self._has_ttl:
+            now = self._clock()
+            records = [r for r in records if not self._is_expired(r, now)]
+
+        verbose_name = self.model._meta.verbose_name
+        ret = self.model.ColumnarSet()()
+        for record in records:
+            ret.append_record(record[verbose_name])
+        self._count('records_returned', len(records))
+        return ret
+
+    @measured('get')
     def get(self, **params):
         modelset = self.filter(**params)
+        self._count('records_returned', min(len(modelset), 1))
         return modelset and modelset[0] or None
 
+    @measured('in_bulk')
+    def in_bulk(self, pks):
+        """Takes a list of {primary key name: value} dicts, returning the
+        stored instances having them, found in a single pass, as a dict
+        keyed by base.pk_key(pk)"""
+        if not self.model._meta.has_pk:
+            raise TypeError('in_bulk() needs %s to have at least one primary_key' % self.model.__name__)
+
+        build = self._builder()
+        now = self._clock()
+        found = {}
+        for key, record in self._find_records(pks).items():
+            if self._has_ttl and self._is_expired(record, now):
+                continue
+            found[key] = build(record)
+
+        self._count('records_returned', len(found))
+        return found
+
+    def _find_records(self, pks):
+        """Returns the stored records having the given {primary key
+        name: value} dicts, in a dict keyed by their sorted (name,
+        value) tuples.
+
+        Files written with Meta.checksums are read line by line, only
+        the lines holding one of the wanted values of the first primary
+        key field get decoded. The other storage files are a single json
+        document, which has to be decoded whole"""
+        wanted = set([tuple(sorted(pk.items())) for pk in pks])
+        if not wanted or not os.path.exists(self._fullpath):
+            return {}
+
+        meta = self.model._meta
+        if meta.checksums:
+            records = iter_records(self._fullpath, meta.verbose_name_plural,
+                                   candidate=self._pk_candidate(wanted))
+            self._count('bytes_read', os.stat(self._fullpath).st_size)
+        else:
+            records = self._decode_file()
+
+        found = {}
+        for record in records:
+            self._count('records_scanned', 1)
+            data = record[meta.verbose_name]
+            key = tuple(sorted([(k, data.get(k)) for k in meta._pk_names]))
+            if key in wanted:
+                found[key] = record
+
+        return found
+
+    def _pk_candidate(self, wanted):
+        """Returns the iter_records candidate filter for the lines
+        holding one of the wanted values of the first primary key field,
+        as they are encoded in the line (a line may hold other records,
+        the related ones, so it is just a candidate)"""
+        name = self.model._meta._pk_names[0]
+        values = set([dict(key)[name] for key in wanted])
+        if None in values:
+            # not stored at all, every line has to be checked
+            return None
+
+        encoded = set([demjson.encode(v) for v in values])
+        regex = re.compile(r'"%s":("(?:[^"\\]|\\.)*"|[^,}\]]*)' % re.escape(name))
+        return lambda line: bool([v for v in regex.findall(line) if v in encoded])
+
+    @measured('referrers')
+    def referrers(self, instance):
+        """Returns the stored objects having a relationship pointing to
+        the given instance. With Meta.reverse_index only the records
+        found in the index are checked, otherwise all of them are"""
+        relationships = self.model._meta._relationships
+        names = [k for k, r in relationships.items() if isinstance(instance, r.to_model)]
+        if not names:
+            raise TypeError('%s has no relationship to %r' % (self.model.__name__, instance))
+
+        target = relationships[names[0]].reference_for(instance)
+        verbose_name = self.model._meta.verbose_name
+        pk_names = self.model._meta._pk_names
+        def key_for(record):
+            return tuple(sorted([(k, record[verbose_name].get(k)) for k in pk_names]))
+
+        joined = []
+        for name in names:
+            if name in self._join_tables:
+                joined.extend(self._join_tables[name].referrers(target))
+
+        if self._reverse_index is not None:
+            if not self._reverse_index.exists:
+                records = self._read_records()
+                if records:
+                    self._reverse_index.rebuild(records)
+
+            # only the records found in the index are read
+            pks = self._reverse_index.lookup(names, target)
+            pks.extend([pk for pk in joined if pk not in pks])
+            found = self._find_records(pks)
+            keys = [tuple(sorted(pk.items())) for pk in pks]
+            ret = self._load([found[k] for k in keys if k in found])
+            self._count('records_returned', len(ret))
+            return ret
+
+        records = self._read_records()
+        joined = set([tuple(sorted(pk.items())) for pk in joined])
+        def points_to_target(record):
+            if joined and key_for(record) in joined:
+                return True
+
+            data = record[verbose_name]
+            for name in names:
+                if target in relationships[name].stored_pks(data.get(name)):
+                    return True
+            return False
+
+        ret = self._load([r for r in records if points_to_target(r)])
+        self._count('records_returned', len(ret))
+        return ret
+
+    @measured('delete')
     def delete(self, obj):
         if not isinstance(obj, self.model):
             raise TypeError('delete() takes a %s as parameter, got %r' % (self.model.__name__, obj))
 
-        modelset = self.all()
-        newset = self.model.Set()()
-
-        for model in modelset:
-            if model.to_dict() != obj.to_dict():
-                newset.add(model)
-
-        f = codecs.open(self._fullpath, 'w', 'utf-8')
-        f.write(newset.serialize('json'))
-        f.close()
+        records = self._sweep(self._read_records(strict=True))
+        kept = []
+        deleted = []
+
+        # the stored records are compared as they are, without building
+        # instances: by primary key, or all of their data when there is
+        # no primary key
+        verbose_name = self.model._meta.verbose_name
+        target = obj._get_data()
+        if self.model._meta.has_pk:
+            key = self._record_pk
+            target = key({verbose_name: target})
+        else:
+            key = lambda record: record[verbose_name]
+
+        for record in records:
+            if key(record) != target:
+                kept.append(record)
+            else:
+                deleted.append(record)
+
+        self._write_records(kept)
+        self._notify(DELETE, deleted)
+
+    @measured('purge')
+    def purge(self):
+        """Removes the expired records from the storage file in a
+        single rewrite, returning how many were removed"""
+        records = self._read_records(strict=True)
+        alive = self._sweep(records)
+        if len(alive) != len(records):
+            self._write_records(alive)
+
+        return len(records) - len(alive)
+
+    def iterate(self, raw=False):
+        """Yields the stored model instances (or the raw records, when
+        raw is True) one at a time, skipping the expired ones. Files
+        written with Meta.checksums are read line by line, in bounded
+        memory"""
+        if not os.path.exists(self._fullpath):
+            return
+
+        build = self._builder()
+        now = self._clock()
+        plural = self.model._meta.verbose_name_plural
+        for record in iter_records(self._fullpath, plural):
+            if self._has_ttl and self._is_expired(record, now):
+                continue
+            yield raw and record or build(record)
+
+    @measured('compact')
+    def compact(self):
+        """Rewrites the storage file in a single pass, dropping the
+        expired records. Returns the number of records before and after
+        the compaction"""
+        if not os.path.exists(self._fullpath):
+            return (0, 0)
+
+        if not self.model._meta.checksums:
+            records = self._read_records(strict=True)
+            alive = self._sweep(records)
+            self._write_records(alive)
+            return (len(records), len(alive))
+
+        report = self.verify()
+        if not report.ok:
+            number, reason = report.errors[0]
+            raise self._corrupted('line %d: %s' % (number, reason))
+
+        now = self._clock()
+        plural = self.model._meta.verbose_name_plural
+        expired = []
+        def alive():
+            for record in iter_records(self._fullpath, plural):
+                if self._has_ttl and self._is_expired(record, now):
+                    expired.append(record)
+                else:
+                    yield record
+
+        self._write_lines(encode_records(plural, alive()))
+        self._notify(DELETE, expired)
+        return (report.valid, report.valid - len(expired))
+
+    @measured('search')
+    def search(self, query, operator='and'):
+        """Full-text search over the Meta.search_fields, returning the
+        records having all (operator="and") or any (operator="or") of
+        the words in the query, the most frequent matches first"""
+        if self._search_index is None:
+            raise TypeError('%s can not be searched, declare the fields to be '
+                            'indexed in its Meta.search_fields' % self.model.__name__)
+
+        if not self._search_index.exists:
+            records = self._read_records()
+            if records:
+                self._search_index.rebuild(records)
+
+        # only the records found in the index are read
+        names = self._search_index.pk_names
+        pks = [dict(zip(names, demjson.decode(key))) for key, score in \
+               self._search_index.search(query, operator)]
+        found = self._find_records(pks)
+        keys = [tuple(sorted(pk.items())) for pk in pks]
+        ret = self._load([found[k] for k in keys if k in found])
+        self._count('records_returned', len(ret))
+        return ret
+
+    def reindex(self):
+        """Rebuilds the sidecar indexes from the stored records,
+        returning how many records were indexed"""
+        records = self._read_records()
+        if self._search_index is not None:
+            self._search_index.rebuild(records)
+        if self._reverse_index is not None:
+            self._reverse_index.rebuild(records)
+
+        return len(records)
+
+    def verify(self):
+        """Checks the storage file record by record, returning a
+        integrity.VerifyReport with the damaged lines"""
+        report = VerifyReport(self._fullpath)
+        if os.path.exists(self._fullpath):
+            plural = self.model._meta.verbose_name_plural
+            for record in iter_records(self._fullpath, plural, report):
+                pass
+
+        return report
+
+    def recover(self):
+        """Rewrites the storage file keeping only its valid records,
+        returning the integrity.VerifyReport of what was dropped"""
+        report = VerifyReport(self._fullpath)
+        if not os.path.exists(self._fullpath):
+            return report
+
+        plural = self.model._meta.verbose_name_plural
+        records = list(iter_records(self._fullpath, plural, report))
+        if not report.ok:
+            # the damaged file is kept aside for a closer look
+            shutil.copyfile(self._fullpath, self._fullpath + '.damaged')
+            self._write_records(records)
+            if self._identity_map is not None:
+                self._identity_map.clear()
+            if self._search_index is not None:
+                self._search_index.rebuild(records)
+            if self._reverse_index is not None:
+                self._reverse_index.rebuild(records)
+
+        return report
 
 class FileSystemModelManager(ModelManager):
     manager = FileObjectsManager
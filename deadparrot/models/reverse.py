@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# -*- coding: utf-8; -*-
+#
+# Copyright (C) 2009 Gabriel Falcão <gabriel@nacaolivre.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public
+# License along with this program; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+import os
+import codecs
+
+from deadparrot.lib import demjson
+
+__all__ = ['ReverseIndex', 'key_for']
+
+def key_for(pk):
+    """Returns the json string that stands for a {primary key name:
+    value} dict in the index"""
+    return demjson.encode(sorted([[k, v] for k, v in pk.items()]))
+
+class ReverseIndex(object):
+    """Index of the objects each record of a model points to:
+    {relationship name: {related object key: [record primary keys]}}.
+
+    The index is kept in a file next to the model storage, and
+    reloaded whenever another process changes it."""
+
+    def __init__(self, model, path):
+        meta = model._meta
+        if not meta.has_pk:
+            raise TypeError('%s needs at least one primary_key to '
+                            'use a reverse_index' % model.__name__)
+
+        self.model = model
+        self.path = path
+        self.pk_names = [k for k, f in meta._fields.items() if f.primary_key]
+        self._relations = {}
+        self._stamp = None
+
+    @property
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def references(self, record):
+        """Returns a list of (relationship name, related object key,
+        record primary key) tuples"""
+        data = record[self.model._meta.verbose_name]
+        pk = dict([(k, data.get(k)) for k in self.pk_names])
+        ret = []
+        for name, relationship in self.model._meta._relationships.items():
+            for related in relationship.stored_pks(data.get(name)):
+                ret.append((name, key_for(related), pk))
+        return ret
+
+    def _get_stamp(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return (st.st_mtime, st.st_size)
+
+    def _load(self):
+        stamp = self._get_stamp()
+        if stamp == self._stamp:
+            return self._relations
+
+        self._relations = {}
+        if stamp is not None:
+            fobj = codecs.open(self.path, 'r', 'utf-8')
+            try:
+                self._relations = demjson.decode(fobj.read())
+            finally:
+                fobj.close()
+
+        self._stamp = stamp
+        return self._relations
+
+    def _save(self):
+        fobj = codecs.open(self.path, 'w', 'utf-8')
+        fobj.write(demjson.encode(self._relations))
+        fobj.close()
+        self._stamp = self._get_stamp()
+
+    def add(self, records):
+        relations = self._load()
+        for record in records:
+            for name, key, pk in self.references(record):
+                referrers = relations.setdefault(name, {}).setdefault(key, [])
+                if pk not in referrers:
+                    referrers.append(pk)
+        self._save()
+
+    def remove(self, records):
+        relations = self._load()
+        for record in records:
+            for name, key, pk in self.references(record):
+                referrers = relations.get(name, {}).get(key, [])
+                if pk in referrers:
+                    referrers.remove(pk)
+                if not referrers:
+                    relations.get(name, {}).pop(key, None)
+        self._save()
+
+    def rebuild(self, records):
+        self._relations = {}
+        self.add(records)
+
+    def lookup(self, names, pk):
+        """Returns the primary keys of the records pointing to the
+        object with the given primary key through any of the given
+        relationships"""
+        relations = self._load()
+        key = key_for(pk)
+        ret = []
+        for name in names:
+            for referrer in relations.get(name, {}).get(key, []):
+                if referrer not in ret:
+                    ret.append(referrer)
+        return ret
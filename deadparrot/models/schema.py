@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding: utf-8; -*-
+#
+# Copyright (C) 2009 Gabriel Falcão <gabriel@nacaolivre.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public
+# License along with this program; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+import os
+import codecs
+import hashlib
+
+from deadparrot.lib import demjson
+
+__all__ = ['fingerprint', 'SchemaStamp']
+
+# the field options that make it into the fingerprint, the others
+# (e.g. compiled regexes) would not be the same from run to run
+SIMPLE_TYPES = (basestring, int, long, float, bool, type(None), list, tuple, type)
+
+def describe(field):
+    return repr(sorted([(k, v) for k, v in vars(field).items() \
+                        if isinstance(v, SIMPLE_TYPES)]))
+
+def fingerprint(model):
+    """Returns a hash of everything that decides how the records of a
+    model are validated and converted: its fields, with their options,
+    its relationships and its fields_validation_policy"""
+    meta = model._meta
+    parts = [repr(meta.fields_validation_policy)]
+    for name, field in sorted(meta._fields.items()):
+        parts.append('%s:%s:%s' % (name, field.__class__.__name__, describe(field)))
+
+    for name, relationship in sorted(meta._relationships.items()):
+        parts.append('%s:%s:%s' % (name, relationship.__class__.__name__,
+                                   relationship.to_model.__name__))
+
+    return hashlib.sha1("\n".join(parts)).hexdigest()
+
+class SchemaStamp(object):
+    """Kept next to the storage of a model, tells the fingerprint of
+    the model that wrote the storage file last, along with the
+    modification time and size the file had right after that write.
+
+    A storage file changed in any other way (e.g. edited by hand, or
+    written by a model not keeping the stamp) no longer matches it."""
+
+    def __init__(self, path, fingerprint):
+        self.path = path
+        self.fingerprint = fingerprint
+
+    def storage_stamp(self, storage_path):
+        """The modification time and size of the storage file"""
+        try:
+            st = os.stat(storage_path)
+        except OSError:
+            return None
+        return [repr(st.st_mtime), st.st_size]
+
+    def write(self, storage_path):
+        data = {'fingerprint': self.fingerprint,
+                'storage': self.storage_stamp(storage_path)}
+        fobj = codecs.open(self.path, 'w', 'utf-8')
+        fobj.write(demjson.encode(data))
+        fobj.close()
+
+    def read(self):
+        if not os.path.exists(self.path):
+            return None
+
+        fobj = codecs.open(self.path, 'r', 'utf-8')
+        try:
+            try:
+                data = demjson.decode(fobj.read())
+            except ValueError:
+                return None
+        finally:
+            fobj.close()
+
+        return isinstance(data, dict) and data or None
+
+    def matches(self, storage_path):
+        """True when the storage file was last written by a model with
+        this same fingerprint"""
+        data = self.read()
+        if data is None or data.get('fingerprint') != self.fingerprint:
+            return False
+
+        current = self.storage_stamp(storage_path)
+        return current is not None and data.get('storage') == current
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# -*- coding: utf-8; -*-
+#
+# Copyright (C) 2009 Gabriel Falcão <gabriel@nacaolivre.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public
+# License along with this program; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+import os
+import re
+import codecs
+
+from deadparrot.lib import demjson
+from deadparrot.models.fields import CharField, TextField, DateTimeField
+
+__all__ = ['SearchIndex', 'tokenize']
+
+word_regex = re.compile(r'\w+', re.UNICODE)
+
+def tokenize(text):
+    return word_regex.findall(unicode(text).lower())
+
+class SearchIndex(object):
+    """Inverted index of the words found in the Meta.search_fields of a
+    model: {term: {record key: term frequency}}, where the record key
+    is the json-encoded list of the record primary key values.
+
+    The index is kept in a file next to the model storage, and
+    reloaded whenever another process changes it. Each add() and
+    remove() writes the whole index file again, so every write to the
+    storage costs the size of the index too: records imported in bulk
+    are indexed once per batch, and large tables are better indexed
+    at once with rebuild()."""
+
+    def __init__(self, model, path):
+        meta = model._meta
+        if not meta.has_pk:
+            raise TypeError('%s needs at least one primary_key to '
+                            'use search_fields' % model.__name__)
+
+        for name in meta.search_fields:
+            field = meta._fields.get(name)
+            if not isinstance(field, (CharField, TextField)) or \
+               isinstance(field, DateTimeField):
+                raise TypeError('%s.Meta.search_fields should have only names of '
+                                'CharField or TextField fields, got %r' % (model.__name__, name))
+
+        self.model = model
+        self.path = path
+        self.fields = list(meta.search_fields)
+        self.pk_names = sorted([k for k, f in meta._fields.items() if f.primary_key])
+        self._terms = {}
+        self._stamp = None
+
+    @property
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def key_for(self, record):
+        data = record[self.model._meta.verbose_name]
+        return demjson.encode([data.get(k) for k in self.pk_names])
+
+    def frequencies(self, record):
+        data = record[self.model._meta.verbose_name]
+        ret = {}
+        for name in self.fields:
+            value = data.get(name)
+            if value:
+                for term in tokenize(value):
+                    ret[term] = ret.get(term, 0) + 1
+        return ret
+
+    def _get_stamp(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return (st.st_mtime, st.st_size)
+
+    def _load(self):
+        stamp = self._get_stamp()
+        if stamp == self._stamp:
+            return self._terms
+
+        self._terms = {}
+        if stamp is not None:
+            fobj = codecs.open(self.path, 'r', 'utf-8')
+            try:
+                self._terms = demjson.decode(fobj.read())
+            finally:
+                fobj.close()
+
+        self._stamp = stamp
+        return self._terms
+
+    def _save(self):
+        fobj = codecs.open(self.path, 'w', 'utf-8')
+        fobj.write(demjson.encode(self._terms))
+        fobj.close()
+        self._stamp = self._get_stamp()
+
+    def add(self, records):
+        terms = self._load()
+        for record in records:
+            key = self.key_for(record)
+            for term, count in self.frequencies(record).items():
+                postings = terms.setdefault(term, {})
+                postings[key] = postings.get(key, 0) + count
+        self._save()
+
+    def remove(self, records):
+        terms = self._load()
+        for record in records:
+            key = self.key_for(record)
+            for term in self.frequencies(record).keys():
+                postings = terms.get(term, {})
+                postings.pop(key, None)
+                if not postings:
+                    terms.pop(term, None)
+        self._save()
+
+    def rebuild(self, records):
+        self._terms = {}
+        self.add(records)
+
+    def search(self, query, operator='and'):
+        """Returns a list of (record key, score) tuples, best scores
+        first (then ordered by record key). The score is the sum of the
+        query terms frequencies in the record"""
+        if operator not in ('and', 'or'):
+            raise TypeError('search() operator should be "and" or "or", got %r' % operator)
+
+        words = tokenize(query)
+        if not words:
+            return []
+
+        terms = self._load()
+        postings = [terms.get(word, {}) for word in words]
+        keys = set(postings[0])
+        for posting in postings[1:]:
+            if operator == 'and':
+                keys &= set(posting)
+            else:
+                keys |= set(posting)
+
+        scores = [(key, sum([p.get(key, 0) for p in postings])) for key in keys]
+        # equal scores are ordered by key, the same from run to run
+        scores.sort(key=lambda item: (-item[1], item[0]))
+        return scores
@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+# -*- coding: utf-8; -*-
+#
+# Copyright (C) 2009 Gabriel Falcão <gabriel@nacaolivre.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public
+# License along with this program; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+import errno
+import socket
+import httplib
+import urlparse
+import threading
+
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+from time import time as timestamp
+
+__all__ = ['URLExistenceService', 'service']
+
+# the errors a request is sent again after, on a new connection
+RETRIABLE_ERRNOS = (errno.ECONNRESET, errno.ECONNREFUSED, errno.ECONNABORTED, errno.EPIPE)
+
+class URLExistenceService(object):
+    """Tells whether urls exist, for the URLFields declared with
+    verify_exists=True.
+
+    Urls are checked with HEAD requests, keeping one connection per
+    host (and thread) open for the next requests. The results are
+    cached for "ttl" seconds, up to "max_size" urls, dropping the least
+    recently used ones first. Many urls can be checked at once by a
+    pool of "workers" threads."""
+
+    def __init__(self, timeout=10, ttl=300, max_size=1024, workers=8):
+        self.timeout = timeout
+        self.ttl = ttl
+        self.max_size = max_size
+        self.workers = workers
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._pool = None
+
+    def _clock(self):
+        return timestamp()
+
+    def cached(self, url):
+        """Returns the cached result for the url, None when there is none"""
+        self._lock.acquire()
+        try:
+            entry = self._cache.pop(url, None)
+            if entry is None or entry[0] <= self._clock():
+                return None
+
+            # back to the end, as the most recently used
+            self._cache[url] = entry
+            return entry[1]
+        finally:
+            self._lock.release()
+
+    def remember(self, url, exists):
+        self._lock.acquire()
+        try:
+            self._cache.pop(url, None)
+            self._cache[url] = (self._clock() + self.ttl, exists)
+            while len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._cache.clear()
+        finally:
+            self._lock.release()
+
+    def _connections(self):
+        connections = getattr(self._local, 'connections', None)
+        if connections is None:
+            connections = self._local.connections = {}
+        return connections
+
+    def _connection(self, scheme, netloc):
+        connections = self._connections()
+        connection = connections.get((scheme, netloc))
+        if connection is None:
+            klass = scheme == 'https' and httplib.HTTPSConnection or httplib.HTTPConnection
+            connection = klass(netloc, timeout=self.timeout)
+            connections[(scheme, netloc)] = connection
+        return connection
+
+    def _drop(self, scheme, netloc):
+        connection = self._connections().pop((scheme, netloc), None)
+        if connection is not None:
+            connection.close()
+
+    def request(self, method, url):
+        """Returns the status of a request to the url, reusing the
+        connection to its host"""
+        parts = urlparse.urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+
+        for attempt in 0, 1:
+            connection = self._connection(parts.scheme, parts.netloc)
+            try:
+                connection.request(method, path)
+                response = connection.getresponse()
+                response.read()
+            except (httplib.HTTPException, socket.error), e:
+                # the kept connection may have been closed by the server
+                self._drop(parts.scheme, parts.netloc)
+                if attempt or not self._retriable(e):
+                    raise
+                continue
+
+            if response.getheader('connection', '').lower() == 'close':
+                self._drop(parts.scheme, parts.netloc)
+            return response.status
+
+    def _retriable(self, error):
+        """Tells whether a failed request is worth sending again: the
+        server may have closed the kept connection, but a host that
+        timed out once is not waited for twice"""
+        if isinstance(error, socket.timeout):
+            return False
+        if isinstance(error, httplib.BadStatusLine):
+            return True
+        return getattr(error, 'errno', None) in RETRIABLE_ERRNOS
+
+    def check(self, url):
+        """Requests the url, without looking at the cache"""
+        try:
+            status = self.request('HEAD', url)
+            if status in (405, 501):
+                # the server does not take HEAD requests
+                status = self.request('GET', url)
+        except (httplib.HTTPException, socket.error, ValueError):
+            return False
+
+        return status < 400
+
+    def exists(self, url):
+        exists = self.cached(url)
+        if exists is None:
+            exists = self.check(url)
+            self.remember(url, exists)
+        return exists
+
+    def _get_pool(self):
+        self._lock.acquire()
+        try:
+            if self._pool is None:
+                self._pool = ThreadPool(self.workers)
+            return self._pool
+        finally:
+            self._lock.release()
+
+    def exists_many(self, urls):
+        """Returns a {url: exists} dict, checking the urls that are not
+        cached concurrently"""
+        ret = {}
+        missing = []
+        for url in urls:
+            if url in ret:
+                continue
+
+            ret[url] = self.cached(url)
+            if ret[url] is None:
+                missing.append(url)
+
+        if len(missing) > 1 and self.workers > 1:
+            results = self._get_pool().map(self.check, missing)
+        else:
+            results = [self.check(url) for url in missing]
+
+        for url, exists in zip(missing, results):
+            self.remember(url, exists)
+            ret[url] = exists
+
+        return ret
+
+    def close(self):
+        """Stops the thread pool and closes the connections of the
+        calling thread"""
+        self._lock.acquire()
+        try:
+            pool, self._pool = self._pool, None
+        finally:
+            self._lock.release()
+
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+        for scheme, netloc in self._connections().keys():
+            self._drop(scheme, netloc)
+
+# the service used by the URLFields that were not given a url_checker
+service = URLExistenceService()
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# -*- coding: utf-8; -*-
+#
+# Copyright (C) 2009 Gabriel Falcão <gabriel@nacaolivre.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public
+# License along with this program; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+import threading
+
+__all__ = ['Histogram', 'OperationStats', 'StatsRegistry', 'registry',
+           'snapshot', 'reset', 'to_prometheus']
+
+# upper bounds, in seconds, of the latency histogram buckets
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+           0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+COUNTERS = ('calls', 'records_scanned', 'records_returned',
+            'bytes_read', 'bytes_written')
+
+class Histogram(object):
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = tuple(buckets)
+        # one extra slot for the values above the last bucket (+Inf)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        index = 0
+        for bound in self.buckets:
+            if value <= bound:
+                break
+            index += 1
+
+        self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """Returns a list of (upper bound, count) tuples, counting every
+        observation less than or equal to each bound, the last bound
+        being None for +Inf"""
+        ret = []
+        total = 0
+        for bound, count in zip(self.buckets + (None,), self.counts):
+            total += count
+            ret.append((bound, total))
+        return ret
+
+class OperationStats(object):
+    def __init__(self):
+        self.latency = Histogram()
+        for name in COUNTERS:
+            setattr(self, name, 0)
+
+    def as_dict(self):
+        ret = dict([(name, getattr(self, name)) for name in COUNTERS])
+        ret['latency'] = {
+            'sum': self.latency.sum,
+            'count': self.latency.count,
+            'buckets': self.latency.cumulative(),
+        }
+        return ret
+
+class StatsRegistry(object):
+    """Keeps the OperationStats of each (model name, operation) pair"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def get(self, model_name, operation):
+        key = (model_name, operation)
+        stats = self._stats.get(key)
+        if stats is None:
+            self._lock.acquire()
+            try:
+                stats = self._stats.setdefault(key, OperationStats())
+            finally:
+                self._lock.release()
+        return stats
+
+    def record(self, model_name, operation, seconds, **counters):
+        stats = self.get(model_name, operation)
+        self._lock.acquire()
+        try:
+            stats.calls += 1
+            stats.latency.observe(seconds)
+            for name, value in counters.items():
+                setattr(stats, name, getattr(stats, name) + value)
+        finally:
+            self._lock.release()
+
+    def snapshot(self):
+        """Returns a copy of all stats as plain dicts:
+        {model name: {operation: {...}}}"""
+        self._lock.acquire()
+        try:
+            ret = {}
+            for (model_name, operation), stats in self._stats.items():
+                ret.setdefault(model_name, {})[operation] = stats.as_dict()
+            return ret
+        finally:
+            self._lock.release()
+
+    def reset(self):
+        self._lock.acquire()
+        try:
+            self._stats.clear()
+        finally:
+            self._lock.release()
+
+    def to_prometheus(self):
+        """Renders the stats in the Prometheus text exposition format"""
+        items = sorted(self.snapshot().items())
+        lines = []
+
+        def labels(model_name, operation, extra=''):
+            return '{model="%s",operation="%s"%s}' % (model_name, operation, extra)
+
+        counters = (
+            ('calls', 'deadparrot_operations_total', 'Number of manager operations'),
+            ('records_scanned', 'deadparrot_records_scanned_total', 'Records decoded from storage'),
+            ('records_returned', 'deadparrot_records_returned_total', 'Records returned to the caller'),
+            ('bytes_read', 'deadparrot_bytes_read_total', 'Bytes read from storage'),
+            ('bytes_written', 'deadparrot_bytes_written_total', 'Bytes written to storage'),
+        )
+        for key, metric, help in counters:
+            lines.append('# HELP %s %s' % (metric, help))
+            lines.append('# TYPE %s counter' % metric)
+            for model_name, operations in items:
+                for operation, stats in sorted(operations.items()):
+                    lines.append('%s%s %d' % (metric, labels(model_name, operation), stats[key]))
+
+        metric = 'deadparrot_operation_duration_seconds'
+        lines.append('# HELP %s Latency of manager operations' % metric)
+        lines.append('# TYPE %s histogram' % metric)
+        for model_name, operations in items:
+            for operation, stats in sorted(operations.items()):
+                latency = stats['latency']
+                for bound, count in latency['buckets']:
+                    le = bound is None and '+Inf' or repr(bound)
+                    extra = ',le="%s"' % le
+                    lines.append('%s_bucket%s %d' % (metric, labels(model_name, operation, extra), count))
+                lines.append('%s_sum%s %r' % (metric, labels(model_name, operation), latency['sum']))
+                lines.append('%s_count%s %d' % (metric, labels(model_name, operation), latency['count']))
+
+        return "\n".join(lines) + "\n"
+
+# the in-process registry used by the model managers
+registry = StatsRegistry()
+
+def snapshot():
+    return registry.snapshot()
+
+def reset():
+    registry.reset()
+
+def to_prometheus():
+    return registry.to_prometheus()
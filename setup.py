@@ -37,6 +37,9 @@ setup(name='dead-parrot',
           'deadparrot.serialization.plugins',
           'deadparrot.server'
     ],
+    entry_points={
+        'console_scripts': ['deadparrot = deadparrot.cli:main'],
+    },
     test_suite="tests.runner.test_suite",
 )
 
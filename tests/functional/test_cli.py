@@ -0,0 +1,168 @@
+# -*- coding: utf-8; -*-
+#
+# Copyright (C) 2009 Gabriel Falcão <gabriel@nacaolivre.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public
+# License along with this program; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+import os
+from StringIO import StringIO
+from nose.tools import assert_equals
+from deadparrot import models, cli, stats
+
+class CliParrot(models.Model):
+    name = models.CharField(max_length=100, primary_key=True)
+    objects = models.FileSystemModelManager(base_path='.')
+    class Meta:
+        checksums = True
+
+def run(*argv):
+    out = StringIO()
+    code = cli.main(list(argv), out=out)
+    return code, out.getvalue()
+
+def test_cli_verify():
+    CliParrot.objects.create(name='Polly')
+    CliParrot.objects.create(name='Norwegian Blue')
+
+    code, output = run('verify', '-m', __name__, 'CliParrot')
+    assert_equals(code, 0)
+    assert_equals(output, 'CliParrot: 2 valid records, 0 errors\n')
+
+    path = CliParrot.objects._fullpath
+    content = open(path).read()
+    open(path, 'w').write(content.replace('Polly', 'Pelly'))
+
+    code, output = run('verify', '-m', __name__, 'CliParrot')
+    assert_equals(code, 1)
+    assert_equals(output, 'CliParrot: 1 valid records, 1 errors\n'
+                          '  line 2: checksum mismatch\n')
+
+    code, output = run('verify', '--recover', '-m', __name__, 'CliParrot')
+    assert_equals(code, 0)
+    assert_equals(run('verify', '-m', __name__, 'CliParrot')[0], 0)
+
+    os.remove(path)
+    os.remove(path + '.damaged')
+
+def test_cli_unknown_model():
+    code, output = run('verify', '-m', __name__, 'Spam')
+    assert_equals(code, 2)
+
+class CliSession(models.Model):
+    key = models.CharField(max_length=10, primary_key=True)
+    kind = models.CharField(max_length=10)
+    objects = models.FileSystemModelManager(base_path='.')
+    class Meta:
+        ttl_seconds = 60
+        search_fields = ['kind']
+
+def test_cli_compact_drops_expired_records():
+    now = [1000000000.0]
+    clock = lambda: now[0]
+    CliSession.objects._clock = clock
+    CliSession.objects.create(key='a', kind='web')
+    now[0] += 30
+    CliSession.objects.create(key='b', kind='api')
+    now[0] += 45
+
+    original = cli.FileObjectsManager._clock
+    cli.FileObjectsManager._clock = lambda self: now[0]
+    try:
+        code, output = run('compact', '-m', __name__, 'CliSession')
+    finally:
+        cli.FileObjectsManager._clock = original
+
+    assert_equals(code, 0)
+    assert_equals(output, 'CliSession: 1 records, 1 dropped\n')
+    assert_equals([s.key for s in CliSession.objects.all()], ['b'])
+    assert_equals([s.key for s in CliSession.objects.search('web')], [])
+
+    os.remove(CliSession.objects._fullpath)
+    os.remove(CliSession.objects._search_index.path)
+
+def test_cli_reindex_and_stats():
+    CliParrot.objects.create(name='Polly')
+    CliParrot.objects.create(name='Norwegian Blue')
+
+    assert_equals(run('reindex', '-m', __name__, 'CliParrot'),
+                  (0, 'CliParrot: 2 records indexed\n'))
+
+    code, output = run('stats', '-m', __name__, 'CliParrot')
+    size = os.path.getsize(CliParrot.objects._fullpath)
+    assert_equals(output, 'CliParrot: 2 records, %d bytes\n'
+                          '  name: 2 distinct values\n' % size)
+    os.remove(CliParrot.objects._fullpath)
+
+def test_cli_export():
+    CliParrot.objects.create(name='Polly')
+    CliParrot.objects.create(name='Norwegian Blue')
+
+    code, output = run('export', '-m', __name__, 'CliParrot')
+    assert_equals(output, '{"CliParrot":{"name":"Polly"}}\n'
+                          '{"CliParrot":{"name":"Norwegian Blue"}}\n')
+
+    code, output = run('export', '-f', 'json', '-m', __name__, 'CliParrot')
+    assert_equals(CliParrot.Set().deserialize(output, 'json'), CliParrot.objects.all())
+
+    code, output = run('export', '-f', 'xml', '-m', __name__, 'CliParrot')
+    assert_equals(output, '<CliParrots><CliParrot><name>Polly</name></CliParrot>'
+                          '<CliParrot><name>Norwegian Blue</name></CliParrot></CliParrots>\n')
+
+    assert_equals(run('export', '-f', 'yaml', '-m', __name__, 'CliParrot')[0], 2)
+    os.remove(CliParrot.objects._fullpath)
+
+def test_cli_bench():
+    CliParrot.objects.create(name='Polly')
+    CliParrot.objects.create(name='Norwegian Blue')
+
+    stats.reset()
+    code, output = run('bench', '-n', '2', '-m', __name__, 'CliParrot')
+    assert_equals(code, 0)
+    lines = output.splitlines()
+    assert_equals([l.split(':')[0] for l in lines],
+                  ['CliParrot.add', 'CliParrot.get', 'CliParrot.filter'])
+    assert ' 2 ops in ' in lines[0], lines[0]
+
+    # the scratch manager records in a registry of its own
+    operations = stats.snapshot().get('CliParrot', {})
+    for name in 'add', 'get', 'filter':
+        assert name not in operations, operations
+
+    # the benchmark runs on a copy, the stored records are untouched
+    assert_equals(len(CliParrot.objects.all()), 2)
+    os.remove(CliParrot.objects._fullpath)
+
+def test_cli_distinct_counter_is_bounded():
+    counter = cli.DistinctCounter(size=128)
+    for i in range(100):
+        counter.add(i % 10)
+    assert counter.exact
+    assert_equals(counter.count(), 10)
+
+    for i in range(5000):
+        counter.add(u'value %d' % i)
+    assert not counter.exact
+    assert_equals(len(counter._hashes), 128)
+    assert abs(counter.count() - 5010) < 1000, counter.count()
+
+def test_cli_reports_damaged_storage():
+    CliParrot.objects.create(name='Polly')
+    path = CliParrot.objects._fullpath
+    content = open(path).read()
+    open(path, 'w').write(content[:-5])
+
+    code, output = run('compact', '-m', __name__, 'CliParrot')
+    assert_equals(code, 2)
+    os.remove(path)
@@ -17,8 +17,11 @@
 # Free Software Foundation, Inc., 59 Temple Place - Suite 330,
 # Boston, MA 02111-1307, USA.
 import os
-from nose.tools import assert_equals
-from deadparrot import models
+import codecs
+from datetime import datetime
+from nose.tools import assert_equals, assert_raises
+from deadparrot import models, stats
+from deadparrot.lib import demjson
 
 def test_model_file_manager_create():
     class FooBarSerial(models.Model):
@@ -212,3 +215,943 @@ def test_model_file_manager_m2m_and_fk():
     assert_equals(box.color, 'blue')
     assert_equals(box.owner.name, 'John Doe')
     assert_equals(box.items.as_modelset()[0].name, 'screwdriver')
+
+def test_model_file_manager_watch_changes():
+    class Parrot1(models.Model):
+        name = models.CharField(max_length=100, primary_key=True)
+        objects = models.FileSystemModelManager(base_path='.')
+        class Meta:
+            changelog = True
+
+    assert_equals(Parrot1.objects.version, 0)
+    assert_equals(Parrot1.objects.watch(since=0), [])
+
+    polly = Parrot1.objects.create(name='Polly')
+    Parrot1.objects.create(name='Norwegian Blue')
+    Parrot1.objects.delete(polly)
+
+    changes = Parrot1.objects.watch(since=0)
+    assert_equals([(c.version, c.op, c.pk) for c in changes],
+                  [(1, 'insert', {'name': 'Polly'}),
+                   (2, 'insert', {'name': 'Norwegian Blue'}),
+                   (3, 'delete', {'name': 'Polly'})])
+
+    assert_equals(Parrot1.objects.version, 3)
+    assert_equals(Parrot1.objects.watch(since=3), [])
+    assert_equals([c.version for c in Parrot1.objects.watch(since=1)], [2, 3])
+
+    seen = []
+    assert_equals(Parrot1.objects.watch(since=2, callback=seen.append), 3)
+    assert_equals([c.op for c in seen], ['delete'])
+
+    os.remove(Parrot1.objects._fullpath)
+    os.remove(Parrot1.objects._changelog.path)
+
+def test_model_file_manager_watch_sees_other_writers():
+    class Parrot2(models.Model):
+        name = models.CharField(max_length=100, primary_key=True)
+        objects = models.FileSystemModelManager(base_path='.')
+        class Meta:
+            changelog = True
+
+    writer = models.FileSystemModelManager.manager(Parrot2, '.')
+    Parrot2.objects.create(name='Polly')
+    version = Parrot2.objects.version
+
+    writer.create(name='Norwegian Blue')
+    changes = Parrot2.objects.watch(since=version)
+    assert_equals([c.pk for c in changes], [{'name': 'Norwegian Blue'}])
+
+    os.remove(Parrot2.objects._fullpath)
+    os.remove(Parrot2.objects._changelog.path)
+
+def test_model_file_manager_watch_requires_changelog():
+    class Parrot3(models.Model):
+        name = models.CharField(max_length=100, primary_key=True)
+        objects = models.FileSystemModelManager(base_path='.')
+
+    assert_raises(TypeError, Parrot3.objects.watch)
+
+def test_model_file_manager_ttl_field_hides_and_purges_expired():
+    class Session1(models.Model):
+        key = models.CharField(max_length=10, primary_key=True)
+        expires_at = models.DateTimeField()
+        objects = models.FileSystemModelManager(base_path='.')
+        class Meta:
+            ttl_field = 'expires_at'
+
+    def stored_keys():
+        stored = Session1.Set().deserialize(open(Session1.objects._fullpath).read(), 'json')
+        return sorted(session.key for session in stored)
+
+    fresh = Session1.objects.create(key='fresh', expires_at='2099-01-01 00:00:00')
+    Session1.objects.create(key='old', expires_at='2009-01-01 00:00:00')
+
+    assert_equals(Session1.objects.all(), Session1.Set()(fresh))
+    assert_equals(Session1.objects.get(key='old'), None)
+
+    # the expired record is hidden, but still on disk until it is swept
+    assert_equals(stored_keys(), ['fresh', 'old'])
+    assert_equals(Session1.objects.purge(), 1)
+    assert_equals(stored_keys(), ['fresh'])
+    assert_equals(Session1.objects.purge(), 0)
+
+    # a write sweeps the expired records as well
+    Session1.objects.create(key='stale', expires_at='2009-01-01 00:00:00')
+    assert_equals(stored_keys(), ['fresh', 'stale'])
+    Session1.objects.create(key='new', expires_at='2099-01-01 00:00:00')
+    assert_equals(stored_keys(), ['fresh', 'new'])
+    os.remove(Session1.objects._fullpath)
+
+def test_model_file_manager_ttl_seconds():
+    class Session2(models.Model):
+        key = models.CharField(max_length=10, primary_key=True)
+        objects = models.FileSystemModelManager(base_path='.')
+        class Meta:
+            ttl_seconds = 60
+            changelog = True
+
+    now = [1000000000.0]
+    Session2.objects._clock = lambda: now[0]
+
+    first = Session2.objects.create(key='first')
+    now[0] += 30
+    second = Session2.objects.create(key='second')
+    assert_equals(Session2.objects.all(), Session2.Set()(first, second))
+
+    now[0] += 45
+    assert_equals(Session2.objects.all(), Session2.Set()(second))
+    assert_equals(Session2.objects.purge(), 1)
+    assert_equals(Session2.objects.purge(), 0)
+    assert_equals([(c.op, c.pk) for c in Session2.objects.watch()][-1],
+                  ('delete', {'key': 'first'}))
+
+    now[0] += 60
+    Session2.objects.create(key='third')
+    stored = Session2.Set().deserialize(open(Session2.objects._fullpath).read(), 'json')
+    assert_equals([s.key for s in stored], ['third'])
+
+    os.remove(Session2.objects._fullpath)
+    os.remove(Session2.objects._changelog.path)
+
+def test_model_file_manager_ttl_field_must_be_datetime():
+    def make_class():
+        class Session3(models.Model):
+            key = models.CharField(max_length=10, primary_key=True)
+            objects = models.FileSystemModelManager(base_path='.')
+            class Meta:
+                ttl_field = 'key'
+
+    assert_raises(TypeError, make_class)
+
+def test_model_file_manager_ttl_seconds_fills_ttl_field():
+    class Session4(models.Model):
+        key = models.CharField(max_length=10, primary_key=True)
+        expires_at = models.DateTimeField()
+        objects = models.FileSystemModelManager(base_path='.')
+        class Meta:
+            ttl_field = 'expires_at'
+            ttl_seconds = 3600
+
+    session = Session4.objects.create(key='abc')
+    assert session.expires_at > datetime.now()
+    assert_equals(Session4.objects.get(key='abc').expires_at, session.expires_at)
+    os.remove(Session4.objects._fullpath)
+
+def test_model_file_manager_identity_map_reuses_instances():
+    class Parrot4(models.Model):
+        name = models.CharField(max_length=100, primary_key=True)
+        age = models.IntegerField()
+        objects = models.FileSystemModelManager(base_path='.')
+        class Meta:
+            identity_map = True
+
+    Parrot4.objects.create(name='Polly', age=3)
+    Parrot4.objects.create(name='Norwegian Blue', age=5)
+
+    polly = Parrot4.objects.get(name='Polly')
+    assert Parrot4.objects.get(name='Polly') is polly
+    assert Parrot4.objects.all()[0] is polly
+
+    # writes to a record invalidate its instance
+    Parrot4.objects.delete(polly)
+    new_polly = Parrot4.objects.create(name='Polly', age=4)
+    got = Parrot4.objects.get(name='Polly')
+    assert got is not polly
+    assert_equals(got.age, 4)
+
+    # and the map does not keep instances alive
+    del polly, got, new_polly
+    import gc; gc.collect()
+    assert_equals(len(Parrot4.objects._identity_map), 0)
+
+    os.remove(Parrot4.objects._fullpath)
+
+def test_model_file_manager_identity_map_sees_changes_from_other_writers():
+    class Parrot5(models.Model):
+        name = models.CharField(max_length=100, primary_key=True)
+        age = models.IntegerField()
+        objects = models.FileSystemModelManager(base_path='.')
+        class Meta:
+            identity_map = True
+
+    other = models.FileSystemModelManager.manager(Parrot5, '.')
+    polly = Parrot5.objects.create(name='Polly', age=3)
+    first = Parrot5.objects.get(name='Polly')
+
+    other.delete(polly)
+    other.create(name='Polly', age=30)
+
+    second = Parrot5.objects.get(name='Polly')
+    assert second is not first
+    assert_equals(second.age, 30)
+    os.remove(Parrot5.objects._fullpath)
+
+def test_model_file_manager_identity_map_requires_primary_key():
+    def make_class():
+        class Parrot6(models.Model):
+            name = models.CharField(max_length=100)
+            objects = models.FileSystemModelManager(base_path='.')
+            class Meta:
+                identity_map = True
+
+    assert_raises(TypeError, make_class)
+
+def test_model_file_manager_records_stats():
+    class Order1(models.Model):
+        code = models.CharField(max_length=10, primary_key=True)
+        objects = models.FileSystemModelManager(base_path='.')
+
+    stats.reset()
+    Order1.objects.create(code='a')
+    first_size = os.path.getsize(Order1.objects._fullpath)
+    Order1.objects.create(code='b')
+    second_size = os.path.getsize(Order1.objects._fullpath)
+    Order1.objects.get(code='b')
+
+    got = stats.snapshot()['Order1']
+    assert_equals(got['add']['calls'], 2)
+    assert_equals(got['add']['records_scanned'], 1)
+    assert_equals(got['add']['bytes_read'], first_size)
+    assert_equals(got['add']['bytes_written'], first_size + second_size)
+    assert_equals(got['get']['calls'], 1)
+    assert_equals(got['get']['records_scanned'], 2)
+    assert_equals(got['get']['records_returned'], 1)
+    assert_equals(got['get']['bytes_read'], second_size)
+    assert 'filter' not in got, 'the filter() done by get() should be accounted to get()'
+
+    os.remove(Order1.objects._fullpath)
+
+def test_model_file_manager_records_returned():
+    class Order9(models.Model):
+        code = models.CharField(max_length=10, primary_key=True)
+        note = models.CharField(max_length=10)
+        objects = models.FileSystemModelManager(base_path='.')
+
+    stats.reset()
+    Order9.objects.add_many([Order9(code='a'), Order9(code='b'), Order9(code='c')])
+    order = Order9.objects.get(code='a')
+    order.note = u'urgent'
+    Order9.objects.update(order)
+    Order9.objects.all()
+    Order9.objects.delete(order)
+    Order9.objects.purge()
+    Order9.objects.compact()
+
+    got = stats.snapshot()['Order9']
+    returned = dict([(operation, got[operation]['records_returned']) for operation in got])
+    assert_equals(returned, {'add_many': 3, 'get': 1, 'update': 0, 'all': 3,
+                             'delete': 0, 'purge': 0, 'compact': 0})
+    os.remove(Order9.objects._fullpath)
+
+def test_model_file_manager_search():
+    class Sketch1(models.Model):
+        title = models.CharField(max_length=100, primary_key=True)
+        body = models.TextField()
+        objects = models.FileSystemModelManager(base_path='.')
+        class Meta:
+            search_fields = ['title', 'body']
+
+    parrot = Sketch1.objects.create(title='Dead Parrot', body=u'This parrot is no more. It is a dead parrot!')
+    shop = Sketch1.objects.create(title='Cheese Shop', body=u'No cheese, and no parrot either')
+    spam = Sketch1.objects.create(title='Spam', body=u'Spam spam spam')
+
+    assert_equals(Sketch1.objects.search('dead parrot'), Sketch1.Set()(parrot))
+    assert_equals(Sketch1.objects.search('PARROT'), Sketch1.Set()(parrot, shop))
+    assert_equals(Sketch1.objects.search('cheese spam', operator='or'), Sketch1.Set()(spam, shop))
+    assert_equals(Sketch1.objects.search('lumberjack'), Sketch1.Set()())
+
+    Sketch1.objects.delete(parrot)
+    assert_equals(Sketch1.objects.search('parrot'), Sketch1.Set()(shop))
+
+    # a missing index gets rebuilt from the storage
+    os.remove(Sketch1.objects._search_index.path)
+    assert_equals(Sketch1.objects.search('spam'), Sketch1.Set()(spam))
+
+    os.remove(Sketch1.objects._fullpath)
+    os.remove(Sketch1.objects._search_index.path)
+
+def test_model_file_manager_search_ties_are_ordered_by_key():
+    class Sketch2(models.Model):
+        id = models.IntegerField(primary_key=True)
+        title = models.CharField(max_length=100)
+        objects = models.FileSystemModelManager(base_path='.')
+        class Meta:
+            search_fields = ['title']
+
+    for i in 12, 3, 40, 7, 25:
+        Sketch2.objects.create(id=i, title=u'parrot %d' % i)
+    Sketch2.objects.create(id=1, title=u'parrot parrot')
+
+    assert_equals([s.id for s in Sketch2.objects.search('parrot')], [1, 12, 25, 3, 40, 7])
+    os.remove(Sketch2.objects._fullpath)
+    os.remove(Sketch2.objects._search_index.path)
+
+def test_model_file_manager_search_fields_must_be_text():
+    def make_class():
+        class Sketch2(models.Model):
+            title = models.CharField(max_length=100, primary_key=True)
+            year = models.IntegerField()
+            objects = models.FileSystemModelManager(base_path='.')
+            class Meta:
+                search_fields = ['year']
+
+    assert_raises(TypeError, make_class)
+
+def test_model_file_manager_checksums_layout_and_verify():
+    class Ledger1(models.Model):
+        code = models.CharField(max_length=10, primary_key=True)
+        amount = models.IntegerField()
+        objects = models.FileSystemModelManager(base_path='.')
+        class Meta:
+            checksums = True
+
+    first = Ledger1.objects.create(code='a', amount=10)
+    second = Ledger1.objects.create(code=u'ç', amount=20)
+
+    lines = codecs.open(Ledger1.objects._fullpath, 'r', 'utf-8').read().splitlines()
+    assert_equals(len(lines), 4)
+    assert_equals(lines[0], '{"Ledger1s":[')
+    assert_equals(lines[-1], ']}')
+    assert '"__crc32__":' in lines[1]
+
+    assert_equals(Ledger1.objects.all(), Ledger1.Set()(first, second))
+    report = Ledger1.objects.verify()
+    assert report.ok, report.errors
+    assert_equals(report.valid, 2)
+
+    os.remove(Ledger1.objects._fullpath)
+
+def test_model_file_manager_checksums_detect_and_recover_damage():
+    class Ledger2(models.Model):
+        code = models.CharField(max_length=10, primary_key=True)
+        amount = models.IntegerField()
+        objects = models.FileSystemModelManager(base_path='.')
+        class Meta:
+            checksums = True
+
+    first = Ledger2.objects.create(code='a', amount=10)
+    Ledger2.objects.create(code='b', amount=20)
+    third = Ledger2.objects.create(code='c', amount=30)
+
+    path = Ledger2.objects._fullpath
+    content = open(path).read()
+    # a flipped digit keeps the json valid, but not the checksum
+    open(path, 'w').write(content.replace('"amount":20', '"amount":21'))
+
+    report = Ledger2.objects.verify()
+    assert_equals(report.valid, 2)
+    assert_equals(report.errors, [(3, 'checksum mismatch')])
+
+    # reads keep the valid records, writes refuse to overwrite the damage
+    assert_equals(Ledger2.objects.all(), Ledger2.Set()(first, third))
+    assert_raises(models.StorageCorruptedError, Ledger2.objects.create, code='d', amount=40)
+
+    report = Ledger2.objects.recover()
+    assert_equals(len(report.errors), 1)
+    assert Ledger2.objects.verify().ok
+    assert_equals(Ledger2.objects.all(), Ledger2.Set()(first, third))
+    assert_equals(open(path + '.damaged').read(), content.replace('"amount":20', '"amount":21'))
+
+    os.remove(path)
+    os.remove(path + '.damaged')
+
+def test_model_file_manager_verify_truncated_file():
+    class Ledger3(models.Model):
+        code = models.CharField(max_length=10, primary_key=True)
+        objects = models.FileSystemModelManager(base_path='.')
+        class Meta:
+            checksums = True
+
+    first = Ledger3.objects.create(code='a')
+    Ledger3.objects.create(code='b')
+    path = Ledger3.objects._fullpath
+    content = open(path).read()
+    open(path, 'w').write(content[:-12])
+
+    report = Ledger3.objects.verify()
+    assert_equals(report.valid, 1)
+    assert_equals(len(report.errors), 2)
+    assert_equals(report.errors[0][0], 3)
+    assert_equals(report.errors[1][1], 'truncated file')
+
+    Ledger3.objects.recover()
+    assert_equals(Ledger3.objects.all(), Ledger3.Set()(first))
+    os.remove(path)
+    os.remove(path + '.damaged')
+
+def test_model_file_manager_checksums_keep_line_separators():
+    class Ledger5(models.Model):
+        code = models.CharField(max_length=10, primary_key=True)
+        memo = models.CharField(max_length=20)
+        objects = models.FileSystemModelManager(base_path='.')
+        class Meta:
+            checksums = True
+
+    memo = u'a\u2028b\u2029c\x85d\x0be\x0cf\x1cg'
+    first = Ledger5.objects.create(code='a', memo=memo)
+    Ledger5.objects.create(code='b', memo=u'plain')
+
+    assert Ledger5.objects.verify().ok, Ledger5.objects.verify().errors
+    assert_equals(Ledger5.objects.get(code='a').memo, memo)
+    Ledger5.objects.create(code='c', memo=u'more')
+    assert_equals(len(Ledger5.objects.all()), 3)
+
+    # a line without its checksum can not be told valid
+    path = Ledger5.objects._fullpath
+    lines = open(path).read().split('\n')
+    lines[2] = '{"Ledger5":{"code":"b","memo":"plain"}},'
+    open(path, 'w').write('\n'.join(lines))
+    assert_equals(Ledger5.objects.verify().errors, [(3, 'missing checksum')])
+    assert_equals(Ledger5.objects.all(), Ledger5.Set()(first, Ledger5(code='c')))
+
+    os.remove(path)
+
+def test_model_file_manager_add_refuses_damaged_plain_file():
+    class Ledger4(models.Model):
+        code = models.CharField(max_length=10, primary_key=True)
+        objects = models.FileSystemModelManager(base_path='.')
+
+    Ledger4.objects.create(code='a')
+    path = Ledger4.objects._fullpath
+    content = open(path).read()
+    open(path, 'w').write(content[:-5])
+
+    assert_equals(Ledger4.objects.all(), Ledger4.Set()())
+    assert_raises(models.StorageCorruptedError, Ledger4.objects.create, code='b')
+    assert not Ledger4.objects.verify().ok
+    os.remove(path)
+
+def test_model_file_manager_compact_streams_checksummed_files():
+    class Ledger5(models.Model):
+        code = models.CharField(max_length=10, primary_key=True)
+        objects = models.FileSystemModelManager(base_path='.')
+        class Meta:
+            checksums = True
+            ttl_seconds = 60
+
+    now = [1000000000.0]
+    Ledger5.objects._clock = lambda: now[0]
+    Ledger5.objects.create(code='a')
+    now[0] += 30
+    second = Ledger5.objects.create(code='b')
+    now[0] += 45
+
+    assert_equals(Ledger5.objects.compact(), (2, 1))
+    assert_equals(list(Ledger5.objects.iterate()), [second])
+    assert Ledger5.objects.verify().ok
+    os.remove(Ledger5.objects._fullpath)
+
+def test_model_file_manager_load_csv():
+    class Customer1(models.Model):
+        name = models.CharField(max_length=10, primary_key=True, blank=False)
+        age = models.IntegerField()
+        vip = models.BooleanField(positives=['yes'], negatives=['no'], blank=True)
+        objects = models.FileSystemModelManager(base_path='.')
+
+    Customer1.objects.create(name='first', age=50)
+    path = os.path.abspath('customers1.csv')
+    open(path, 'w').write('Full Name,Age,VIP,Ignored\n'
+                          'john,20,yes,x\n'
+                          'mary,abc,False,y\n'
+                          ',30,False,z\n'
+                          'jos\xc3\xa9,40,,w\n')
+
+    report = Customer1.objects.load_csv(path, batch_size=2,
+                                        mapping={'Full Name': 'name', 'Age': 'age', 'VIP': 'vip'})
+
+    assert_equals(report.imported, 2)
+    assert_equals(report.rejected, 2)
+    assert_equals([(n, f) for n, f, message in report.errors], [(3, 'age'), (4, 'name')])
+
+    assert_equals(Customer1.objects.all(), Customer1.Set()(Customer1(name='first', age=50),
+                                                           Customer1(name='john', age=20, vip=True),
+                                                           Customer1(name=u'josé', age=40)))
+    os.remove(path)
+    os.remove(Customer1.objects._fullpath)
+
+def test_model_file_manager_load_jsonl_appends_checksummed_files():
+    class Customer2(models.Model):
+        name = models.CharField(max_length=10, primary_key=True)
+        age = models.IntegerField()
+        objects = models.FileSystemModelManager(base_path='.')
+        class Meta:
+            checksums = True
+            changelog = True
+
+    first = Customer2.objects.create(name='first', age=50)
+    path = os.path.abspath('customers2.jsonl')
+    open(path, 'w').write('{"name": "john", "age": 20}\n'
+                          '{"Customer2": {"name": "mary", "age": 30}}\n'
+                          'not json\n'
+                          '\n'
+                          '{"name": "bob", "age": 40, "color": "blue"}\n'
+                          '{"name": "ann", "age": 60}\n')
+
+    report = Customer2.objects.load_jsonl(path, batch_size=2)
+    assert_equals(report.imported, 3)
+    assert_equals([(n, f) for n, f, message in report.errors], [(3, None), (5, 'color')])
+
+    assert Customer2.objects.verify().ok
+    assert_equals(Customer2.objects.all(), Customer2.Set()(first,
+                                                           Customer2(name='john', age=20),
+                                                           Customer2(name='mary', age=30),
+                                                           Customer2(name='ann', age=60)))
+    assert_equals([c.pk for c in Customer2.objects.watch()][1:],
+                  [{'name': 'john'}, {'name': 'mary'}, {'name': 'ann'}])
+
+    os.remove(path)
+    os.remove(Customer2.objects._fullpath)
+    os.remove(Customer2.objects._changelog.path)
+
+def test_model_file_manager_reference_foreign_keys():
+    class Customer3(models.Model):
+        id = models.IntegerField(primary_key=True)
+        name = models.CharField(max_length=10)
+        objects = models.FileSystemModelManager(base_path='.')
+
+    class Tag3(models.Model):
+        name = models.CharField(max_length=10, primary_key=True)
+        objects = models.FileSystemModelManager(base_path='.')
+
+    class Order3(models.Model):
+        id = models.IntegerField(primary_key=True)
+        customer = models.ForeignKey(Customer3, reference=True)
+        tags = models.ManyToManyField(Tag3, reference=True)
+        objects = models.FileSystemModelManager(base_path='.')
+
+    john = Customer3.objects.create(id=1, name='john')
+    red, blue = Tag3.objects.create(name='red'), Tag3.objects.create(name='blue')
+    Order3.objects.create(id=10, customer=john, tags=[blue, red])
+
+    stored = open(Order3.objects._fullpath).read()
+    assert '"customer":{"id":1}' in stored, stored
+    assert '"tags":[{"name":"blue"},{"name":"red"}]' in stored, stored
+
+    # the customer changes after the order was stored
+    Customer3.objects.delete(john)
+    Customer3.objects.create(id=1, name='johnny')
+
+    stats.reset()
+    order = Order3.objects.get(id=10)
+    assert 'customer' not in order.__dict__
+    assert_equals(order.to_dict(), {'Order3': {'id': 10, 'customer': {'id': 1},
+                                               'tags': [{'name': 'blue'}, {'name': 'red'}]}})
+    assert_equals(stats.snapshot().get('Customer3'), None)
+
+    assert_equals(order.customer.name, 'johnny')
+    assert order.customer is order.customer
+    assert_equals(stats.snapshot()['Customer3']['in_bulk']['calls'], 1)
+    assert_equals([t.name for t in order.tags.objects], ['blue', 'red'])
+
+    order.customer = Customer3(id=2)
+    assert_equals(order.to_dict()['Order3']['customer'], {'id': 2})
+    assert_equals(order.customer.name, None)
+
+    for model in Customer3, Tag3, Order3:
+        os.remove(model.objects._fullpath)
+
+def test_model_file_manager_prefetch_related():
+    class Customer4(models.Model):
+        id = models.IntegerField(primary_key=True)
+        objects = models.FileSystemModelManager(base_path='.')
+
+    class Item4(models.Model):
+        sku = models.CharField(max_length=10, primary_key=True)
+        objects = models.FileSystemModelManager(base_path='.')
+
+    class Order4(models.Model):
+        id = models.IntegerField(primary_key=True)
+        customer = models.ForeignKey(Customer4, reference=True)
+        items = models.ManyToManyField(Item4, reference=True)
+        objects = models.FileSystemModelManager(base_path='.')
+
+    john, mary = Customer4.objects.create(id=1), Customer4.objects.create(id=2)
+    pen, ink = Item4.objects.create(sku='pen'), Item4.objects.create(sku='ink')
+    Order4.objects.create(id=1, customer=john, items=[pen])
+    Order4.objects.create(id=2, customer=mary, items=[pen, ink])
+    Order4.objects.create(id=3, customer=john)
+
+    stats.reset()
+    orders = Order4.objects.all().prefetch_related('customer', 'items')
+    snapshot = stats.snapshot()
+    assert_equals(snapshot['Customer4']['in_bulk']['calls'], 1)
+    assert_equals(snapshot['Item4']['in_bulk']['calls'], 1)
+
+    assert_equals([o.customer.id for o in orders], [1, 2, 1])
+    assert orders[0].customer is orders[2].customer
+    assert_equals([i.sku for i in orders[1].items.objects], ['pen', 'ink'])
+    assert_equals(orders[2].items.objects, [])
+    assert_equals(stats.snapshot()['Customer4']['in_bulk']['calls'], 1)
+
+    assert_raises(TypeError, orders.prefetch_related, 'color')
+    for model in Customer4, Item4, Order4:
+        os.remove(model.objects._fullpath)
+
+def test_model_file_manager_reverse_relationships():
+    class Customer5(models.Model):
+        id = models.IntegerField(primary_key=True)
+        objects = models.FileSystemModelManager(base_path='.')
+
+    class Order5(models.Model):
+        id = models.IntegerField(primary_key=True)
+        customer = models.ForeignKey(Customer5, reference=True)
+        objects = models.FileSystemModelManager(base_path='.')
+        class Meta:
+            reverse_index = True
+
+    class Invoice5(models.Model):
+        number = models.IntegerField()
+        customer = models.ForeignKey(Customer5)
+        objects = models.FileSystemModelManager(base_path='.')
+
+    john, mary = Customer5(id=1), Customer5(id=2)
+    first = Order5.objects.create(id=1, customer=john)
+    Order5.objects.create(id=2, customer=mary)
+    third = Order5.objects.create(id=3, customer=john)
+    Invoice5.objects.create(number=100, customer=mary)
+
+    assert_equals(john.order5_set, Order5.Set()(first, third))
+    assert_equals([i.number for i in mary.invoice5_set], [100])
+    assert_equals(john.invoice5_set, Invoice5.Set()())
+
+    refs = demjson.decode(open(Order5.objects._reverse_index.path).read())
+    assert_equals(refs['customer']['[["id",1]]'], [{'id': 1}, {'id': 3}])
+
+    Order5.objects.delete(first)
+    assert_equals(john.order5_set, Order5.Set()(third))
+
+    os.remove(Order5.objects._reverse_index.path)
+    assert_equals(Order5.objects.reindex(), 2)
+    assert_equals(mary.order5_set[0].id, 2)
+
+    for model in Order5, Invoice5:
+        os.remove(model.objects._fullpath)
+    os.remove(Order5.objects._reverse_index.path)
+
+def test_model_file_manager_many_to_many_join_table():
+    class Tag6(models.Model):
+        name = models.CharField(max_length=10, primary_key=True)
+        objects = models.FileSystemModelManager(base_path='.')
+
+    class Post6(models.Model):
+        id = models.IntegerField(primary_key=True)
+        tags = models.ManyToManyField(Tag6, join_table=True)
+        objects = models.FileSystemModelManager(base_path='.')
+
+    red, blue, green = [Tag6.objects.create(name=n) for n in 'red', 'blue', 'green']
+    Post6.objects.create(id=1, tags=[red, blue])
+    second = Post6.objects.create(id=2)
+
+    assert_equals(open(Post6.objects._fullpath).read(),
+                  '{"Post6s":[{"Post6":{"id":1}},{"Post6":{"id":2}}]}')
+    table = Post6.objects._join_tables['tags']
+    assert_equals(open(table.path).read(),
+                  '[{"id":1},{"name":"red"}]\n[{"id":1},{"name":"blue"}]\n')
+
+    first = Post6.objects.get(id=1)
+    assert 'tags' not in first.__dict__
+    assert_equals([t.name for t in first.tags.objects], ['red', 'blue'])
+
+    # adding a tag appends a single pair, the post is not rewritten
+    stored = open(Post6.objects._fullpath).read()
+    second.tags.add(green)
+    first.tags.add(green)
+    first.tags.remove(red)
+    assert_equals(open(Post6.objects._fullpath).read(), stored)
+    assert_equals([t.name for t in Post6.objects.get(id=1).tags.objects], ['blue', 'green'])
+    assert_equals([p.id for p in green.post6_set], [1, 2])
+
+    Post6.objects.delete(second)
+    assert_equals(table.referrers({'name': 'green'}), [{'id': 1}])
+
+    for model in Tag6, Post6:
+        os.remove(model.objects._fullpath)
+    os.remove(table.path)
+
+def test_model_file_manager_all_columnar():
+    class Reading1(models.Model):
+        sensor = models.CharField(max_length=10)
+        value = models.FloatField()
+        objects = models.FileSystemModelManager(base_path='.')
+
+    Reading1.objects.create(sensor='a', value=1.5)
+    Reading1.objects.create(sensor='b', value=2.5)
+
+    readings = Reading1.objects.all(columnar=True)
+    assert_equals(readings.values('value'), [1.5, 2.5])
+    assert_equals(readings.to_dict(), Reading1.objects.all().to_dict())
+    assert_equals(readings.filter(sensor='b')[0].value, 2.5)
+    os.remove(Reading1.objects._fullpath)
+
+def test_model_file_manager_trusted_load():
+    class Account1(models.Model):
+        id = models.IntegerField(primary_key=True)
+        name = models.CharField(max_length=10)
+        objects = models.FileSystemModelManager(base_path='.')
+        class Meta:
+            trusted_load = True
+
+    validated = []
+    field = Account1._meta._fields['name']
+    validate = field.validate
+    field.validate = lambda value: validated.append(value) or validate(value)
+
+    try:
+        Account1.objects.create(id=1, name=u'John')
+        Account1.objects.create(id=2, name=u'Mary')
+        assert os.path.exists('Account1.schema')
+
+        del validated[:]
+        assert_equals([a.name for a in Account1.objects.all()], [u'John', u'Mary'])
+        assert_equals(Account1.objects.get(id=2).name, u'Mary')
+        assert_equals(validated, [])
+
+        # changed by someone else, it has to be validated again
+        fobj = open(Account1.objects._fullpath, 'a')
+        fobj.write('\n')
+        fobj.close()
+        assert_equals([a.name for a in Account1.objects.all()], [u'John', u'Mary'])
+        assert_equals(validated, [u'John', u'Mary'])
+
+        # but only once, it is trusted after being fully validated
+        del validated[:]
+        Account1.objects.all()
+        assert_equals(validated, [])
+    finally:
+        del field.validate
+        os.remove(Account1.objects._fullpath)
+        os.remove('Account1.schema')
+
+def test_model_file_manager_trusted_load_is_opt_in():
+    class Account2(models.Model):
+        id = models.IntegerField(primary_key=True)
+        objects = models.FileSystemModelManager(base_path='.')
+
+    Account2.objects.create(id=1)
+    assert not os.path.exists('Account2.schema')
+    assert_equals(Account2.objects.get(id=1).id, 1)
+    os.remove(Account2.objects._fullpath)
+
+def test_model_file_manager_update():
+    class Account3(models.Model):
+        id = models.IntegerField(primary_key=True)
+        name = models.CharField(max_length=20)
+        email = models.EmailField()
+        objects = models.FileSystemModelManager(base_path='.')
+        class Meta:
+            changelog = True
+
+    Account3.objects.create(id=1, name=u'John', email=u'john@doe.com')
+    Account3.objects.create(id=2, name=u'Mary', email=u'mary@doe.com')
+
+    try:
+        john = Account3.objects.get(id=1)
+        assert_equals(john.changed_fields(), [])
+        assert_equals(Account3.objects.update(john), [])
+
+        john.name = u'Johnny'
+        john.email = u'johnny@doe.com'
+        assert_equals(Account3.objects.update(john), ['email', 'name'])
+        assert_equals(john.changed_fields(), [])
+
+        stored = [a.to_dict() for a in Account3.objects.all()]
+        assert_equals(stored, [{'Account3': {'id': 1, 'name': u'Johnny', 'email': u'johnny@doe.com'}},
+                               {'Account3': {'id': 2, 'name': u'Mary', 'email': u'mary@doe.com'}}])
+        assert_equals([(c.op, c.pk) for c in Account3.objects.watch(since=2)], [('update', {'id': 1})])
+
+        # the record the primary key was loaded from is not overwritten
+        mary = Account3.objects.get(id=2)
+        mary.id = 1
+        mary.name = u'Mallory'
+        assert_raises(TypeError, Account3.objects.update, mary)
+        assert_raises(TypeError, Account3.objects.update, Account3(id=2, name=u'Mallory'))
+        assert_equals([a.name for a in Account3.objects.all()], [u'Johnny', u'Mary'])
+
+        paul = Account3.objects.get(id=1)
+        Account3.objects.delete(paul)
+        paul.name = u'Paul'
+        assert_raises(ValueError, Account3.objects.update, paul)
+    finally:
+        os.remove(Account3.objects._fullpath)
+        os.remove('Account3.changes')
+
+def test_model_file_manager_delete_does_not_build_instances():
+    class Account4(models.Model):
+        id = models.IntegerField(primary_key=True)
+        name = models.CharField(max_length=20)
+        objects = models.FileSystemModelManager(base_path='.')
+
+    class Note1(models.Model):
+        text = models.CharField(max_length=20)
+        objects = models.FileSystemModelManager(base_path='.')
+
+    Account4.objects.create(id=1, name=u'John')
+    Account4.objects.create(id=2, name=u'Mary')
+    Note1.objects.create(text=u'do')
+    Note1.objects.create(text=u're')
+
+    built = []
+    load = Account4._load_from_dict
+    Account4._load_from_dict = classmethod(lambda cls, data: built.append(data) or load(data))
+    try:
+        # found by its primary key, whatever its other fields are
+        Account4.objects.delete(Account4(id=1, name=u'Johnny'))
+        assert_equals(built, [])
+    finally:
+        Account4._load_from_dict = classmethod(load.im_func)
+
+    assert_equals([a.id for a in Account4.objects.all()], [2])
+    Note1.objects.delete(Note1(text=u'do'))
+    assert_equals([n.text for n in Note1.objects.all()], [u're'])
+
+    os.remove(Account4.objects._fullpath)
+    os.remove(Note1.objects._fullpath)
+
+def test_model_file_manager_lookups_decode_only_the_matches():
+    class Customer7(models.Model):
+        id = models.IntegerField(primary_key=True)
+        objects = models.FileSystemModelManager(base_path='.')
+
+    class Order7(models.Model):
+        id = models.IntegerField(primary_key=True)
+        note = models.CharField(max_length=40)
+        customer = models.ForeignKey(Customer7, reference=True)
+        objects = models.FileSystemModelManager(base_path='.')
+        class Meta:
+            checksums = True
+            reverse_index = True
+            search_fields = ['note']
+
+    john, mary = Customer7(id=1), Customer7(id=2)
+    Order7.objects.add_many([Order7(id=i, note=u'order "%d", spam' % i, customer=i % 2 and john or mary)
+                             for i in range(1, 21)])
+    Order7.objects.create(id=21, note=u'lumberjack', customer=mary)
+
+    stats.reset()
+    assert_equals([o.id for o in Order7.objects.search('lumberjack')], [21])
+    assert_equals(stats.snapshot()['Order7']['search']['records_scanned'], 1)
+
+    assert_equals([o.id for o in Order7.objects.search('"3", spam')], [3])
+    assert_equals(stats.snapshot()['Order7']['search']['records_scanned'], 2)
+
+    assert_equals([o.id for o in Order7.objects.referrers(mary)], range(2, 21, 2) + [21])
+    assert_equals(stats.snapshot()['Order7']['referrers']['records_scanned'], 11)
+    assert_equals(sorted(Order7.objects.in_bulk([{'id': 5}, {'id': 50}]).keys()), [(('id', 5), )])
+
+    for path in Order7.objects._fullpath, Order7.objects._search_index.path, \
+                Order7.objects._reverse_index.path:
+        os.remove(path)
+
+def test_model_file_manager_load_jsonl_into_single_document_checksummed_file():
+    class Customer8(models.Model):
+        name = models.CharField(max_length=10, primary_key=True)
+        objects = models.FileSystemModelManager(base_path='.')
+        class Meta:
+            checksums = True
+
+    # written before Meta.checksums was set
+    path = Customer8.objects._fullpath
+    open(path, 'w').write('{"Customer8s": [{"Customer8": {"name": "first"}}]}')
+    jsonl = os.path.abspath('customers8.jsonl')
+    open(jsonl, 'w').write('{"name": "john"}\n{"name": "mary"}\n{"name": "ann"}\n')
+
+    report = Customer8.objects.load_jsonl(jsonl, batch_size=2)
+    assert_equals(report.imported, 3)
+    assert Customer8.objects.verify().ok
+    assert_equals(open(path).readline(), '{"Customer8s":[\n')
+    assert_equals([c.name for c in Customer8.objects.all()], ['first', 'john', 'mary', 'ann'])
+
+    os.remove(jsonl)
+    os.remove(path)
+
+def test_model_file_manager_update_join_tables():
+    class Tag10(models.Model):
+        name = models.CharField(max_length=10, primary_key=True)
+        objects = models.FileSystemModelManager(base_path='.')
+
+    class Post10(models.Model):
+        id = models.IntegerField(primary_key=True)
+        title = models.CharField(max_length=10)
+        tags = models.ManyToManyField(Tag10, join_table=True)
+        objects = models.FileSystemModelManager(base_path='.')
+
+    red, blue = [Tag10.objects.create(name=n) for n in 'red', 'blue']
+    Post10.objects.create(id=1, title=u'a', tags=[red])
+    Post10.objects.create(id=2, title=u'z', tags=[red])
+    table = Post10.objects._join_tables['tags']
+
+    try:
+        post = Post10.objects.get(id=1)
+        post.tags = [blue]
+        post.title = u'b'
+        assert_equals(Post10.objects.update(post), ['tags', 'title'])
+
+        stored = Post10.objects.get(id=1)
+        assert_equals(stored.title, u'b')
+        assert_equals([t.name for t in stored.tags.objects], ['blue'])
+        assert_equals([t.name for t in Post10.objects.get(id=2).tags.objects], ['red'])
+
+        # only the join table changes
+        post.tags = [red, blue]
+        assert_equals(Post10.objects.update(post), ['tags'])
+        assert_equals([t.name for t in Post10.objects.get(id=1).tags.objects], ['red', 'blue'])
+    finally:
+        for model in Tag10, Post10:
+            os.remove(model.objects._fullpath)
+        os.remove(table.path)
+
+def test_model_file_manager_update_keeps_references_lazy():
+    class Customer11(models.Model):
+        id = models.IntegerField(primary_key=True)
+        name = models.CharField(max_length=10)
+        objects = models.FileSystemModelManager(base_path='.')
+
+    class Order11(models.Model):
+        id = models.IntegerField(primary_key=True)
+        note = models.CharField(max_length=10)
+        customer = models.ForeignKey(Customer11, reference=True)
+        objects = models.FileSystemModelManager(base_path='.')
+
+    john = Customer11.objects.create(id=1, name=u'john')
+    mary = Customer11.objects.create(id=2, name=u'mary')
+    Order11.objects.create(id=1, customer=john)
+    Order11.objects.create(id=2, customer=mary)
+
+    try:
+        order = Order11.objects.get(id=1)
+        assert_equals(order.customer.name, u'john')
+        assert_equals(order.changed_fields(), [])
+        assert_equals(Order11.objects.update(order), [])
+
+        orders = Order11.objects.all().prefetch_related('customer')
+        assert_equals([o.changed_fields() for o in orders], [[], []])
+
+        order.note = u'urgent'
+        assert_equals(Order11.objects.update(order), ['note'])
+        order.customer = mary
+        assert_equals(Order11.objects.update(order), ['customer'])
+        assert_equals(Order11.objects.get(id=1).customer.name, u'mary')
+    finally:
+        for model in Customer11, Order11:
+            os.remove(model.objects._fullpath)
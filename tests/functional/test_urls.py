@@ -0,0 +1,204 @@
+# -*- coding: utf-8; -*-
+#
+# Copyright (C) 2009 Gabriel Falcão <gabriel@nacaolivre.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public
+# License along with this program; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+import os
+import time
+import threading
+import SocketServer
+import BaseHTTPServer
+
+from nose.tools import assert_equals, assert_raises
+from deadparrot import models
+from deadparrot.models.urls import URLExistenceService
+
+# (method, path, client port) of every request the server got
+requests = []
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def respond(self):
+        requests.append((self.command, self.path, self.client_address[1]))
+        if self.path == '/slow':
+            time.sleep(0.2)
+        elif self.path == '/timeout':
+            time.sleep(0.5)
+
+        status = 200
+        if self.path == '/missing':
+            status = 404
+        elif self.path == '/nohead' and self.command == 'HEAD':
+            status = 405
+
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    do_HEAD = do_GET = respond
+
+    def log_message(self, *args):
+        pass
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+server = None
+
+def setup_module():
+    global server
+    server = Server(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.setDaemon(True)
+    thread.start()
+
+def teardown_module():
+    server.shutdown()
+    server.server_close()
+
+def url(path):
+    return 'http://127.0.0.1:%d%s' % (server.server_address[1], path)
+
+def test_exists():
+    service = URLExistenceService()
+    assert service.exists(url('/ok'))
+    assert not service.exists(url('/missing'))
+    assert not service.exists('http://127.0.0.1:1/closed')
+    service.close()
+
+def test_exists_falls_back_to_get():
+    service = URLExistenceService()
+    del requests[:]
+    assert service.exists(url('/nohead'))
+    assert_equals([r[0] for r in requests], ['HEAD', 'GET'])
+    service.close()
+
+def test_exists_reuses_the_connection():
+    service = URLExistenceService()
+    del requests[:]
+    for path in '/ok', '/missing', '/ok?page=2':
+        service.exists(url(path))
+
+    assert_equals([r[1] for r in requests], ['/ok', '/missing', '/ok?page=2'])
+    assert_equals(len(set([r[2] for r in requests])), 1)
+    service.close()
+
+def test_exists_does_not_retry_timeouts():
+    service = URLExistenceService(timeout=0.2)
+    del requests[:]
+    started = time.time()
+    assert not service.exists(url('/timeout'))
+    assert time.time() - started < 0.4
+    assert_equals([r[1] for r in requests], ['/timeout'])
+    service.close()
+
+def test_exists_is_cached():
+    service = URLExistenceService(ttl=60)
+    del requests[:]
+    service.exists(url('/ok'))
+    service.exists(url('/ok'))
+    assert_equals(len(requests), 1)
+
+    service._clock = lambda: time.time() + 61
+    service.exists(url('/ok'))
+    assert_equals(len(requests), 2)
+    service.close()
+
+def test_cache_drops_the_least_recently_used():
+    service = URLExistenceService(max_size=2)
+    service.exists(url('/ok'))
+    service.exists(url('/missing'))
+    service.exists(url('/ok'))
+    service.exists(url('/ok?page=2'))
+
+    assert_equals(service.cached(url('/ok')), True)
+    assert_equals(service.cached(url('/missing')), None)
+    service.close()
+
+def test_exists_many_is_concurrent():
+    service = URLExistenceService(workers=5)
+    urls = [url('/slow?%d' % i) for i in range(5)] + [url('/missing')]
+
+    started = time.time()
+    found = service.exists_many(urls + urls)
+    assert time.time() - started < 0.8
+
+    assert_equals(sorted(found.keys()), sorted(urls))
+    assert_equals(found[url('/missing')], False)
+    assert_equals(found[url('/slow?0')], True)
+    service.close()
+
+class FakeService(object):
+    def __init__(self, existing):
+        self.existing = existing
+        self.batches = []
+
+    def exists(self, url):
+        return self.exists_many([url])[url]
+
+    def exists_many(self, urls):
+        self.batches.append(list(urls))
+        return dict([(u, u in self.existing) for u in urls])
+
+def test_urlfield_validate_many():
+    service = FakeService(['http://foo.bar.com'])
+    field = models.URLField(url_checker=models.URLChecker(service))
+    errors = field.validate_many(['http://foo.bar.com', 'http://foo.baz.com', 'nope', 10])
+
+    assert_equals(sorted(errors.keys()), [1, 2, 3])
+    assert_equals(service.batches, [['http://foo.bar.com', 'http://foo.baz.com']])
+
+def test_urlfield_deferred_checks_when_stored():
+    service = FakeService(['http://foo.bar.com', 'http://foo.baz.com'])
+
+    class Site1(models.Model):
+        url = models.URLField(deferred=True, url_checker=models.URLChecker(service))
+        objects = models.FileSystemModelManager(base_path='.')
+
+    sites = [Site1(url=u'http://foo.bar.com'), Site1(url=u'http://foo.baz.com')]
+    assert_equals(service.batches, [])
+
+    Site1.objects.add_many(sites)
+    assert_equals(service.batches, [['http://foo.bar.com', 'http://foo.baz.com']])
+    assert_equals([s.url for s in Site1.objects.all()], [u'http://foo.bar.com', u'http://foo.baz.com'])
+
+    assert_raises(models.FieldValidationError, Site1.objects.add, Site1(url=u'http://foo.qux.com'))
+    assert_equals(len(Site1.objects.all()), 2)
+    os.remove(Site1.objects._fullpath)
+
+def test_urlfield_deferred_checks_when_updated():
+    service = FakeService(['http://foo.bar.com'])
+
+    class Site2(models.Model):
+        id = models.IntegerField(primary_key=True)
+        name = models.CharField(max_length=10)
+        url = models.URLField(deferred=True, url_checker=models.URLChecker(service))
+        objects = models.FileSystemModelManager(base_path='.')
+
+    Site2.objects.create(id=1, url=u'http://foo.bar.com')
+    try:
+        site = Site2.objects.get(id=1)
+        site.name = u'foo'
+        Site2.objects.update(site)
+        assert_equals(len(service.batches), 1)
+
+        site.url = u'http://bad.com/'
+        assert_raises(models.FieldValidationError, Site2.objects.update, site)
+        assert_equals(service.batches[-1], ['http://bad.com/'])
+        assert_equals(Site2.objects.get(id=1).url, u'http://foo.bar.com')
+    finally:
+        os.remove(Site2.objects._fullpath)
@@ -0,0 +1,118 @@
+# -*- coding: utf-8; -*-
+#
+# Copyright (C) 2009 Gabriel Falcão <gabriel@nacaolivre.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public
+# License along with this program; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+from nose.tools import assert_equals
+from deadparrot import models
+from deadparrot.models import codegen
+
+from utils import assert_raises
+
+class CodegenArtist(models.Model):
+    id = models.IntegerField(primary_key=True)
+    name = models.CharField(max_length=20)
+
+class CodegenAlbum(models.Model):
+    id = models.IntegerField(primary_key=True)
+    title = models.CharField(max_length=20)
+    artist = models.ForeignKey(CodegenArtist)
+    guests = models.ManyToManyField(CodegenArtist)
+
+def test_generated_methods_are_set():
+    assert getattr(CodegenAlbum.__init__.im_func, '__deadparrot_generated__', False)
+    assert getattr(CodegenAlbum._load_from_dict.im_func, '__deadparrot_generated__', False)
+
+def test_models_alike_share_the_code():
+    class CodegenSinger(models.Model):
+        id = models.IntegerField(primary_key=True)
+        name = models.CharField(max_length=20)
+
+    assert CodegenSinger.__init__.im_func is not CodegenArtist.__init__.im_func
+    assert CodegenSinger.__init__.im_func.func_code is CodegenArtist.__init__.im_func.func_code
+
+def test_generated_init():
+    album = CodegenAlbum(id=1, title=u'Innuendo', artist=CodegenArtist(id=1, name=u'Queen'),
+                         guests=[CodegenArtist(id=2, name=u'Steve Howe')])
+    assert_equals(album.title, u'Innuendo')
+    assert_equals(album.artist.name, u'Queen')
+    assert_equals([a.name for a in album.guests], [u'Steve Howe'])
+
+def test_generated_init_raises():
+    assert_raises(AttributeError, CodegenAlbum, year=1991)
+    assert_raises(TypeError, CodegenAlbum, artist=u'Queen')
+    assert_raises(models.FieldValidationError, CodegenAlbum, title=u'x' * 21)
+
+def test_generated_loader():
+    album = CodegenAlbum.from_dict({'CodegenAlbum': {
+        'id': 1,
+        'title': u'Innuendo',
+        'artist': {'CodegenArtist': {'id': 1, 'name': u'Queen'}},
+        'guests': {'CodegenArtists': [{'CodegenArtist': {'id': 2, 'name': u'Steve Howe'}}]},
+        'unknown': 'ignored',
+    }})
+    assert_equals(album.id, 1)
+    assert_equals(album.artist.name, u'Queen')
+    assert_equals([a.name for a in album.guests], [u'Steve Howe'])
+
+def test_init_written_by_hand_is_kept():
+    class CodegenBand(models.Model):
+        name = models.CharField(max_length=20)
+        def __init__(self, **kw):
+            kw.setdefault('name', u'Unknown')
+            super(CodegenBand, self).__init__(**kw)
+
+    assert_equals(CodegenBand().name, u'Unknown')
+    assert_equals(CodegenBand(name=u'Yes').name, u'Yes')
+
+def test_setattr_written_by_hand_is_called():
+    class CodegenSong(models.Model):
+        title = models.CharField(max_length=20)
+        def __setattr__(self, attr, val):
+            if attr == 'title':
+                val = val.upper()
+            super(CodegenSong, self).__setattr__(attr, val)
+
+    assert_equals(CodegenSong(title=u'bicycle').title, u'BICYCLE')
+    assert_equals(CodegenSong.from_dict({'CodegenSong': {'title': u'bicycle'}}).title, u'BICYCLE')
+
+def test_trusted_loader_with_setattr_written_by_hand():
+    class CodegenTrack(models.Model):
+        title = models.CharField(max_length=5)
+        def __setattr__(self, attr, val):
+            if attr == 'title':
+                val = val.upper()
+            super(CodegenTrack, self).__setattr__(attr, val)
+
+    data = {'CodegenTrack': {'title': u'bicycle'}}
+    assert_raises(models.FieldValidationError, CodegenTrack.from_dict, data)
+
+    track = CodegenTrack.from_dict(data, trusted=True)
+    assert_equals(track.title, u'BICYCLE')
+    assert 'title' not in track.changed_fields()
+    assert '_setters' not in track.__dict__
+    assert_raises(models.FieldValidationError, setattr, track, 'title', u'bicycle')
+
+def test_loader_source():
+    assert_equals(codegen.loader_source(['id'], [('owner', False)], True),
+                  "def _load_from_dict(cls, data):\n"
+                  "    obj = cls()\n"
+                  "    if 'id' in data:\n"
+                  "        set_attr(obj, 'id', setter_0(obj, data['id']))\n"
+                  "    if 'owner' in data:\n"
+                  "        load_relationship(obj, 'owner', data['owner'])\n"
+                  "    set_attr(obj, '_changed', set())\n"
+                  "    return obj\n")
@@ -0,0 +1,139 @@
+# -*- coding: utf-8; -*-
+#
+# Copyright (C) 2009 Gabriel Falcão <gabriel@nacaolivre.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public
+# License along with this program; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+from array import array
+from decimal import Decimal
+from datetime import datetime
+from nose.tools import assert_equals
+from deadparrot import models
+from deadparrot.models import columnar
+from deadparrot.models.columnar import BitColumn
+
+from utils import assert_raises
+
+class ColumnarPerson(models.Model):
+    name = models.CharField(max_length=20, primary_key=True)
+    age = models.IntegerField()
+    height = models.FloatField()
+    alive = models.BooleanField(positives=['yes'], negatives=['no'])
+
+def make_people():
+    return ColumnarPerson.ColumnarSet()(
+        ColumnarPerson(name=u'john', age=30, height=1.8, alive=True),
+        ColumnarPerson(name=u'mary', age=0, height=1.6, alive=False),
+        ColumnarPerson(name=u'john', age=50))
+
+def test_bit_column():
+    bits = BitColumn([True, False] * 5)
+    assert_equals(len(bits), 10)
+    assert_equals(len(bits.bits), 2)
+    assert_equals(list(bits), [True, False] * 5)
+    assert_equals(bits[-2], True)
+    assert_raises(IndexError, lambda: bits[10])
+
+def test_columnar_set_keeps_typed_columns():
+    people = make_people()
+    assert_equals(len(people), 3)
+    assert isinstance(people.columns['age'].values, array)
+    assert_equals(people.columns['height'].values.typecode, 'd')
+    assert isinstance(people.columns['alive'].values, BitColumn)
+    assert_equals(people.values('age'), [30, 0, 50])
+    assert_equals(people.values('height'), [1.8, 1.6, None])
+    assert_equals(people.values('alive'), [True, False, None])
+
+    names = people.columns['name'].values
+    assert names[0] is names[2]
+
+def test_columnar_set_keeps_large_integers():
+    people = ColumnarPerson.ColumnarSet().from_dict({'ColumnarPersons': [
+        {'ColumnarPerson': {'name': u'john', 'age': 30}},
+        {'ColumnarPerson': {'name': u'mary', 'age': 2 ** 70}},
+        {'ColumnarPerson': {'name': u'ann'}},
+    ]})
+    column = people.columns['age']
+    assert not column.packed
+    assert_equals(people.values('age'), [30, 2 ** 70, None])
+    assert_equals(people.sum('age'), 2 ** 70 + 30)
+    assert_equals(people.argsort('age', reverse=True), [1, 0, 2])
+
+def test_columnar_set_materializes_rows():
+    people = make_people()
+    mary = people[1]
+    assert isinstance(mary, ColumnarPerson)
+    assert_equals((mary.name, mary.age, mary.height, mary.alive), (u'mary', 0, 1.6, False))
+    assert_equals(people[-1].height, None)
+    assert_equals([p.age for p in people[1:]], [0, 50])
+    assert_equals(list(people)[0].name, u'john')
+
+def test_columnar_set_to_dict_and_filter():
+    people = make_people()
+    expected = ColumnarPerson.Set()(*list(people)).to_dict()
+    assert_equals(people.to_dict(), expected)
+    assert_equals(ColumnarPerson.ColumnarSet().from_dict(expected).to_dict(), expected)
+
+    assert_equals(people.filter(name='john').values('age'), [30, 50])
+    assert_equals(people.filter(name='john', age='50').values('age'), [50])
+    assert_equals(len(people.filter(alive=False)), 1)
+    assert_raises(TypeError, people.filter, color='red')
+
+class ColumnarSale(models.Model):
+    id = models.IntegerField(primary_key=True)
+    price = models.DecimalField(max_digits=6, decimal_places=2)
+    sold_at = models.DateTimeField()
+    region = models.CharField(max_length=10)
+    class Meta:
+        fields_validation_policy = models.VALIDATE_NONE
+
+def make_sales(use_numpy):
+    SaleSet = ColumnarSale.ColumnarSet()
+    SaleSet.use_numpy = use_numpy
+    return SaleSet.from_dict({'ColumnarSales': [
+        {'ColumnarSale': {'id': 1, 'price': u'10.50', 'sold_at': u'2009-01-02 10:00:00', 'region': u'north'}},
+        {'ColumnarSale': {'id': 2, 'price': u'99.99', 'sold_at': u'2009-03-01 08:30:00', 'region': u'south'}},
+        {'ColumnarSale': {'id': 3, 'price': u'10.50', 'region': u'north'}},
+        {'ColumnarSale': {'id': 4, 'sold_at': u'2008-12-31 23:59:59', 'region': u'east'}},
+    ]})
+
+def check_columnar_queries(use_numpy):
+    sales = make_sales(use_numpy)
+    assert_equals(sales.filter(id__gt=2).values('id'), [3, 4])
+    assert_equals(sales.filter(id__gte=2, id__lt=4).values('id'), [2, 3])
+    assert_equals(sales.filter(id__in=[1, 4]).values('id'), [1, 4])
+    assert_equals(sales.filter(price__gt='20').values('id'), [2])
+    assert_equals(sales.filter(price='10.5').values('id'), [1, 3])
+    assert_equals(sales.filter(sold_at__lt=datetime(2009, 1, 1)).values('id'), [4])
+    assert_equals(sales.filter(region='north', id__ne=1).values('id'), [3])
+
+    assert_equals(sales.sum('id'), 10)
+    assert_equals(sales.sum('price'), Decimal('120.99'))
+    assert_equals(sales.mean('price'), Decimal('40.33'))
+    assert_equals(sales.mean('id'), 2.5)
+    assert_raises(TypeError, sales.sum, 'region')
+
+    assert_equals(sales.count_by('region'), {u'north': 2, u'south': 1, u'east': 1})
+    assert_equals(sales.count_by('price'), {u'10.50': 2, u'99.99': 1, None: 1})
+    assert_equals(sales.argsort('sold_at'), [3, 0, 1, 2])
+    assert_equals(sales.argsort('price', reverse=True), [1, 0, 2, 3])
+    assert_equals(sales.order_by('id', reverse=True).values('id'), [4, 3, 2, 1])
+    assert_raises(TypeError, sales.filter, id__near=1)
+
+def test_columnar_queries():
+    for use_numpy in False, True:
+        if use_numpy and columnar.numpy is None:
+            continue
+        yield check_columnar_queries, use_numpy
@@ -623,3 +623,28 @@ class TestFieldsBasicBehavior:
         assert (checker.does_exists())
 
         urlmock.verify()
+
+    def test_decimalfield_validate_rounds_without_float(self):
+        field = fields.DecimalField(max_digits=21, decimal_places=2)
+        field.validate('1234567890123456789.01')
+        assert_raises(fields.FieldValidationError, field.validate, '12345678901234567890.01')
+        assert_raises(fields.FieldValidationError, field.validate, 'Infinity')
+
+    def test_datetimefield_checks_its_format_once(self):
+        assert fields.DateTimeField(format="nothing").bad_format
+        assert not fields.DateTimeField(format="%Y/%m").bad_format
+
+    def test_phonenumberfield_compiles_its_regex(self):
+        field = fields.PhoneNumberField(format="(00) 0000-0000")
+        assert field.regex.search("(21) 1234-5678")
+
+    def test_validate_many(self):
+        field = fields.EmailField()
+        errors = field.validate_many(['john@doe.net', 'nope', 'mary@doe.net', 10])
+        assert_equals(sorted(errors.keys()), [1, 3])
+        assert isinstance(errors[1], fields.FieldValidationError)
+        assert isinstance(errors[3], TypeError)
+
+    def test_validate_many_without_errors(self):
+        field = fields.IntegerField()
+        assert_equals(field.validate_many([1, '2', 3.0]), {})
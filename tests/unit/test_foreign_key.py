@@ -138,6 +138,22 @@ class TestForeignKey(unittest.TestCase):
         self.assertEquals(polly.cage, pollys_cage)
         self.assertEquals(polly.cage._to_model, Cage)
 
+    def test_reverse_accessor_is_registered(self):
+        assert isinstance(Cage.parrot_set, models.ReverseRelation)
+        assert Cage.parrot_set.from_model is Parrot
+
+    def test_reverse_accessor_clash(self):
+        class Kennel(models.Model):
+            id = models.IntegerField(primary_key=True)
+            dog_set = models.CharField(max_length=10)
+
+        def make_class():
+            class Dog(models.Model):
+                id = models.IntegerField(primary_key=True)
+                kennel = models.ForeignKey(Kennel)
+
+        assert_raises(models.InvalidRelationShipError, make_class)
+
 class TestForeignKeySerialization(unittest.TestCase):
     unevaluated_xml = """
     <Parrot>
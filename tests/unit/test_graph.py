@@ -0,0 +1,71 @@
+# -*- coding: utf-8; -*-
+#
+# Copyright (C) 2009 Gabriel Falcão <gabriel@nacaolivre.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public
+# License along with this program; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+from nose.tools import assert_equals
+from deadparrot import models
+from deadparrot.lib import demjson
+
+class GraphPerson(models.Model):
+    name = models.CharField(max_length=20, primary_key=True)
+    friend = models.ForeignKey('self')
+
+class GraphTag(models.Model):
+    name = models.CharField(max_length=20, primary_key=True)
+
+class GraphCustomer(models.Model):
+    id = models.IntegerField(primary_key=True)
+    name = models.CharField(max_length=20)
+
+class GraphOrder(models.Model):
+    id = models.IntegerField(primary_key=True)
+    customer = models.ForeignKey(GraphCustomer)
+    tags = models.ManyToManyField(GraphTag)
+
+def test_to_graph_writes_shared_objects_once():
+    john = GraphCustomer(id=1, name='John')
+    red = GraphTag(name='red')
+    orders = GraphOrder.Set()(GraphOrder(id=1, customer=john, tags=[red]),
+                              GraphOrder(id=2, customer=john, tags=[red]))
+
+    graph = orders.to_graph()
+    assert_equals(graph['$refs']['GraphCustomer'], {'[["id",1]]': {'id': 1, 'name': u'John'}})
+    assert_equals(graph['$refs']['GraphOrder']['[["id",2]]'],
+                  {'id': 2, 'customer': {'$ref': ['GraphCustomer', '[["id",1]]']},
+                   'tags': [{'$ref': ['GraphTag', '[["name","red"]]']}]})
+    assert_equals(len(graph['$root']), 2)
+
+    loaded = GraphOrder.Set().from_graph(demjson.decode(demjson.encode(graph)))
+    assert_equals(loaded, orders)
+    assert loaded[0].customer is loaded[1].customer
+    assert_equals(loaded[0].customer.name, 'John')
+    assert loaded[0].tags.objects[0] is loaded[1].tags.objects[0]
+
+def test_to_graph_handles_cycles():
+    ann = GraphPerson(name='ann')
+    bob = GraphPerson(name='bob', friend=ann)
+    ann.friend = bob
+
+    graph = ann.to_graph()
+    assert_equals(graph['$root'], {'$ref': ['GraphPerson', '[["name","ann"]]']})
+    assert_equals(graph['$refs']['GraphPerson']['[["name","bob"]]']['friend'],
+                  {'$ref': ['GraphPerson', '[["name","ann"]]']})
+
+    loaded = GraphPerson.from_graph(graph)
+    assert_equals(loaded.name, 'ann')
+    assert_equals(loaded.friend.name, 'bob')
+    assert loaded.friend.friend is loaded
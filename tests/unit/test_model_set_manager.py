@@ -236,3 +236,56 @@ def test_model_set_manager_method_from_dict_takes_a_dict_as_parameter():
     methods_test_manager = models.ModelSetManager(ModelSetModelTestMethods)
     assert_raises(TypeError, methods_test_manager.from_dict, 'blabla', exc_pattern=r"ModelSetModelTestMethodsSet.from_dict takes a dict as parameter. Got %r" % type('blabla'))
     assert_raises(TypeError, methods_test_manager.from_dict, None, exc_pattern=r"ModelSetModelTestMethodsSet.from_dict takes a dict as parameter. Got %r" % type(None))
+
+class ModelSetModelWithPk(models.Model):
+    id = models.IntegerField(primary_key=True)
+    name = models.CharField(max_length=10)
+
+def test_model_set_manager_add_replaces_objects_with_same_pk():
+    manager = models.ModelSetManager(ModelSetModelWithPk)
+    manager.add(ModelSetModelWithPk(id=1, name='old'))
+    manager.add(ModelSetModelWithPk(id=2))
+    manager.add(ModelSetModelWithPk(id=1, name='new'))
+
+    assert_equals(len(manager), 2)
+    assert_equals([m.name for m in manager], ['new', None])
+    assert ModelSetModelWithPk(id=2) in manager
+    assert ModelSetModelWithPk(id=3) not in manager
+
+    manager.remove(ModelSetModelWithPk(id=1))
+    assert_equals([m.id for m in manager.objects], [2])
+    assert_raises(ValueError, manager.remove, ModelSetModelWithPk(id=1))
+
+def test_model_set_manager_set_algebra():
+    one, two, three = [ModelSetModelWithPk(id=i) for i in 1, 2, 3]
+    first = models.ModelSetManager(ModelSetModelWithPk)
+    second = models.ModelSetManager(ModelSetModelWithPk)
+    for m in one, two:
+        first.add(m)
+    for m in three, two:
+        second.add(m)
+
+    assert_equals([m.id for m in first | second], [1, 2, 3])
+    assert_equals([m.id for m in first & second], [2])
+    assert_equals([m.id for m in first - second], [1])
+    assert_equals(len(first), 2)
+
+    assert_raises(TypeError, lambda: first | models.ModelSetManager(ModelSetModelTestMethods))
+
+def test_model_set_manager_objects_can_not_be_changed():
+    manager = models.ModelSetManager(ModelSetModelWithPk)
+    manager.add(ModelSetModelWithPk(id=1))
+
+    objects = manager.objects
+    assert_equals(objects, [ModelSetModelWithPk(id=1)])
+    assert_raises(TypeError, objects.append, ModelSetModelWithPk(id=2))
+    assert_raises(TypeError, objects.remove, objects[0])
+    def set_item():
+        objects[0] = ModelSetModelWithPk(id=2)
+    assert_raises(TypeError, set_item)
+    assert_equals(len(manager), 1)
+
+def test_model_set_manager_is_true_even_when_empty():
+    manager = models.ModelSetManager(ModelSetModelWithPk)
+    assert manager
+    assert_equals(len(manager), 0)
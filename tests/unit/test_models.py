@@ -611,6 +611,44 @@ class TestModelSet(unittest.TestCase):
         self.assertEquals(people[0], person1)
         self.assertEquals(people[1], person2)
 
+    def test_index_by_and_group_by(self):
+        class Pet(Model):
+            id = fields.IntegerField(primary_key=True)
+            kind = fields.CharField(max_length=10)
+
+        cat, dog, tom = Pet(id=1, kind=u'cat'), Pet(id=2, kind=u'dog'), Pet(id=3, kind=u'cat')
+        pets = Pet.Set()(cat, dog)
+
+        index = pets.index_by('id')
+        self.assertEquals(index, {1: cat, 2: dog})
+        assert pets.index_by('id') is index
+        self.assertEquals(pets.group_by('kind'), {u'cat': Pet.Set()(cat), u'dog': Pet.Set()(dog)})
+
+        pets.add(tom)
+        self.assertEquals(pets.index_by('id')[3], tom)
+        self.assertEquals(pets.group_by('kind')[u'cat'], Pet.Set()(cat, tom))
+
+        pets[0] = Pet(id=4, kind=u'bird')
+        assert 4 in pets
+        assert 1 not in pets
+        assert Pet(id=2) in pets
+        pets.remove(dog)
+        assert 2 not in pets
+        self.assertRaises(TypeError, pets.index_by, 'color')
+
+    def test_set_algebra_by_primary_key(self):
+        class Fish(Model):
+            id = fields.IntegerField(primary_key=True)
+
+        one, two, three = [Fish(id=i) for i in 1, 2, 3]
+        first = Fish.Set()(one, two)
+        second = Fish.Set()(Fish(id=2), three)
+
+        self.assertEquals([f.id for f in first.union(second)], [1, 2, 3])
+        self.assertEquals([f.id for f in first.intersection(second)], [2])
+        self.assertEquals([f.id for f in first.difference(second)], [1])
+        self.assertRaises(TypeError, first.union, [three])
+
 class TestModelSerialization(unittest.TestCase):
     class Person(Model):
             first_name = fields.CharField(max_length=40)
@@ -946,6 +984,228 @@ class TestModelOperations(unittest.TestCase):
         person2 = Person(name=u"polly", birthdate=u'20/01/1988')
         self.assertNotEquals(person1, person2)
 
+class TestCompactModel(unittest.TestCase):
+    def setUp(self):
+        class Band(Model):
+            id = fields.IntegerField(primary_key=True)
+            name = fields.CharField(max_length=20)
+            class Meta:
+                compact = True
+
+        class Musician(Model):
+            id = fields.IntegerField(primary_key=True)
+            name = fields.CharField(max_length=20)
+            band = models.ForeignKey(Band)
+            friends = models.ManyToManyField(Band)
+            class Meta:
+                compact = True
+
+        self.Band = Band
+        self.Musician = Musician
+
+    def test_compact_defaults_to_false(self):
+        class Drummer(Model):
+            name = fields.CharField(max_length=20)
+
+        self.assertEquals(Drummer._meta.compact, False)
+        assert hasattr(Drummer(name=u'Ringo'), '__dict__')
+
+    def test_compact_instances_have_no_dict(self):
+        band = self.Band(id=1, name=u'Queen')
+        assert not hasattr(band, '__dict__')
+        self.assertEquals(self.Band.__slots__,
+                          ('id', 'name', '_from_model', '_to_model', '_changed', '_serialized', '__weakref__'))
+
+    def test_compact_values_are_per_instance(self):
+        queen = self.Band(id=1, name=u'Queen')
+        beatles = self.Band(id=2, name=u'Beatles')
+        self.assertEquals(queen.name, u'Queen')
+        self.assertEquals(beatles.name, u'Beatles')
+        self.assertEquals(self.Band._data['name'], self.Band._meta._fields['name'])
+
+    def test_compact_unset_values_are_none(self):
+        musician = self.Musician(id=1)
+        self.assertEquals(musician.name, None)
+        self.assertEquals(musician.band, None)
+        self.assertEquals(musician.friends.objects, [])
+
+    def test_compact_many_to_many_is_per_instance(self):
+        john = self.Musician(id=1)
+        paul = self.Musician(id=2)
+        john.friends.add(self.Band(id=1, name=u'Queen'))
+        self.assertEquals(len(john.friends), 1)
+        self.assertEquals(len(paul.friends), 0)
+
+    def test_compact_unknown_attribute_raises(self):
+        band = self.Band(id=1)
+        assert_raises(AttributeError, setattr, band, 'genre', u'rock')
+
+    def test_compact_still_validates(self):
+        band = self.Band(id=1)
+        assert_raises(fields.FieldValidationError, setattr, band, 'id', u'one')
+
+    def test_compact_to_dict_and_back(self):
+        band = self.Band(id=1, name=u'Queen')
+        musician = self.Musician(id=1, name=u'Freddie', band=band, friends=[band])
+        data = musician.to_dict()
+        self.assertEquals(data, {'Musician': {'id': 1, 'name': u'Freddie',
+                                              'band': {'Band': {'id': 1, 'name': u'Queen'}},
+                                              'friends': {'Bands': [{'Band': {'id': 1, 'name': u'Queen'}}]}}})
+
+        other = self.Musician.from_dict(data)
+        self.assertEquals(other.name, u'Freddie')
+        self.assertEquals(other.band.name, u'Queen')
+        self.assertEquals([b.id for b in other.friends], [1])
+
+    def test_compact_weakref(self):
+        import weakref
+        band = self.Band(id=1)
+        assert weakref.ref(band)() is band
+
+    def test_compact_references_raise(self):
+        def declare():
+            class Singer(Model):
+                id = fields.IntegerField(primary_key=True)
+                band = models.ForeignKey(self.Band, reference=True)
+                class Meta:
+                    compact = True
+
+        assert_raises(models.InvalidRelationShipError, declare)
+
+class TestDataLeakage(unittest.TestCase):
+    def test_values_are_not_kept_in_the_class(self):
+        class Guitarist(Model):
+            name = fields.CharField(max_length=20)
+
+        Guitarist(name=u'Brian')
+        Guitarist(name=u'Jimmy')
+        self.assertEquals(Guitarist._data['name'], Guitarist._meta._fields['name'])
+
+class TestModelSetters(unittest.TestCase):
+    def test_setters_cover_fields_and_relationships(self):
+        class Label(Model):
+            id = fields.IntegerField(primary_key=True)
+
+        class Record(Model):
+            title = fields.CharField(max_length=20)
+            label = models.ForeignKey(Label)
+            class Meta:
+                fields_validation_policy = models.VALIDATE_NONE
+
+        self.assertEquals(sorted(Record._setters.keys()), ['label', 'title'])
+        self.assertEquals(Label._setters.keys(), ['id'])
+
+    def test_setters_convert_without_validating(self):
+        class Record(Model):
+            title = fields.CharField(max_length=3)
+            class Meta:
+                fields_validation_policy = models.VALIDATE_NONE
+
+        self.assertEquals(Record(title=u'Abbey Road').title, u'Abbey Road')
+
+    def test_setters_check_relationships(self):
+        class Label(Model):
+            id = fields.IntegerField(primary_key=True)
+
+        class Record(Model):
+            label = models.ForeignKey(Label)
+
+        assert_raises(TypeError, Record, label=u'EMI')
+
+    def test_other_attributes_are_set_as_usual(self):
+        class Record(Model):
+            title = fields.CharField(max_length=20)
+
+        record = Record()
+        record.cached = 1
+        self.assertEquals(record.cached, 1)
+
+class TestChangedFields(unittest.TestCase):
+    def setUp(self):
+        class Label(Model):
+            id = fields.IntegerField(primary_key=True)
+
+        class Record(Model):
+            id = fields.IntegerField(primary_key=True)
+            title = fields.CharField(max_length=20)
+            label = models.ForeignKey(Label)
+
+        self.Label = Label
+        self.Record = Record
+
+    def test_changed_fields(self):
+        record = self.Record(id=1, title=u'Abbey Road')
+        self.assertEquals(record.changed_fields(), ['id', 'title'])
+        record.label = self.Label(id=1)
+        self.assertEquals(record.changed_fields(), ['id', 'label', 'title'])
+
+        record._clear_changes()
+        self.assertEquals(record.changed_fields(), [])
+        record.title = u'Let It Be'
+        self.assertEquals(record.changed_fields(), ['title'])
+
+    def test_loaded_instances_have_no_changes(self):
+        record = self.Record.from_dict({'Record': {'id': 1, 'title': u'Abbey Road',
+                                                   'label': {'Label': {'id': 1}}}})
+        self.assertEquals(record.changed_fields(), [])
+        self.assertEquals(record.label.changed_fields(), [])
+
+    def test_serialized_values_are_cached_until_changed(self):
+        record = self.Record(id=1, title=u'Abbey Road')
+        self.assertEquals(record.to_dict(), {'Record': {'id': 1, 'title': u'Abbey Road'}})
+        self.assertEquals(record._serialized, {'id': 1, 'title': u'Abbey Road'})
+
+        record.title = u'Let It Be'
+        self.assertEquals(record._serialized, {'id': 1})
+        self.assertEquals(record.to_dict(), {'Record': {'id': 1, 'title': u'Let It Be'}})
+
+class TestModelIdentity(unittest.TestCase):
+    def setUp(self):
+        class Track(Model):
+            number = fields.IntegerField(primary_key=True)
+            title = fields.CharField(max_length=20)
+
+        class Take(Model):
+            disc = fields.IntegerField(primary_key=True)
+            number = fields.IntegerField(primary_key=True)
+
+        class Note(Model):
+            text = fields.CharField(max_length=20)
+
+        self.Track = Track
+        self.Take = Take
+        self.Note = Note
+
+    def test_pk(self):
+        self.assertEquals(self.Track(number=0, title=u'Intro').pk, 0)
+        self.assertEquals(self.Take(disc=2, number=1).pk, (2, 1))
+        self.assertEquals(self.Note(text=u'la').pk, None)
+
+    def test_eq_and_hash_follow_the_pk(self):
+        intro = self.Track(number=1, title=u'Intro')
+        same = self.Track(number=1, title=u'Outro')
+        other = self.Track(number=2, title=u'Intro')
+
+        assert intro == same and not intro != same
+        assert intro != other
+        self.assertEquals(hash(intro), hash(same))
+        self.assertEquals(len(set([intro, same, other])), 2)
+        self.assertEquals({intro: 1}[same], 1)
+
+    def test_eq_and_hash_without_pk(self):
+        self.assertEquals(self.Note(text=u'do'), self.Note(text=u'do'))
+        self.assertEquals(hash(self.Note(text=u'do')), hash(self.Note(text=u'do')))
+        assert self.Note(text=u'do') != self.Note(text=u're')
+
+    def test_modelset_remove(self):
+        intro = self.Track(number=1, title=u'Intro')
+        outro = self.Track(number=2, title=u'Outro')
+        tracks = self.Track.Set()(intro, outro)
+
+        tracks.remove(self.Track(number=1))
+        self.assertEquals(list(tracks), [outro])
+        assert_raises(ValueError, tracks.remove, intro)
+
 class TestAllFieldsSerialization(unittest.TestCase):
     def setUp(self):
         class Person(models.Model):
@@ -93,3 +93,20 @@ class TestRelationShipBaseInternals:
 
         assert rl1.is_self_referenced is True
         assert rl2.is_self_referenced is False
+
+    def test_set_as_reference_fail_when_not_not_bool(self):
+        rl = models.RelationShip()
+        assert_raises(TypeError, rl.set_reference, None)
+        assert_raises(TypeError, rl.set_reference, 'yes')
+
+    def test_serialize_as_reference(self):
+        class MyModelRSReference(models.Model):
+            id = models.IntegerField(primary_key=True)
+            name = models.CharField(max_length=10)
+
+        rl = models.ForeignKey(MyModelRSReference, reference=True)
+        instance = MyModelRSReference(id=1, name='foo')
+        assert rl.serialize(instance) == {'id': 1}
+        assert rl.serialize([instance]) == [{'id': 1}]
+        assert rl.is_reference({'id': 1})
+        assert not rl.is_reference(instance.to_dict())
@@ -0,0 +1,58 @@
+# -*- coding: utf-8; -*-
+#
+# Copyright (C) 2009 Gabriel Falcão <gabriel@nacaolivre.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public
+# License along with this program; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+import os
+import tempfile
+from nose.tools import assert_equals
+from deadparrot import models
+from deadparrot.models.schema import fingerprint, SchemaStamp
+
+def declare(max_length=10, policy=models.VALIDATE_ALL):
+    class SchemaPerson(models.Model):
+        name = models.CharField(max_length=max_length)
+        birthdate = models.DateField(format='%d/%m/%Y')
+        class Meta:
+            fields_validation_policy = policy
+    return SchemaPerson
+
+def test_fingerprint_is_stable():
+    assert_equals(fingerprint(declare()), fingerprint(declare()))
+
+def test_fingerprint_changes_with_the_fields():
+    assert fingerprint(declare()) != fingerprint(declare(max_length=20))
+
+def test_fingerprint_changes_with_the_validation_policy():
+    assert fingerprint(declare()) != fingerprint(declare(policy=models.VALIDATE_NONE))
+
+def test_stamp_matches_the_storage_it_was_written_for():
+    path = tempfile.mkdtemp()
+    storage = os.path.join(path, 'SchemaPerson.json')
+    open(storage, 'w').write('{"SchemaPersons":[]}')
+
+    stamp = SchemaStamp(os.path.join(path, 'SchemaPerson.schema'), 'abc')
+    assert not stamp.matches(storage)
+    stamp.write(storage)
+    assert stamp.matches(storage)
+    assert not SchemaStamp(stamp.path, 'def').matches(storage)
+
+    open(storage, 'a').write('\n')
+    assert not stamp.matches(storage)
+
+    os.remove(storage)
+    os.remove(stamp.path)
+    os.rmdir(path)
@@ -0,0 +1,68 @@
+# -*- coding: utf-8; -*-
+#
+# Copyright (C) 2009 Gabriel Falcão <gabriel@nacaolivre.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public
+# License along with this program; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+from nose.tools import assert_equals
+from deadparrot import stats
+
+def test_histogram_counts_values_in_buckets():
+    histogram = stats.Histogram(buckets=(0.1, 1.0))
+    for value in 0.05, 0.1, 0.5, 3.0:
+        histogram.observe(value)
+
+    assert_equals(histogram.counts, [2, 1, 1])
+    assert_equals(histogram.cumulative(), [(0.1, 2), (1.0, 3), (None, 4)])
+    assert_equals(histogram.count, 4)
+    assert_equals(histogram.sum, 3.65)
+
+def test_registry_records_and_snapshots():
+    registry = stats.StatsRegistry()
+    registry.record('Order', 'get', 0.002, records_scanned=400, records_returned=1)
+    registry.record('Order', 'get', 0.004, records_scanned=400, records_returned=0)
+
+    snapshot = registry.snapshot()
+    got = snapshot['Order']['get']
+    assert_equals(got['calls'], 2)
+    assert_equals(got['records_scanned'], 800)
+    assert_equals(got['records_returned'], 1)
+    assert_equals(got['bytes_read'], 0)
+    assert_equals(got['latency']['count'], 2)
+
+    registry.reset()
+    assert_equals(registry.snapshot(), {})
+
+def test_registry_snapshot_is_a_copy():
+    registry = stats.StatsRegistry()
+    registry.record('Order', 'all', 0.1)
+    snapshot = registry.snapshot()
+    registry.record('Order', 'all', 0.1)
+    assert_equals(snapshot['Order']['all']['calls'], 1)
+
+def test_registry_to_prometheus():
+    registry = stats.StatsRegistry()
+    registry.record('Order', 'add', 0.003, bytes_written=120)
+
+    text = registry.to_prometheus()
+    assert '# TYPE deadparrot_operations_total counter' in text
+    assert 'deadparrot_operations_total{model="Order",operation="add"} 1\n' in text
+    assert 'deadparrot_bytes_written_total{model="Order",operation="add"} 120\n' in text
+    assert '# TYPE deadparrot_operation_duration_seconds histogram' in text
+    assert 'deadparrot_operation_duration_seconds_bucket{model="Order",operation="add",le="0.0025"} 0\n' in text
+    assert 'deadparrot_operation_duration_seconds_bucket{model="Order",operation="add",le="0.005"} 1\n' in text
+    assert 'deadparrot_operation_duration_seconds_bucket{model="Order",operation="add",le="+Inf"} 1\n' in text
+    assert 'deadparrot_operation_duration_seconds_count{model="Order",operation="add"} 1\n' in text